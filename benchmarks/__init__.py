@@ -0,0 +1,11 @@
+"""MTProxy benchmarks, run them from the repository root, e.g.::
+
+    python -m benchmarks.handshake
+    python -m benchmarks.crypto
+    python -m benchmarks.load --output results.json
+    python -m benchmarks.middle_proxy --clients 1000
+    python -m benchmarks.middle_proxy_rpc
+    python -m benchmarks.timers --connections 100000
+    python -m benchmarks.idle_sessions --sessions 100000
+    python -m benchmarks.dc_failover
+"""
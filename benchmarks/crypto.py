@@ -0,0 +1,34 @@
+"""AES-CTR backends key setup and in place throughput.
+
+Times every installed :class:`mtproxy.mtproto.AES` backend at typical relay chunk sizes
+and prints the ranking the proxy uses to pick one at startup::
+
+    python -m benchmarks.crypto --sizes 1024 16384 131072
+"""
+import argparse
+from mtproxy.mtproto import AES
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1024, 4096, 16384, 65536, 131072],
+                        help='chunk sizes in bytes')
+    parser.add_argument('--chunks', type=int, default=256, help='chunks per measure')
+    options = parser.parse_args()
+
+    print('%-14s %12s' % ('backend', 'setup us') + ''.join('%12s' % ('%dB MB/s' % size) for size in options.sizes))
+    for backend in AES.backends():
+        row = []
+        setup = None
+        for size in options.sizes:
+            setup, chunk = AES.measure(backend, size, options.chunks)
+            row.append(size / chunk / 2 ** 20)
+        print('%-14s %12.2f' % (backend.name, setup * 1e6) + ''.join('%12.1f' % speed for speed in row))
+
+    print()
+    for seconds, backend in AES.calibrate():
+        print('%-14s %.3f ms per session' % (backend.name, seconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""DC failover check.
+
+Drives a :class:`mtproxy.proxy.dc_router.DCRouter` over three endpoints of one DC: a
+:mod:`benchmarks.fake_dc` server, a port refusing connections and a blackholed one, a
+listening socket with a full accept queue that drops SYNs. Both bad endpoints are
+ranked first. The check asserts that connects fail over to the good endpoint, racing
+past the blackholed one, that the breaker of the refusing endpoint opens, half-opens
+once its cooldown is over, opens again with a doubled cooldown while it still
+refuses, and closes once it accepts again. Exits with 1 if any step fails::
+
+    python -m benchmarks.dc_failover
+"""
+import sys
+import time
+import socket
+import asyncio
+import argparse
+from mtproxy.config import Config
+from mtproxy.proxy.dc_router import DCRouter, Endpoint
+from .fake_dc import FakeDC
+from .load import free_port
+
+DC = 2
+
+
+def blackhole() -> tuple:
+    """Listening socket dropping new connections, and the connection filling its queue"""
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(0)
+    filler = socket.socket()
+    filler.setblocking(False)
+    filler.connect_ex(listener.getsockname())
+    # the queue is full once a connection is waiting to be accepted
+    time.sleep(0.1)
+    return listener, filler
+
+
+class Check:
+    __slots__ = {'failed'}
+
+    def __init__(self):
+        self.failed = 0
+
+    def __call__(self, name: str, condition: bool, detail=''):
+        print('%-6s %s %s' % ('ok' if condition else 'FAILED', name, detail))
+        if not condition:
+            self.failed += 1
+
+
+async def run(cooldown: float) -> int:
+    check = Check()
+    loop = asyncio.get_event_loop()
+    good = FakeDC()
+    await good.start()
+    refusing_port = free_port()
+    listener, filler = blackhole()
+
+    config = Config(prefer_ipv6=False, server_connect_timeout=3, to_client_buffer_size=65536)
+    router = DCRouter(config, {DC: [('127.0.0.1', refusing_port), listener.getsockname(), ('127.0.0.1', good.port)]},
+                      probe_interval=0)
+    refusing, blackholed, healthy = router.endpoints[DC]
+    # bad endpoints first
+    refusing.rtt, blackholed.rtt, healthy.rtt = 0.001, 0.002, 0.01
+    Endpoint.COOLDOWN_MIN = cooldown
+
+    try:
+        for attempt in range(Endpoint.FAILURE_THRESHOLD):
+            started = loop.time()
+            _, writer = await router.connect(DC)
+            elapsed = loop.time() - started
+            writer.transport.abort()
+            check('connect %d failed over' % attempt, writer.get_extra_info('peername')[1] == good.port)
+            # the blackholed attempt only delays the next candidate
+            check('connect %d raced past the blackhole' % attempt, elapsed < DCRouter.ATTEMPT_DELAY * 3,
+                  '%.3fs' % elapsed)
+
+        now = loop.time()
+        check('refusing breaker opened', not refusing.is_available(now), refusing)
+        check('refusing endpoint skipped', refusing not in router.candidates(DC))
+        check('outrun blackhole ranked last', router.candidates(DC)[-1] is blackholed, blackholed)
+
+        await asyncio.sleep(cooldown * 1.1)
+        check('refusing breaker half-open', refusing in router.candidates(DC))
+        _, writer = await router.connect(DC)
+        writer.transport.abort()
+        check('refusing breaker reopened', not refusing.is_available(loop.time()))
+        check('cooldown doubled', refusing.cooldown == cooldown * 2, refusing.cooldown)
+
+        recovered = FakeDC(port=refusing_port)
+        await recovered.start()
+        await asyncio.sleep(refusing.cooldown * 1.1)
+        _, writer = await router.connect(DC)
+        writer.transport.abort()
+        check('recovered endpoint used', writer.get_extra_info('peername')[1] == refusing_port)
+        check('refusing breaker closed', refusing.failures == 0 and refusing.is_available(loop.time()), refusing)
+        recovered.server.close()
+    finally:
+        router.close()
+        good.server.close()
+        filler.close()
+        listener.close()
+        # let the fake DC handlers see the aborted connections
+        await asyncio.sleep(0.1)
+    return check.failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--cooldown', type=float, default=0.5, help='breaker cooldown, seconds')
+    options = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    failed = loop.run_until_complete(run(options.cooldown))
+    loop.close()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
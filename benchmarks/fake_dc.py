@@ -0,0 +1,80 @@
+"""Local stand-in for a Telegram Data Center.
+
+Does the server side of the obfuscated2 handshake, then reads a request of
+``REQUEST`` (upload bytes, download bytes) sent by the client. It sends ``download``
+bytes, sinks ``upload`` bytes and acknowledges them with one more byte, then waits for
+the connection to be closed. Payload bytes are not encrypted nor checked, the proxy
+relays them all the same.
+"""
+import struct
+import asyncio
+from mtproxy.mtproto import Keys
+
+REQUEST = struct.Struct('<QQ')
+CHUNK = b'\0' * 65536
+
+
+class FakeDC:
+    """Fake DC server
+
+    Args:
+        host (``str``, *optional*)
+            Listen address.
+        port (``int``, *optional*)
+            Listen port, any free port by default.
+    """
+
+    __slots__ = {'host', 'port', 'server'}
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port, limit=len(CHUNK))
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        try:
+            # pre-connected proxy pool connections may be closed without a handshake
+            message = await reader.readexactly(Keys.SAMPLE_LEN)
+            keys = Keys(message)
+            decryptor = keys.generate_decryptor()
+            decryptor.decrypt(message)
+
+            upload, download = REQUEST.unpack(decryptor.decrypt(await reader.readexactly(REQUEST.size)))
+            sending = asyncio.ensure_future(FakeDC.send(writer, download))
+            while upload:
+                data = await reader.read(min(upload, len(CHUNK)))
+                if not data:
+                    break
+                upload -= len(data)
+            await sending
+
+            writer.write(b'\0')
+            while await reader.read(len(CHUNK)):
+                pass
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.transport.abort()
+
+    @staticmethod
+    async def send(writer, size: int):
+        view = memoryview(CHUNK)
+        while size:
+            chunk = view[:min(size, len(CHUNK))]
+            writer.write(chunk)
+            size -= len(chunk)
+            await writer.drain()
+
+
+def serve(port_queue, host: str = '127.0.0.1'):
+    """Run a fake DC until killed, putting its port to ``port_queue``"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    dc = FakeDC(host)
+    loop.run_until_complete(dc.start())
+    port_queue.put(dc.port)
+    loop.run_forever()
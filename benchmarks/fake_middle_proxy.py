@@ -0,0 +1,152 @@
+"""Local stand-in for a Telegram middle proxy.
+
+Does the middle proxy side of the RPC nonce exchange and handshake, then answers every
+``RPC_PROXY_REQ`` with an ``RPC_PROXY_ANS`` echoing its payload to the same connection
+id, and a ``RPC_SIMPLE_ACK`` first when a quick ack is requested. Connections, session
+ids, closed sessions and ad tags seen are kept in ``stats``.
+"""
+import os
+import zlib
+import socket
+import asyncio
+from mtproxy.mtproto import AESCBC
+from mtproxy.proxy import middle_proxy as rpc
+
+SECRET = bytes(range(128))
+
+
+class FrameStream:
+    """RPC frames over a stream pair, AES-CBC encrypted once ``encryptor`` and ``decryptor`` are set"""
+
+    __slots__ = {'reader', 'writer', 'encryptor', 'decryptor', 'read_seq', 'write_seq', 'buffer'}
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.encryptor = None
+        self.decryptor = None
+        self.read_seq = -2
+        self.write_seq = -2
+        self.buffer = bytearray()
+
+    async def readexactly(self, n: int) -> bytes:
+        while len(self.buffer) < n:
+            if self.decryptor is None:
+                self.buffer += await self.reader.readexactly(n - len(self.buffer))
+            else:
+                self.buffer += self.decryptor.decrypt(await self.reader.readexactly(16))
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    async def read(self) -> bytes:
+        length = 4
+        while length == 4:
+            length = int.from_bytes(await self.readexactly(4), 'little')
+        frame = int.to_bytes(length, 4, 'little') + await self.readexactly(length - 4)
+        if self.decryptor is None:
+            # the padding of the plain nonce frame, encryption starts at a block boundary
+            await self.readexactly(-length % 16)
+        if int.from_bytes(frame[-4:], 'little') != zlib.crc32(frame[:-4]):
+            raise ValueError("bad checksum")
+        if int.from_bytes(frame[4:8], 'little', signed=True) != self.read_seq:
+            raise ValueError("bad sequence number")
+        self.read_seq += 1
+        return frame[8:-4]
+
+    def write(self, message: bytes):
+        frame = int.to_bytes(len(message) + 12, 4, 'little') + int.to_bytes(self.write_seq, 4, 'little', signed=True)
+        frame += message
+        frame += int.to_bytes(zlib.crc32(frame), 4, 'little')
+        frame += rpc.PADDING * (-len(frame) % 16 // 4)
+        self.write_seq += 1
+        self.writer.write(self.encryptor.encrypt(frame) if self.encryptor else frame)
+
+
+class FakeMiddleProxy:
+    """Fake middle proxy server
+
+    Args:
+        secret (``bytes``, *optional*)
+            Middle proxy secret the proxy is configured with.
+        host (``str``, *optional*)
+            Listen address.
+        port (``int``, *optional*)
+            Listen port, any free port by default.
+    """
+
+    __slots__ = {'secret', 'host', 'port', 'server', 'stats'}
+
+    def __init__(self, secret: bytes = SECRET, host: str = '127.0.0.1', port: int = 0):
+        self.secret = secret
+        self.host = host
+        self.port = port
+        self.server = None
+        self.stats = {'connections': 0, 'sessions': set(), 'closed': set(), 'ad_tags': set()}
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        stream = FrameStream(reader, writer)
+        try:
+            await self.handshake(stream)
+            self.stats['connections'] += 1
+            while True:
+                message = await stream.read()
+                kind = message[:4]
+                if kind == rpc.RPC_PROXY_REQ:
+                    self.answer(stream, message)
+                elif kind == rpc.RPC_CLOSE_CONN:
+                    self.stats['closed'].add(message[4:12])
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.transport.abort()
+
+    async def handshake(self, stream: FrameStream):
+        nonce = await stream.read()
+        if nonce[:4] != rpc.RPC_NONCE or nonce[4:8] != self.secret[:4] or nonce[8:12] != rpc.CRYPTO_AES:
+            raise ValueError("bad nonce")
+        nonce_srv = os.urandom(16)
+        stream.write(rpc.RPC_NONCE + self.secret[:4] + rpc.CRYPTO_AES + nonce[12:16] + nonce_srv)
+
+        srv_ip, srv_port = stream.writer.get_extra_info('sockname')[:2]
+        clt_ip, clt_port = stream.writer.get_extra_info('peername')[:2]
+        args = dict(nonce_srv=nonce_srv, nonce_clt=nonce[16:32], clt_ts=nonce[12:16],
+                    srv_ip=socket.inet_aton(srv_ip)[::-1],
+                    clt_ip=socket.inet_aton(clt_ip)[::-1],
+                    srv_port=int.to_bytes(srv_port, 2, 'little'), clt_port=int.to_bytes(clt_port, 2, 'little'),
+                    secret=self.secret)
+        stream.decryptor = AESCBC(*rpc.derive_keys(b'CLIENT', **args))
+        stream.encryptor = AESCBC(*rpc.derive_keys(b'SERVER', **args))
+
+        handshake = await stream.read()
+        if handshake[:4] != rpc.RPC_HANDSHAKE:
+            raise ValueError("bad handshake")
+        stream.write(rpc.RPC_HANDSHAKE + rpc.RPC_FLAGS + rpc.PROCESS_ID + handshake[8:20])
+
+    def answer(self, stream: FrameStream, message: bytes):
+        flags = int.from_bytes(message[4:8], 'little')
+        conn_id = message[8:16]
+        payload = message[56:]
+        if flags & rpc.FLAG_HAS_AD_TAG:
+            extra = int.from_bytes(payload[:4], 'little')
+            self.stats['ad_tags'].add(payload[9:9 + payload[8]].hex())
+            payload = payload[4 + extra:]
+        self.stats['sessions'].add(conn_id)
+
+        if flags & rpc.FLAG_QUICKACK:
+            stream.write(rpc.RPC_SIMPLE_ACK + conn_id + payload[:4])
+        stream.write(rpc.RPC_PROXY_ANS + bytes(4) + conn_id + payload)
+
+
+def serve(port_queue, secret: bytes = SECRET, host: str = '127.0.0.1'):
+    """Run a fake middle proxy until killed, putting its port to ``port_queue``"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    middle_proxy = FakeMiddleProxy(secret, host)
+    loop.run_until_complete(middle_proxy.start())
+    port_queue.put(middle_proxy.port)
+    loop.run_forever()
@@ -0,0 +1,74 @@
+"""Client handshake cost against the number of proxy users.
+
+Compares the linear scan ``ClientSteamProtocol.handle_handshake`` used to do with
+:class:`mtproxy.mtproto.HandshakeEngine`, for a client whose secret is the last one of the
+table with no recent hit nor IP affinity (cold) and for a client reconnecting from the
+same IP (warm). The engine is built once, outside the timings::
+
+    python -m benchmarks.handshake --users 1 10 100 1000 5000
+"""
+import os
+import time
+import argparse
+from mtproxy.mtproto import Keys, HandshakeEngine
+from mtproxy.utils import User
+from .obfuscated2 import client_handshake
+
+
+def linear_match(users: list, sample: Keys):
+    for user in users:
+        secret = bytes.fromhex(user.secret)
+        decryptor = sample.generate_decryptor(secret)
+        decrypted = decryptor.decrypt(sample.buffer)
+        sample.generate_encryptor(secret)
+        if decrypted[Keys.PROTO_TAG_POS:Keys.PROTO_TAG_POS + Keys.PROTO_TAG_LEN] in HandshakeEngine.PROTO_TAGS:
+            return user
+
+
+def engine_match(engine: HandshakeEngine, sample: Keys, ip: str):
+    user, secret, _ = engine.match(sample, ip)
+    sample.generate_decryptor(secret).decrypt(sample.buffer)
+    sample.generate_encryptor(secret)
+    return user
+
+
+def cold_match(engine: HandshakeEngine, sample: Keys, ip: str):
+    # forget the recent hits and IP affinities, as for a client the engine has never seen
+    engine._recent.clear()
+    engine._affinity.clear()
+    return engine_match(engine, sample, ip)
+
+
+def timed(func, messages: list) -> float:
+    started = time.perf_counter()
+    for message in messages:
+        func(Keys(message))
+    return (time.perf_counter() - started) / len(messages)
+
+
+def run(user_counts: list, rounds: int):
+    print("%8s %14s %14s %14s" % ("users", "linear, us", "cold, us", "warm, us"))
+    for count in user_counts:
+        users = [User('user%d' % i, os.urandom(16).hex()) for i in range(count)]
+        secret = bytes.fromhex(users[-1].secret)
+        messages = [client_handshake(secret, Keys.PROTO_TAG_SECURE)[0] for _ in range(rounds)]
+
+        linear = timed(lambda sample: linear_match(users, sample), messages)
+        engine = HandshakeEngine(users)
+        cold = timed(lambda sample: cold_match(engine, sample, '10.0.0.1'), messages)
+        engine_match(engine, Keys(client_handshake(secret, Keys.PROTO_TAG_SECURE)[0]), '10.0.0.1')
+        warm = timed(lambda sample: engine_match(engine, sample, '10.0.0.1'), messages)
+
+        print("%8d %14.1f %14.1f %14.1f" % (count, linear * 1e6, cold * 1e6, warm * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, nargs='+', default=[1, 10, 100, 1000, 5000])
+    parser.add_argument('--rounds', type=int, default=20)
+    options = parser.parse_args()
+    run(options.users, options.rounds)
+
+
+if __name__ == '__main__':
+    main()
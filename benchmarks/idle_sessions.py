@@ -0,0 +1,153 @@
+"""Idle sessions memory benchmark.
+
+Starts an :class:`mtproxy.MTProxy` and a :mod:`benchmarks.fake_dc` server per Data
+Center in their own processes, then opens ``--sessions`` obfuscated2 client sessions
+through the proxy and leaves them idle once relayed. The proxy RSS and event loop
+tasks per session are printed for each relay engine, and written as JSON with
+``--output`` to follow them across releases. The protocol engine keeps no task for an
+idle session, the stream engine two::
+
+    python -m benchmarks.idle_sessions --sessions 100000
+
+Sessions are spread over the Data Centers and over ``127.0.0.0/8`` source addresses, so
+no address pair runs out of ephemeral ports. The proxy holds two file descriptors per
+session and the clients one, raise the hard ``ulimit -n`` to fit, each process raises
+its soft limit to it. RSS is read from ``/proc``, it is null on other platforms.
+"""
+import os
+import sys
+import json
+import asyncio
+import argparse
+import platform
+import multiprocessing
+from mtproxy import MTProxy
+from mtproxy.utils import User, setup_files_limit
+from . import fake_dc
+from .load import SECRET, PROTO_TAGS, free_port, wait_listening, rss, package_version
+from .obfuscated2 import client_handshake
+
+DCS = (1, 2, 3, 4, 5)
+SOURCES = 16
+BATCH = 500
+
+
+def run_proxy(port: int, dc_ports: dict, fast_mode: bool, relay_engine: str, tasks):
+    setup_files_limit()
+    sys.stdout = open(os.devnull, 'w')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    proxy = MTProxy(loop=loop, port=port, fast_mode=fast_mode, relay_engine=relay_engine, prefer_ipv6=False,
+                    listen_addr_ipv4='127.0.0.1', listen_addr_ipv6='::1',
+                    datacenters={dc: [('127.0.0.1', dc_port)] for dc, dc_port in dc_ports.items()},
+                    ipv4='127.0.0.1', ip_discovery=False)
+    proxy.config.users.append(User('bench', SECRET))
+    # answers every request on the pipe with the number of tasks of the loop
+    loop.add_reader(tasks.fileno(), lambda: tasks.send(tasks.recv() and len(asyncio.all_tasks(loop))))
+    proxy.start()
+    proxy.run_until_disconnected()
+
+
+async def open_session(port: int, number: int) -> asyncio.StreamWriter:
+    """Open a session and wait for it to be relayed, it is left idle with no task"""
+    source = '127.0.0.%d' % (1 + number % SOURCES)
+    reader, writer = await asyncio.open_connection('127.0.0.1', port, local_addr=(source, 0))
+    try:
+        message, encryptor, _ = client_handshake(bytes.fromhex(SECRET), PROTO_TAGS[number % len(PROTO_TAGS)],
+                                                 DCS[number % len(DCS)])
+        writer.write(message + encryptor.encrypt(fake_dc.REQUEST.pack(0, 0)))
+        # the DC acknowledges the empty upload with a byte
+        await reader.readexactly(1)
+    except BaseException:
+        writer.transport.abort()
+        raise
+    return writer
+
+
+def count_tasks(tasks) -> int:
+    tasks.send(True)
+    return tasks.recv()
+
+
+async def idle_sessions(port: int, pid: int, tasks, sessions: int) -> dict:
+    before = rss(pid)
+    tasks_before = count_tasks(tasks)
+    writers = []
+    try:
+        for start in range(0, sessions, BATCH):
+            # in batches, so the accept backlog doesn't overflow
+            writers.extend(await asyncio.gather(*[open_session(port, number)
+                                                  for number in range(start, min(sessions, start + BATCH))]))
+        await asyncio.sleep(1)
+        after = rss(pid)
+        tasks_after = count_tasks(tasks)
+    finally:
+        for writer in writers:
+            writer.transport.abort()
+    result = {'sessions': sessions, 'tasks_per_session': (tasks_after - tasks_before) / sessions,
+              'rss_before_mb': None, 'rss_after_mb': None, 'rss_per_session_kb': None}
+    if before is not None and after is not None:
+        result.update(rss_before_mb=before / 2 ** 20, rss_after_mb=after / 2 ** 20,
+                      rss_per_session_kb=(after - before) / sessions / 1024)
+    return result
+
+
+def run(options, relay_engine: str) -> dict:
+    port = free_port()
+    port_queue = multiprocessing.Queue()
+    dcs = []
+    for _ in DCS:
+        dc = multiprocessing.Process(target=fake_dc.serve, args=(port_queue,), daemon=True)
+        dc.start()
+        dcs.append(dc)
+    dc_ports = {dc: port_queue.get() for dc in DCS}
+
+    tasks, proxy_tasks = multiprocessing.Pipe()
+    proxy = multiprocessing.Process(target=run_proxy, args=(port, dc_ports, options.fast_mode == 'on', relay_engine,
+                                                            proxy_tasks), daemon=True)
+    proxy.start()
+    try:
+        wait_listening(port)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        result = {'engine': relay_engine}
+        result.update(loop.run_until_complete(idle_sessions(port, proxy.pid, tasks, options.sessions)))
+        loop.close()
+        return result
+    finally:
+        for process in [proxy] + dcs:
+            process.terminate()
+            process.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--engine', choices=('stream', 'protocol', 'both'), default='both')
+    parser.add_argument('--fast-mode', choices=('on', 'off'), default='off')
+    parser.add_argument('--sessions', type=int, default=100000)
+    parser.add_argument('--output', help='JSON results file')
+    options = parser.parse_args()
+
+    setup_files_limit()
+    engines = ('stream', 'protocol') if options.engine == 'both' else (options.engine,)
+    results = {
+        'benchmark': 'idle_sessions',
+        'version': package_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': vars(options),
+        'runs': [run(options, engine) for engine in engines],
+    }
+
+    for result in results['runs']:
+        print('engine=%-8s' % result['engine'], ', '.join(
+            '%s=%s' % (key, '%.2f' % value if isinstance(value, float) else value)
+            for key, value in result.items() if key != 'engine'
+        ))
+    if options.output:
+        with open(options.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+"""End-to-end proxy load benchmark.
+
+Starts a :mod:`benchmarks.fake_dc` server and an :class:`mtproxy.MTProxy` routed to it
+in their own processes, then drives synthetic obfuscated2 clients through the proxy,
+cycling abridged, intermediate and secure proto tags. Each proxy configuration runs:
+
+* a connection phase, ``--connections`` short sessions over ``--concurrency`` client
+  loops, for handshakes/s and time to first byte (connect to the first Telegram byte);
+* a throughput phase per direction, ``--clients`` sessions moving ``--size`` bytes
+  each, for MB/s and the proxy CPU time per GB relayed;
+* an idle phase holding ``--idle`` sessions open, for the proxy RSS per connection.
+
+Results are printed, and written as JSON with ``--output`` to compare releases::
+
+    python -m benchmarks.load --output results.json
+
+CPU and RSS are read from ``/proc``, they are null on other platforms. The client side
+runs in one process, on small machines it may be the bottleneck of the throughput phase.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import platform
+import multiprocessing
+from mtproxy import MTProxy
+from mtproxy.mtproto import Keys
+from mtproxy.utils import User, setup_files_limit
+from . import fake_dc
+from .obfuscated2 import client_handshake
+
+SECRET = '0123456789abcdef0123456789abcdef'
+DC = 2
+PROTO_TAGS = (Keys.PROTO_TAG_ABRIDGED, Keys.PROTO_TAG_INTERMEDIATE, Keys.PROTO_TAG_SECURE)
+CHUNK = b'\0' * 65536
+
+
+def run_proxy(port: int, dc_port: int, fast_mode: bool, relay_engine: str):
+    setup_files_limit()
+    sys.stdout = open(os.devnull, 'w')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    proxy = MTProxy(loop=loop, port=port, fast_mode=fast_mode, relay_engine=relay_engine, prefer_ipv6=False,
+                    listen_addr_ipv4='127.0.0.1', listen_addr_ipv6='::1',
+                    datacenters={DC: [('127.0.0.1', dc_port)]}, ipv4='127.0.0.1', ip_discovery=False)
+    proxy.config.users.append(User('bench', SECRET))
+    proxy.start()
+    proxy.run_until_disconnected()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_listening(port: int, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def cpu_time(pid: int):
+    """User and system CPU seconds of a process"""
+    try:
+        with open('/proc/%d/stat' % pid) as file:
+            fields = file.read().rpartition(')')[2].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def rss(pid: int):
+    """Resident set size of a process in bytes"""
+    try:
+        with open('/proc/%d/status' % pid) as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def percentile(values: list, fraction: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def session(port: int, number: int, upload: int, download: int, hold: asyncio.Future = None,
+                  established: list = None):
+    """Run one client session through the proxy, held open until ``hold`` is done if given
+
+    Return:
+        ``float``: seconds from connect to the first byte from the DC.
+    """
+    loop = asyncio.get_event_loop()
+    started = loop.time()
+    reader, writer = await asyncio.open_connection('127.0.0.1', port, limit=len(CHUNK))
+    try:
+        message, encryptor, _ = client_handshake(bytes.fromhex(SECRET), PROTO_TAGS[number % len(PROTO_TAGS)], DC)
+        writer.write(message + encryptor.encrypt(fake_dc.REQUEST.pack(upload, download)))
+
+        # the proxy doesn't look into the payload, it is sent unencrypted
+        view = memoryview(CHUNK)
+        remaining = upload
+        while remaining:
+            chunk = view[:min(remaining, len(CHUNK))]
+            writer.write(chunk)
+            remaining -= len(chunk)
+            await writer.drain()
+
+        first_byte = None
+        remaining = download + 1
+        while remaining:
+            data = await reader.read(len(CHUNK))
+            if not data:
+                raise ConnectionError("Session closed with %d bytes left" % remaining)
+            if first_byte is None:
+                first_byte = loop.time()
+            remaining -= len(data)
+
+        if hold is not None:
+            established.append(number)
+            await hold
+        return first_byte - started
+    finally:
+        writer.transport.abort()
+
+
+async def connection_phase(port: int, connections: int, concurrency: int) -> dict:
+    loop = asyncio.get_event_loop()
+    counter = iter(range(connections))
+    ttfb = []
+
+    async def client_loop():
+        for number in counter:
+            ttfb.append(await session(port, number, 0, 0))
+
+    started = loop.time()
+    await asyncio.gather(*[client_loop() for _ in range(concurrency)])
+    elapsed = loop.time() - started
+    return {
+        'handshakes_per_s': connections / elapsed,
+        'ttfb_p50_ms': percentile(ttfb, 0.5) * 1000,
+        'ttfb_p99_ms': percentile(ttfb, 0.99) * 1000,
+    }
+
+
+async def throughput_phase(port: int, pid: int, clients: int, size: int, upload: bool) -> dict:
+    loop = asyncio.get_event_loop()
+    cpu = cpu_time(pid)
+    started = loop.time()
+    await asyncio.gather(*[
+        session(port, number, size if upload else 0, 0 if upload else size) for number in range(clients)
+    ])
+    elapsed = loop.time() - started
+    total = clients * size
+    result = {'mb_per_s': total / elapsed / 2 ** 20, 'cpu_s_per_gb': None}
+    if cpu is not None:
+        result['cpu_s_per_gb'] = (cpu_time(pid) - cpu) / (total / 2 ** 30)
+    return result
+
+
+async def idle_phase(port: int, pid: int, idle: int) -> dict:
+    before = rss(pid)
+    hold = asyncio.get_event_loop().create_future()
+    established = []
+    sessions = []
+    for start in range(0, idle, 500):
+        # open in batches, so the accept backlog doesn't overflow
+        sessions.extend(asyncio.ensure_future(session(port, number, 0, 0, hold, established))
+                        for number in range(start, min(idle, start + 500)))
+        while len(established) < len(sessions):
+            failed = [task for task in sessions if task.done()]
+            if failed:
+                hold.set_result(None)
+                await asyncio.gather(*sessions, return_exceptions=True)
+                failed[0].result()
+            await asyncio.sleep(0.05)
+    await asyncio.sleep(1)
+    after = rss(pid)
+    hold.set_result(None)
+    await asyncio.gather(*sessions)
+    if before is None or after is None:
+        return {'rss_per_connection_kb': None}
+    return {'rss_per_connection_kb': (after - before) / idle / 1024}
+
+
+def run(options, fast_mode: bool) -> dict:
+    port = free_port()
+    port_queue = multiprocessing.Queue()
+    dc = multiprocessing.Process(target=fake_dc.serve, args=(port_queue,), daemon=True)
+    dc.start()
+    dc_port = port_queue.get()
+
+    proxy = multiprocessing.Process(target=run_proxy, args=(port, dc_port, fast_mode, options.engine), daemon=True)
+    proxy.start()
+    try:
+        wait_listening(port)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        result = {'fast_mode': fast_mode}
+        result.update(loop.run_until_complete(connection_phase(port, options.connections, options.concurrency)))
+        for direction, upload in (('to_server', True), ('to_client', False)):
+            phase = loop.run_until_complete(throughput_phase(port, proxy.pid, options.clients, options.size, upload))
+            result['%s_mb_per_s' % direction] = phase['mb_per_s']
+            result['%s_cpu_s_per_gb' % direction] = phase['cpu_s_per_gb']
+        result.update(loop.run_until_complete(idle_phase(port, proxy.pid, options.idle)))
+        loop.close()
+        return result
+    finally:
+        proxy.terminate()
+        dc.terminate()
+        proxy.join()
+        dc.join()
+
+
+def package_version():
+    try:
+        from importlib.metadata import version
+        return version('mtproxy')
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--engine', choices=('stream', 'protocol'), default='stream')
+    parser.add_argument('--fast-mode', choices=('on', 'off', 'both'), default='both')
+    parser.add_argument('--connections', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--size', type=int, default=8 * 2 ** 20, help='bytes per throughput session')
+    parser.add_argument('--idle', type=int, default=2000)
+    parser.add_argument('--output', help='JSON results file')
+    options = parser.parse_args()
+
+    setup_files_limit()
+    modes = {'on': [True], 'off': [False], 'both': [False, True]}[options.fast_mode]
+    results = {
+        'benchmark': 'load',
+        'version': package_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'engine': options.engine,
+        'options': vars(options),
+        'runs': [run(options, fast_mode) for fast_mode in modes],
+    }
+
+    for result in results['runs']:
+        print('fast_mode=%-5s' % result['fast_mode'], ', '.join(
+            '%s=%s' % (key, '%.2f' % value if isinstance(value, float) else value)
+            for key, value in result.items() if key != 'fast_mode'
+        ))
+    if options.output:
+        with open(options.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
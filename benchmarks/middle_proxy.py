@@ -0,0 +1,130 @@
+"""Middle proxy mode benchmark.
+
+Runs an :class:`mtproxy.MTProxy` in middle proxy mode in its own process, against a
+:mod:`benchmarks.fake_middle_proxy` server running with the clients, and drives
+``--clients`` concurrent sessions, cycling abridged, intermediate and secure proto tags.
+Each session sends ``--messages`` messages of ``--size`` bytes, every other one with a
+quick ack request, and checks their echoes. Messages/s and the number of middle proxy
+connections the sessions were multiplexed over are printed::
+
+    python -m benchmarks.middle_proxy --clients 1000
+"""
+import os
+import sys
+import asyncio
+import argparse
+import multiprocessing
+from mtproxy import MTProxy
+from mtproxy.mtproto import Keys
+from mtproxy.utils import User, setup_files_limit
+from .fake_middle_proxy import FakeMiddleProxy, SECRET as PROXY_SECRET
+from .load import SECRET, DC, PROTO_TAGS, free_port, wait_listening
+from .obfuscated2 import client_handshake
+
+AD_TAG = '0123456789abcdef0123456789abcdef'
+
+
+def run_proxy(port: int, middle_proxy_port: int, connections: int):
+    setup_files_limit()
+    sys.stdout = open(os.devnull, 'w')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    proxy = MTProxy(loop=loop, port=port, prefer_ipv6=False, listen_addr_ipv4='127.0.0.1', listen_addr_ipv6='::1',
+                    middle_proxy=True, middle_proxy_connections=connections,
+                    middle_proxy_secret=PROXY_SECRET.hex(), middle_proxies={DC: [('127.0.0.1', middle_proxy_port)]},
+                    ad_tag=AD_TAG, ipv4='127.0.0.1', ip_discovery=False)
+    proxy.config.users.append(User('bench', SECRET))
+    proxy.start()
+    proxy.run_until_disconnected()
+
+
+def frame(proto_tag: bytes, message: bytes, quickack: bool) -> bytes:
+    if proto_tag == Keys.PROTO_TAG_ABRIDGED:
+        length = len(message) // 4
+        if length < 0x7f:
+            return bytes((length | (0x80 if quickack else 0),)) + message
+        return bytes((0xff if quickack else 0x7f,)) + int.to_bytes(length, 3, 'little') + message
+    return int.to_bytes(len(message) | (0x80000000 if quickack else 0), 4, 'little') + message
+
+
+async def session(port: int, number: int, messages: int, size: int):
+    """Run one client session through the proxy, checking the echoed messages"""
+    proto_tag = PROTO_TAGS[number % len(PROTO_TAGS)]
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        handshake, encryptor, decryptor = client_handshake(bytes.fromhex(SECRET), proto_tag, DC)
+        writer.write(handshake)
+        for index in range(messages):
+            message = os.urandom(size)
+            quickack = index % 2 == 1
+            writer.write(encryptor.encrypt(frame(proto_tag, message, quickack)))
+            if quickack:
+                # echoed by the fake middle proxy as the first 4 bytes
+                confirm = decryptor.decrypt(await reader.readexactly(4))
+                expected = message[:4][::-1] if proto_tag == Keys.PROTO_TAG_ABRIDGED else message[:4]
+                if confirm != expected:
+                    raise ValueError("Bad quick ack")
+
+            if proto_tag == Keys.PROTO_TAG_ABRIDGED:
+                length = decryptor.decrypt(await reader.readexactly(1))[0]
+                if length == 0x7f:
+                    length = int.from_bytes(decryptor.decrypt(await reader.readexactly(3)), 'little')
+                length *= 4
+            else:
+                length = int.from_bytes(decryptor.decrypt(await reader.readexactly(4)), 'little')
+            answer = decryptor.decrypt(await reader.readexactly(length))
+            # secure transport answers may be padded
+            if answer[:size] != message:
+                raise ValueError("Bad echo")
+    finally:
+        writer.transport.abort()
+
+
+async def benchmark(options) -> dict:
+    loop = asyncio.get_event_loop()
+    middle_proxy = FakeMiddleProxy()
+    await middle_proxy.start()
+
+    port = free_port()
+    proxy = multiprocessing.Process(target=run_proxy, args=(port, middle_proxy.port, options.connections),
+                                    daemon=True)
+    proxy.start()
+    try:
+        await loop.run_in_executor(None, wait_listening, port)
+        started = loop.time()
+        await asyncio.gather(*[session(port, number, options.messages, options.size)
+                               for number in range(options.clients)])
+        elapsed = loop.time() - started
+        await asyncio.sleep(0.5)
+    finally:
+        proxy.terminate()
+        proxy.join()
+
+    stats = middle_proxy.stats
+    return {
+        'messages_per_s': options.clients * options.messages / elapsed,
+        'middle_proxy_connections': stats['connections'],
+        'sessions': len(stats['sessions']),
+        'closed_sessions': len(stats['closed']),
+        'ad_tags': sorted(stats['ad_tags']),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--messages', type=int, default=20)
+    parser.add_argument('--size', type=int, default=1024, help='bytes per message, a multiple of 4')
+    parser.add_argument('--connections', type=int, default=4, help='middle proxy connections per DC')
+    options = parser.parse_args()
+
+    setup_files_limit()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    result = loop.run_until_complete(benchmark(options))
+    print(', '.join('%s=%s' % (key, '%.2f' % value if isinstance(value, float) else value)
+                    for key, value in result.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""Middle proxy RPC framing check.
+
+Opens a :class:`mtproxy.proxy.middle_proxy.MiddleProxyConnection` to a
+:mod:`benchmarks.fake_middle_proxy` server and runs sessions of every proto tag, with
+and without an ad tag, over it. Messages of lengths covering every CBC padding are sent,
+with and without quick ack requests and unencrypted ones among them. The check asserts
+that the handshake completes, that every ``RPC_PROXY_REQ`` reaches the middle proxy with
+the expected flags, addresses, ad tag and payload, in sequence, that every
+``RPC_PROXY_ANS`` and ack is framed back to the client unchanged, and that closed
+sessions are reported. Exits with 1 if any step fails::
+
+    python -m benchmarks.middle_proxy_rpc
+"""
+import os
+import sys
+import socket
+import asyncio
+import argparse
+from mtproxy.mtproto import Keys
+from mtproxy.proxy import middle_proxy as rpc
+from .fake_middle_proxy import FakeMiddleProxy, SECRET
+from .dc_failover import Check
+
+AD_TAG = bytes.fromhex('0123456789abcdef0123456789abcdef')
+CLIENT = ('203.0.113.7', 4433)
+LENGTHS = (8, 12, 16, 20, 24, 28, 32, 504, 508, 1024)
+TIMEOUT = 5
+
+
+class RecordingMiddleProxy(FakeMiddleProxy):
+    """Fake middle proxy keeping the requests it answered and its frame stream"""
+
+    __slots__ = {'requests', 'stream'}
+
+    def __init__(self):
+        super().__init__()
+        self.requests = []
+        self.stream = None
+
+    def answer(self, stream, message: bytes):
+        self.requests.append(message)
+        self.stream = stream
+        super().answer(stream, message)
+
+
+class Client:
+    """Handshaked client stand-in, its streams are one end of a socket pair"""
+
+    __slots__ = {'proto_tag', 'ip', 'port', 'reader', 'writer'}
+
+    def __init__(self, proto_tag: bytes, reader, writer):
+        self.proto_tag = proto_tag
+        self.ip, self.port = CLIENT
+        self.reader = reader
+        self.writer = writer
+
+
+async def read_answer(reader, proto_tag: bytes) -> bytes:
+    """Read an answer as the client framing it"""
+    if proto_tag == Keys.PROTO_TAG_ABRIDGED:
+        length = (await reader.readexactly(1))[0]
+        if length == 0x7f:
+            length = int.from_bytes(await reader.readexactly(3), 'little')
+        return await reader.readexactly(length * 4)
+    length = int.from_bytes(await reader.readexactly(4), 'little')
+    message = await reader.readexactly(length)
+    if proto_tag == Keys.PROTO_TAG_SECURE:
+        message = message[:length - length % 4]
+    return message
+
+
+async def run_session(check: Check, middle_proxy: RecordingMiddleProxy, connection, proto_tag: bytes, ad_tag):
+    name = '%s%s' % (proto_tag.hex()[:2], ' ad_tag' if ad_tag else '')
+    ours, theirs = socket.socketpair()
+    _, writer = await asyncio.open_connection(sock=ours)
+    reader, peer = await asyncio.open_connection(sock=theirs)
+    session = rpc.MiddleProxySession(connection, Client(proto_tag, None, writer), ad_tag)
+    base = rpc.FLAG_MAGIC | rpc.FLAG_EXTMODE2 | rpc.PROTO_FLAGS[proto_tag] | (rpc.FLAG_HAS_AD_TAG if ad_tag else 0)
+    extra = b'\x18\x00\x00\x00' + rpc.PROXY_TAG + bytes((len(ad_tag),)) + ad_tag + bytes(3) if ad_tag else b''
+
+    try:
+        for i, length in enumerate(LENGTHS):
+            quickack = bool(i % 2)
+            # auth key id 0, an unencrypted message
+            message = bytes(8) + os.urandom(length - 8) if i == 2 else os.urandom(length)
+            session.send(message, quickack)
+
+            if quickack:
+                confirm = await asyncio.wait_for(reader.readexactly(4), TIMEOUT)
+                expected = message[:4][::-1] if proto_tag == Keys.PROTO_TAG_ABRIDGED else message[:4]
+                check('%s %d ack' % (name, length), confirm == expected)
+            answer = await asyncio.wait_for(read_answer(reader, proto_tag), TIMEOUT)
+            check('%s %d answer' % (name, length), answer == message)
+
+            request = middle_proxy.requests[-1]
+            flags = base | (rpc.FLAG_QUICKACK if quickack else 0) | (rpc.FLAG_NOT_ENCRYPTED if i == 2 else 0)
+            check('%s %d flags' % (name, length), request[4:8] == int.to_bytes(flags, 4, 'little'),
+                  '%#x' % int.from_bytes(request[4:8], 'little'))
+            check('%s %d header' % (name, length),
+                  request[8:56] == session.conn_id + rpc.ip_port_bytes(*CLIENT) + connection.our_ip_port
+                  and request[56:56 + len(extra)] == extra)
+            check('%s %d payload' % (name, length), request[56 + len(extra):] == message)
+    except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+        check('%s round trip' % name, False, repr(e))
+
+    session.close()
+    await asyncio.sleep(0.05)
+    check('%s close reported' % name, session.conn_id in middle_proxy.stats['closed'])
+    peer.transport.abort()
+
+
+async def run() -> int:
+    check = Check()
+    middle_proxy = RecordingMiddleProxy()
+    await middle_proxy.start()
+    loop = asyncio.get_event_loop()
+    connection = rpc.MiddleProxyConnection(SECRET)
+
+    try:
+        await loop.create_connection(lambda: connection, '127.0.0.1', middle_proxy.port)
+        await asyncio.wait_for(connection.ready, TIMEOUT)
+        check('handshake', middle_proxy.stats['connections'] == 1)
+
+        for proto_tag in (Keys.PROTO_TAG_ABRIDGED, Keys.PROTO_TAG_INTERMEDIATE, Keys.PROTO_TAG_SECURE):
+            for ad_tag in (None, AD_TAG):
+                await run_session(check, middle_proxy, connection, proto_tag, ad_tag)
+
+        check('ad tag seen', middle_proxy.stats['ad_tags'] == {AD_TAG.hex()})
+        stream = middle_proxy.stream
+        check('sequence numbers', not connection.closed and stream is not None
+              and (connection.write_seq, connection.read_seq) == (stream.read_seq, stream.write_seq),
+              (connection.write_seq, connection.read_seq))
+    except (OSError, asyncio.TimeoutError) as e:
+        check('handshake', False, repr(e))
+    finally:
+        connection.close()
+        middle_proxy.server.close()
+        await asyncio.sleep(0.05)
+    return check.failed
+
+
+def main():
+    argparse.ArgumentParser(description=__doc__.split('\n\n')[0]).parse_args()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    failed = loop.run_until_complete(run())
+    loop.close()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
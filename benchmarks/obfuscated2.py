@@ -0,0 +1,26 @@
+from mtproxy.mtproto import Keys
+
+
+def client_handshake(secret: bytes, proto_tag: bytes, dc_id: int = 2):
+    """Build an obfuscated2 client handshake as a Telegram client would
+
+    Args:
+        secret (``bytes``)
+            Proxy user secret.
+        proto_tag (``bytes``)
+            Transport proto tag.
+        dc_id (``int``, *optional*)
+            Requested Data Center.
+
+    Return:
+        ``tuple``: (handshake message, client encryptor, client decryptor)
+    """
+    rnd = bytearray(Keys.generator(proto_tag).rev_buf)
+    rnd[Keys.DC_IDX_POS:Keys.DC_IDX_POS + Keys.DC_IDX_LEN] = dc_id.to_bytes(Keys.DC_IDX_LEN, 'little', signed=True)
+    sample = Keys(bytes(rnd)[::-1])
+
+    encryptor = sample.generate_encryptor(secret)
+    message = sample.rev_buf[:Keys.PROTO_TAG_POS] + encryptor.encrypt(sample.rev_buf)[Keys.PROTO_TAG_POS:]
+    decryptor = Keys(message).generate_encryptor(secret)
+
+    return message, encryptor, decryptor
@@ -0,0 +1,142 @@
+"""Connection timeouts benchmark.
+
+Arms ``--connections`` timeouts the way a handshake deadline is kept, with a task per
+connection awaiting ``asyncio.wait_for``, with a bare ``loop.call_later`` handle and
+with the shared :class:`mtproxy.proxy.timing_wheel.TimingWheel`. For each, prints the
+time to arm and to cancel them all, the memory held per armed timeout and the time
+past the deadline for all of them to expire::
+
+    python -m benchmarks.timers --connections 100000
+"""
+import time
+import asyncio
+import argparse
+import tracemalloc
+from mtproxy.proxy.timing_wheel import TimingWheel
+
+
+class WaitFor:
+    """A task per timeout awaiting an operation, a never ending future, with ``wait_for``"""
+
+    def __init__(self):
+        self.operations = []
+        self.tasks = []
+
+    async def arm(self, count: int, timeout: float, callback):
+        loop = asyncio.get_event_loop()
+
+        async def guarded(operation):
+            try:
+                await asyncio.wait_for(operation, timeout)
+            except asyncio.TimeoutError:
+                callback()
+
+        for _ in range(count):
+            operation = loop.create_future()
+            self.operations.append(operation)
+            self.tasks.append(asyncio.ensure_future(guarded(operation)))
+        # the timeouts are set once the tasks ran
+        await asyncio.sleep(0)
+
+    async def cancel(self):
+        for operation in self.operations:
+            operation.set_result(None)
+        await asyncio.gather(*self.tasks)
+        self.operations, self.tasks = [], []
+
+
+class CallLater:
+    """A loop timer handle per timeout"""
+
+    def __init__(self):
+        self.handles = []
+
+    async def arm(self, count: int, timeout: float, callback):
+        loop = asyncio.get_event_loop()
+        self.handles = [loop.call_later(timeout, callback) for _ in range(count)]
+
+    async def cancel(self):
+        for handle in self.handles:
+            handle.cancel()
+        self.handles = []
+        # cancelled handles leave the heap as the loop runs
+        await asyncio.sleep(0)
+
+
+class Wheel:
+    """A :class:`TimingWheel` timer per timeout"""
+
+    def __init__(self):
+        self.wheel = TimingWheel()
+        self.wheel.start()
+        self.timers = []
+
+    async def arm(self, count: int, timeout: float, callback):
+        arm = self.wheel.arm
+        self.timers = [arm(timeout, callback) for _ in range(count)]
+
+    async def cancel(self):
+        for timer in self.timers:
+            timer.cancel()
+        self.timers = []
+
+
+async def measure(kind, count: int, timeout: float) -> dict:
+    loop = asyncio.get_event_loop()
+    timers = kind()
+
+    started = time.perf_counter()
+    await timers.arm(count, 3600, lambda: None)
+    armed = time.perf_counter() - started
+    started = time.perf_counter()
+    await timers.cancel()
+    cancelled = time.perf_counter() - started
+
+    # traced apart, tracing slows allocations down
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    await timers.arm(count, 3600, lambda: None)
+    memory = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    await timers.cancel()
+
+    fired = 0
+    done = loop.create_future()
+
+    def expired():
+        nonlocal fired
+        fired += 1
+        if fired == count:
+            done.set_result(loop.time())
+
+    await timers.arm(count, timeout, expired)
+    deadline = loop.time() + timeout
+    late = await done - deadline
+    if isinstance(timers, Wheel):
+        timers.wheel.close()
+
+    return {
+        'arm_us': armed / count * 1e6,
+        'cancel_us': cancelled / count * 1e6,
+        'bytes': memory / count,
+        'expire_late_ms': late * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--connections', type=int, default=100000)
+    parser.add_argument('--timeout', type=float, default=1.0, help='seconds to the expiry run deadline')
+    options = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    print('%-12s %10s %10s %10s %16s' % ('timers', 'arm us', 'cancel us', 'bytes', 'expire late ms'))
+    for name, kind in (('wait_for', WaitFor), ('call_later', CallLater), ('wheel', Wheel)):
+        result = loop.run_until_complete(measure(kind, options.connections, options.timeout))
+        print('%-12s %10.2f %10.2f %10.0f %16.1f' % (name, result['arm_us'], result['cancel_us'], result['bytes'],
+                                                      result['expire_late_ms']))
+
+
+if __name__ == '__main__':
+    main()
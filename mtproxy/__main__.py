@@ -1,20 +1,36 @@
 import sys
+import argparse
 from .utils import setup_files_limit
 from .proxy import MTProxy
 
 
+def parse_args(args: list):
+    parser = argparse.ArgumentParser(prog='mtproxy', description='Async Python MTProto Proxy')
+    parser.add_argument('config_file', nargs='?', help='proxy config file')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes sharing the port, 1 by default')
+    return parser.parse_args(args)
+
+
 def main(args: list=sys.argv[1:]):
     """The main routine."""
+    options = parse_args(args if args is not None else [])
     setup_files_limit()
 
     proxy = MTProxy()
 
-    if args is not None and len(args) >= 1:
-        config_file = args[0]
-        proxy.load_from_file(config_file)
+    if options.config_file:
+        proxy.load_from_file(options.config_file)
+
+    if options.workers > 1:
+        proxy.setup_ip_info()
+        proxy.show_data()
+        proxy.run_workers(options.workers)
+        return
 
-    proxy.show_data()
     proxy.start()
+    # links show the external addresses, looked up once listening
+    proxy.ip_discovery.add_done_callback(lambda discovery: discovery.cancelled() or proxy.show_data())
     proxy.run_until_disconnected()
 
 
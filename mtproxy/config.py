@@ -3,8 +3,21 @@
 class Config:
     """MTProto Proxy Config.
     """
-    users = []
     n = 0
+    handshake_engine = None
+    dc_pool = None
+    dc_router = None
+    metrics = None
+    accounting = None
+    shaper = None
+    admission = None
+    tarpit = None
+    budget = None
+    tcp_info = None
+    timers = None
+    middle_proxy_pool = None
+    worker_id = 0
+    workers = 1
     def __init__(self,
                  port=None,
                  fast_mode=None,
@@ -15,13 +28,65 @@ class Config:
                  client_handshake_timeout=None,
                  client_keepalive=None,
                  client_ack_timeout=None,
+                 client_idle_timeout=None,
+                 server_idle_timeout=None,
                  server_connect_timeout=None,
                  to_client_buffer_size=None,
                  to_server_buffer_size=None,
+                 min_buffer_size=None,
+                 to_client_high_watermark=None,
+                 to_client_low_watermark=None,
+                 to_server_high_watermark=None,
+                 to_server_low_watermark=None,
+                 tcp_nodelay=None,
+                 tcp_notsent_lowat=None,
+                 write_coalesce_window=None,
                  block_mode=None,
                  reply_check_length=None,
+                 reply_check_fp_rate=None,
+                 reply_check_file=None,
+                 relay_engine=None,
+                 splice=None,
+                 dc_pool_size=None,
+                 dc_pool_idle_timeout=None,
+                 dc_probe_interval=None,
+                 datacenters=None,
+                 metrics_port=None,
+                 metrics_addr=None,
+                 user_stats_file=None,
+                 rate_limit=None,
+                 crypto_backend=None,
+                 log_level=None,
+                 log_json=None,
+                 log_rate=None,
+                 log_sample=None,
+                 handoff_socket=None,
+                 drain_timeout=None,
+                 max_connections=None,
+                 max_connections_per_ip=None,
+                 ip_connect_rate=None,
+                 ip_prefix_v4=None,
+                 ip_prefix_v6=None,
+                 tarpit_max_connections=None,
+                 tarpit_hold_time=None,
+                 fail_cache_ttl=None,
+                 memory_budget=None,
+                 write_stall_timeout=None,
+                 tcp_info_interval=None,
+                 tcp_info_sample=None,
+                 middle_proxy=None,
+                 middle_proxy_connections=None,
+                 middle_proxy_secret=None,
+                 middle_proxies=None,
+                 ad_tag=None,
                  ipv4=None,
-                 ipv6=None):
+                 ipv6=None,
+                 ip_discovery=None,
+                 ipv4_url=None,
+                 ipv6_url=None,
+                 ip_cache_file=None,
+                 ip_cache_ttl=None,
+                 users=None):
         self.port = port
         self.fast_mode = fast_mode
         self.prefer_ipv6 = prefer_ipv6
@@ -31,10 +96,62 @@ class Config:
         self.client_handshake_timeout = client_handshake_timeout
         self.client_keepalive = client_keepalive
         self.client_ack_timeout = client_ack_timeout
+        self.client_idle_timeout = client_idle_timeout
+        self.server_idle_timeout = server_idle_timeout
         self.server_connect_timeout = server_connect_timeout
         self.to_client_buffer_size = to_client_buffer_size
         self.to_server_buffer_size = to_server_buffer_size
+        self.min_buffer_size = min_buffer_size
+        self.to_client_high_watermark = to_client_high_watermark
+        self.to_client_low_watermark = to_client_low_watermark
+        self.to_server_high_watermark = to_server_high_watermark
+        self.to_server_low_watermark = to_server_low_watermark
+        self.tcp_nodelay = tcp_nodelay
+        self.tcp_notsent_lowat = tcp_notsent_lowat
+        self.write_coalesce_window = write_coalesce_window
         self.block_mode = block_mode
         self.reply_check_length = reply_check_length
+        self.reply_check_fp_rate = reply_check_fp_rate
+        self.reply_check_file = reply_check_file
+        self.relay_engine = relay_engine
+        self.splice = splice
+        self.dc_pool_size = dc_pool_size
+        self.dc_pool_idle_timeout = dc_pool_idle_timeout
+        self.dc_probe_interval = dc_probe_interval
+        self.datacenters = datacenters
+        self.metrics_port = metrics_port
+        self.metrics_addr = metrics_addr
+        self.user_stats_file = user_stats_file
+        self.rate_limit = rate_limit
+        self.crypto_backend = crypto_backend
+        self.log_level = log_level
+        self.log_json = log_json
+        self.log_rate = log_rate
+        self.log_sample = log_sample
+        self.handoff_socket = handoff_socket
+        self.drain_timeout = drain_timeout
+        self.max_connections = max_connections
+        self.max_connections_per_ip = max_connections_per_ip
+        self.ip_connect_rate = ip_connect_rate
+        self.ip_prefix_v4 = ip_prefix_v4
+        self.ip_prefix_v6 = ip_prefix_v6
+        self.tarpit_max_connections = tarpit_max_connections
+        self.tarpit_hold_time = tarpit_hold_time
+        self.fail_cache_ttl = fail_cache_ttl
+        self.memory_budget = memory_budget
+        self.write_stall_timeout = write_stall_timeout
+        self.tcp_info_interval = tcp_info_interval
+        self.tcp_info_sample = tcp_info_sample
+        self.middle_proxy = middle_proxy
+        self.middle_proxy_connections = middle_proxy_connections
+        self.middle_proxy_secret = middle_proxy_secret
+        self.middle_proxies = middle_proxies
+        self.ad_tag = ad_tag
         self.ipv4 = ipv4
         self.ipv6 = ipv6
+        self.ip_discovery = ip_discovery
+        self.ipv4_url = ipv4_url
+        self.ipv6_url = ipv6_url
+        self.ip_cache_file = ip_cache_file
+        self.ip_cache_ttl = ip_cache_ttl
+        self.users = list(users) if users else []
@@ -1,3 +1,5 @@
 from .data_center import DataCenter
-from .crypto import AES
+from .crypto import AES, AESCBC, IdentityCipher
 from .keys import Keys
+from .replay_cache import LocalReplayCache, ReplayCache
+from .handshake import HandshakeEngine
@@ -1,16 +1,46 @@
+import time
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
 
+try:
+    from Cryptodome.Cipher import AES as CryptodomeCipher
+except ImportError:
+    try:
+        from Crypto.Cipher import AES as CryptodomeCipher
+    except ImportError:
+        CryptodomeCipher = None
+
+try:
+    import tgcrypto
+except ImportError:
+    tgcrypto = None
+
 
 class AES:
-    """Core Crypto class by cryptography cipher
+    """AES-256-CTR keystream of one direction, base class of the crypto backends.
+
+    CTR encryption and decryption are the same operation, an instance is used either
+    to encrypt or to decrypt one stream. Instances are made with :meth:`create_aes_ctr`
+    by the selected backend, see :meth:`select` and :meth:`calibrate`.
 
     Args:
-        cipher (:class:`cryptography.hazmat.primitives.ciphers.Cipher`)
+        key (``bytes``)
+            Encryption/Decryption Core key
+        iv (``int``)
+            Encryption/Decryption Counter key
     """
-    def __init__(self, cipher: Cipher):
-        self.encryptor = cipher.encryptor()
-        self.decryptor = cipher.decryptor()
+
+    name = None
+    backend = None
+
+    __slots__ = ()
+
+    def __init__(self, key: bytes, iv: int):
+        raise NotImplementedError
+
+    @classmethod
+    def is_available(cls) -> bool:
+        raise NotImplementedError
 
     def encrypt(self, data: bytes) -> bytes:
         """Encryption method
@@ -22,7 +52,7 @@ class AES:
         Return:
             ``bytes``: encrypted data
         """
-        return self.encryptor.update(data)
+        raise NotImplementedError
 
     def decrypt(self, data: bytes) -> bytes:
         """Decryption method
@@ -34,11 +64,58 @@ class AES:
         Return:
             ``bytes``: decrypted data
         """
-        return self.decryptor.update(data)
+        return self.encrypt(data)
+
+    def encrypt_into(self, data, buf) -> int:
+        """In place encryption method
+
+        Args:
+            data (``bytes-like``)
+                data for encrypting
+            buf (``bytearray``)
+                output buffer, at least 15 bytes longer than data, may share data memory
+
+        Return:
+            ``int``: number of bytes written
+        """
+        encrypted = self.encrypt(data)
+        buf[:len(encrypted)] = encrypted
+        return len(encrypted)
+
+    def decrypt_into(self, data, buf) -> int:
+        """In place decryption method
+
+        Args:
+            data (``bytes-like``)
+                encrypted data
+            buf (``bytearray``)
+                output buffer, at least 15 bytes longer than data, may share data memory
+
+        Return:
+            ``int``: number of bytes written
+        """
+        return self.encrypt_into(data, buf)
+
+    @classmethod
+    def encrypt_block(cls, key: bytes, block: bytes) -> bytes:
+        """Encrypt a single block with AES in ECB mode, e.g. one CTR keystream block
+
+        Args:
+            key (``bytes``)
+                Encryption key
+            block (``bytes``)
+                16 bytes block
+        Return:
+            ``bytes``: encrypted block
+        """
+        if cls is AES:
+            return AES.get_backend().encrypt_block(key, block)
+        # the first CTR keystream block is the encrypted counter
+        return cls(key, int.from_bytes(block, 'big')).encrypt(bytes(16))
 
     @classmethod
     def create_aes_ctr(cls, key: bytes, iv: int) -> 'AES':
-        """Create AES algorithm CRT mode Crypto with cryptography library
+        """Create AES algorithm CRT mode Crypto with the selected backend
 
         Args:
             key (``bytes``)
@@ -48,5 +125,186 @@ class AES:
         Return:
             :class:`AES`: if key and iv be correct and suitable
         """
-        cipher = Cipher(algorithms.AES(key), modes.CTR(int.to_bytes(iv, 16, 'big')), default_backend())
-        return cls(cipher)
+        return cls.get_backend()(key, iv)
+
+    @staticmethod
+    def backends() -> list:
+        """Available backend classes"""
+        return [backend for backend in (CryptographyAES, CryptodomeAES, TgCryptoAES) if backend.is_available()]
+
+    @staticmethod
+    def get_backend():
+        if AES.backend is None:
+            AES.backend = CryptographyAES
+        return AES.backend
+
+    @staticmethod
+    def select(name: str = 'auto'):
+        """Select the backend by name, 'auto' to calibrate
+
+        Raises:
+            :class:`ValueError`: if the backend is unknown or not installed.
+        """
+        if name == 'auto':
+            AES.backend = AES.calibrate()[0][1]
+            return AES.backend
+        for backend in AES.backends():
+            if backend.name == name:
+                AES.backend = backend
+                return backend
+        raise ValueError("Crypto backend %s is not available" % name)
+
+    @staticmethod
+    def measure(backend, chunk_size: int, chunks: int = 64, keys: int = 256) -> tuple:
+        """Time a backend
+
+        Return:
+            ``tuple``: (seconds per key setup, seconds per in place chunk)
+        """
+        key, iv = bytes(range(32)), 1
+        started = time.perf_counter()
+        for _ in range(keys):
+            backend(key, iv)
+        setup = (time.perf_counter() - started) / keys
+
+        cipher = backend(key, iv)
+        buf = bytearray(chunk_size + 15)
+        data = memoryview(buf)[:chunk_size]
+        cipher.encrypt_into(data, buf)
+        started = time.perf_counter()
+        for _ in range(chunks):
+            cipher.encrypt_into(data, buf)
+        return setup, (time.perf_counter() - started) / chunks
+
+    @staticmethod
+    def calibrate(chunk_size: int = 16384, session_bytes: int = 2 ** 20) -> list:
+        """Rank the available backends by the time to set up four ciphers, as a session
+        does, and to relay ``session_bytes`` in ``chunk_size`` chunks
+
+        Return:
+            ``list``: (seconds, backend class) tuples, fastest first.
+        """
+        ranking = []
+        for backend in AES.backends():
+            setup, chunk = AES.measure(backend, chunk_size)
+            ranking.append((4 * setup + chunk * session_bytes / chunk_size, backend))
+        ranking.sort(key=lambda item: item[0])
+        return ranking
+
+
+class CryptographyAES(AES):
+    """AES-CTR with the ``cryptography`` library"""
+
+    name = 'cryptography'
+
+    __slots__ = {'context'}
+
+    def __init__(self, key: bytes, iv: int):
+        self.context = Cipher(algorithms.AES(key), modes.CTR(int.to_bytes(iv, 16, 'big')),
+                              default_backend()).encryptor()
+
+    @classmethod
+    def is_available(cls) -> bool:
+        return True
+
+    def encrypt(self, data: bytes) -> bytes:
+        return self.context.update(data)
+
+    def encrypt_into(self, data, buf) -> int:
+        return self.context.update_into(data, buf)
+
+    @classmethod
+    def encrypt_block(cls, key: bytes, block: bytes) -> bytes:
+        return Cipher(algorithms.AES(key), modes.ECB(), default_backend()).encryptor().update(block)
+
+
+class CryptodomeAES(AES):
+    """AES-CTR with the ``pycryptodome`` or ``pycryptodomex`` library"""
+
+    name = 'pycryptodome'
+
+    __slots__ = {'context'}
+
+    def __init__(self, key: bytes, iv: int):
+        self.context = CryptodomeCipher.new(key, CryptodomeCipher.MODE_CTR, nonce=b'',
+                                            initial_value=int.to_bytes(iv, 16, 'big'))
+
+    @classmethod
+    def is_available(cls) -> bool:
+        return CryptodomeCipher is not None
+
+    def encrypt(self, data: bytes) -> bytes:
+        return self.context.encrypt(data)
+
+    def encrypt_into(self, data, buf) -> int:
+        size = len(data)
+        self.context.encrypt(data, output=memoryview(buf)[:size])
+        return size
+
+    @classmethod
+    def encrypt_block(cls, key: bytes, block: bytes) -> bytes:
+        return CryptodomeCipher.new(key, CryptodomeCipher.MODE_ECB).encrypt(block)
+
+
+class TgCryptoAES(AES):
+    """AES-256-CTR with the ``tgcrypto`` library"""
+
+    name = 'tgcrypto'
+
+    __slots__ = {'key', 'iv', 'state'}
+
+    def __init__(self, key: bytes, iv: int):
+        self.key = key
+        self.iv = bytearray(int.to_bytes(iv, 16, 'big'))
+        self.state = bytearray(1)
+
+    @classmethod
+    def is_available(cls) -> bool:
+        return tgcrypto is not None
+
+    def encrypt(self, data: bytes) -> bytes:
+        return tgcrypto.ctr256_encrypt(data, self.key, self.iv, self.state)
+
+
+class AESCBC:
+    """AES-256-CBC of one direction of a middle proxy connection, with the ``cryptography`` library.
+
+    The chaining state is kept between calls, data must be a multiple of 16 bytes.
+
+    Args:
+        key (``bytes``)
+            Encryption/Decryption key
+        iv (``bytes``)
+            Initialization vector
+    """
+
+    __slots__ = {'encryptor', 'decryptor'}
+
+    def __init__(self, key: bytes, iv: bytes):
+        cipher = Cipher(algorithms.AES(key), modes.CBC(iv), default_backend())
+        self.encryptor = cipher.encryptor()
+        self.decryptor = cipher.decryptor()
+
+    def encrypt(self, data: bytes) -> bytes:
+        return self.encryptor.update(data)
+
+    def decrypt(self, data: bytes) -> bytes:
+        return self.decryptor.update(data)
+
+
+class IdentityCipher:
+    """Pass-through cipher replacing a released encryptor or decryptor."""
+
+    __slots__ = ()
+
+    def encrypt(self, data: bytes) -> bytes:
+        return data
+
+    decrypt = encrypt
+
+    def encrypt_into(self, data, buf) -> int:
+        if not (isinstance(data, memoryview) and data.obj is buf):
+            buf[:len(data)] = data
+        return len(data)
+
+    decrypt_into = encrypt_into
@@ -27,3 +27,20 @@ class DataCenter:
         "2001:67c:04e8:f004::a",
         "2001:b28:f23f:f005::a"
     ]
+
+    @classmethod
+    def endpoints(cls, ipv6: bool = True) -> dict:
+        """Candidate addresses of every Data Center
+
+        Args:
+            ipv6 (``bool``, *optional*)
+                if True, IPv6 addresses are included.
+
+        Return:
+            ``dict``: lists of (address, port) by DC number.
+        """
+        endpoints = {}
+        for addresses in (cls.IPV4, cls.IPV6) if ipv6 else (cls.IPV4,):
+            for idx, address in enumerate(addresses):
+                endpoints.setdefault(idx + 1, []).append((address, cls.PORT))
+        return endpoints
@@ -0,0 +1,106 @@
+import hashlib
+import collections
+from . import AES
+from .keys import Keys
+
+
+class HandshakeEngine:
+    """Finds the user secret a client handshake was made with.
+
+    Secrets are decoded once into an indexed table. A candidate secret is checked by
+    deriving its key and decrypting only the keystream block holding the proto tag,
+    full cipher objects are built by the caller for the matching secret only.
+    Candidates are tried in order: the secret the client IP used last time, recently
+    matched secrets, then the rest of the table.
+
+    Args:
+        users (``list``)
+            List of :class:`mtproxy.utils.User`.
+        secure_only (``bool``, *optional*)
+            if True, only the secure proto tag is accepted.
+        recent_size (``int``, *optional*)
+            Number of recently matched secrets tried first.
+        affinity_size (``int``, *optional*)
+            Number of client IPs to remember the secret of.
+    """
+
+    PROTO_TAGS = (Keys.PROTO_TAG_ABRIDGED, Keys.PROTO_TAG_INTERMEDIATE, Keys.PROTO_TAG_SECURE)
+
+    BLOCK_LEN = 16
+    TAG_BLOCK = Keys.PROTO_TAG_POS // BLOCK_LEN
+    TAG_OFFSET = Keys.PROTO_TAG_POS % BLOCK_LEN
+
+    __slots__ = {'users', 'secrets', 'secure_only', 'recent_size', 'affinity_size', '_recent', '_affinity'}
+
+    def __init__(self, users: list, secure_only: bool = False, recent_size: int = 64,
+                 affinity_size: int = 65536):
+        self.users = list(users)
+        self.secrets = [bytes.fromhex(user.secret) for user in self.users]
+        self.secure_only = secure_only
+        self.recent_size = recent_size
+        self.affinity_size = affinity_size
+        self._recent = collections.OrderedDict()
+        self._affinity = collections.OrderedDict()
+
+    def match(self, sample: Keys, ip: str = None):
+        """Find the user of a handshake
+
+        Args:
+            sample (:class:`mtproxy.mtproto.Keys`)
+                Client handshake.
+            ip (``str``, *optional*)
+                Client IP address.
+
+        Return:
+            ``tuple``: (user, secret, proto_tag) of the matching user or ``None``.
+        """
+        dec_key = sample.dec_key_and_iv[:Keys.KEY_LEN]
+        counter = (int.from_bytes(sample.dec_iv, 'big') + HandshakeEngine.TAG_BLOCK) & ((1 << 128) - 1)
+        counter = counter.to_bytes(HandshakeEngine.BLOCK_LEN, 'big')
+        start = HandshakeEngine.TAG_BLOCK * HandshakeEngine.BLOCK_LEN + HandshakeEngine.TAG_OFFSET
+        tag = sample.buffer[start:start + Keys.PROTO_TAG_LEN]
+
+        for idx in self._candidates(ip):
+            secret = self.secrets[idx]
+            keystream = AES.encrypt_block(hashlib.sha256(dec_key + secret).digest(), counter)
+            keystream = keystream[HandshakeEngine.TAG_OFFSET:HandshakeEngine.TAG_OFFSET + Keys.PROTO_TAG_LEN]
+            proto_tag = bytes(a ^ b for a, b in zip(tag, keystream))
+
+            if proto_tag not in HandshakeEngine.PROTO_TAGS:
+                continue
+            if self.secure_only and proto_tag != Keys.PROTO_TAG_SECURE:
+                continue
+
+            self._hit(idx, ip)
+            return self.users[idx], secret, proto_tag
+
+        return None
+
+    def _candidates(self, ip: str):
+        tried = set()
+
+        idx = self._affinity.get(ip)
+        if idx is not None:
+            tried.add(idx)
+            yield idx
+
+        for idx in reversed(list(self._recent)):
+            if idx not in tried:
+                tried.add(idx)
+                yield idx
+
+        for idx in range(len(self.secrets)):
+            if idx not in tried:
+                yield idx
+
+    def _hit(self, idx: int, ip: str):
+        self._recent.pop(idx, None)
+        self._recent[idx] = None
+        if len(self._recent) > self.recent_size:
+            self._recent.popitem(last=False)
+
+        if ip is not None:
+            self._affinity.pop(ip, None)
+            self._affinity[ip] = idx
+            if len(self._affinity) > self.affinity_size:
+                self._affinity.popitem(last=False)
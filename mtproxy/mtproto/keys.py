@@ -1,14 +1,15 @@
 import os
 import hashlib
-import collections
 from . import AES
+from .replay_cache import LocalReplayCache
+from ..utils.log import log
 
 
 class Keys:
     """MTProto Handshake helper class
 
     Attributes:
-        used_dec_keys (:class:`collections.OrderedDict`)
+        used_dec_keys (:class:`LocalReplayCache` | :class:`ReplayCache`)
             collected handshakes.
         SAMPLE_LEN (``int``)
             Length of handshake message.
@@ -37,7 +38,7 @@ class Keys:
         data (``bytes``)
             64 or more charecters of a handshake message.
     """
-    used_dec_keys = collections.OrderedDict()
+    used_dec_keys = LocalReplayCache()
 
     SAMPLE_LEN = 64
     KEY_LEN = 32
@@ -71,9 +72,15 @@ class Keys:
         return self.dec_key_and_iv not in Keys.used_dec_keys
 
     async def add_key(self, max_len):
-        while len(Keys.used_dec_keys) >= max_len:
-            Keys.used_dec_keys.popitem(last=False)
-        Keys.used_dec_keys[self.dec_key_and_iv] = True
+        Keys.used_dec_keys.add(self.dec_key_and_iv, max_len)
+
+    def check_and_add_key(self, max_len) -> bool:
+        """Remember the key unless it was used, checked and added at once across workers
+
+        Return:
+            ``bool``: False if the key was used already.
+        """
+        return Keys.used_dec_keys.check_and_add(self.dec_key_and_iv, max_len)
 
     @property
     def dec_key(self):
@@ -129,7 +136,7 @@ class Keys:
         if proto_tag not in (
                 Keys.PROTO_TAG_ABRIDGED, Keys.PROTO_TAG_INTERMEDIATE, Keys.PROTO_TAG_SECURE
         ):
-            print('unresolved tag %s' % proto_tag)
+            log.debug('bad_proto_tag', "Unresolved tag %s", proto_tag)
             return False
 
         if secure and proto_tag != Keys.PROTO_TAG_SECURE:
@@ -0,0 +1,228 @@
+import os
+import mmap
+import math
+import struct
+import hashlib
+import tempfile
+import collections
+from ..utils.ext import FileLock
+
+
+class LocalReplayCache(collections.OrderedDict):
+    """In-process cache of used handshake keys, the oldest key is dropped first."""
+
+    def add(self, key: bytes, max_len: int):
+        while len(self) >= max_len:
+            self.popitem(last=False)
+        self[key] = True
+
+    def check_and_add(self, key: bytes, max_len: int) -> bool:
+        """Remember ``key`` if it is new
+
+        Return:
+            ``bool``: False if ``key`` was already remembered.
+        """
+        if key in self:
+            return False
+        self.add(key, max_len)
+        return True
+
+
+class ReplayCache:
+    """Fixed-memory cache of used handshake keys, shareable between processes.
+
+    Keys are reduced to short fingerprints sized for the wanted false positive rate and
+    kept in a ring buffer, the oldest one is overwritten first. An open-addressing index
+    (linear probing, backward-shift deletion) maps fingerprints to their ring slots.
+    Every entry stores its home index position, so lookups only match entries of the
+    same position and deletions don't need the original key.
+
+    The cache lives in shared memory created before forking, so worker processes see
+    the same keys. It is a memory-mapped file, anonymous unless ``path`` is set, then it
+    survives restarts and a file of another layout is replaced by a new one. Workers
+    take a record lock on the file around each access, the kernel drops it if one is
+    killed.
+
+    Args:
+        capacity (``int``)
+            Number of keys to remember.
+        fp_rate (``float``, *optional*)
+            Accepted false positive rate, 0 stores the whole keys.
+        path (``str``, *optional*)
+            Backing file path.
+    """
+
+    MAGIC = b'MTPRPL01'
+    HEADER = struct.Struct('<8sQQQQ16s')
+    KEY_LEN = 48
+    HOME_LEN = 4
+
+    __slots__ = {'capacity', 'fingerprint_len', 'entry_size', 'path', '_mm', '_ring_offset', '_index',
+                 '_mask', '_salt', '_lock'}
+
+    def __init__(self, capacity: int, fp_rate: float = 1e-9, path: str = None):
+        if capacity < 1:
+            raise ValueError("The replay cache capacity must be at least 1, got %r" % capacity)
+        self.capacity = capacity
+        self.fingerprint_len = ReplayCache.fingerprint_size(fp_rate)
+        self.entry_size = self.fingerprint_len + ReplayCache.HOME_LEN
+        self.path = path
+
+        table_size = 1
+        while table_size < capacity * 2:
+            table_size <<= 1
+        self._mask = table_size - 1
+
+        self._ring_offset = ReplayCache.HEADER.size
+        index_offset = self._ring_offset + capacity * self.entry_size
+        size = index_offset + table_size * 4
+
+        fd = None
+        if path is not None:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            if not self._matches(fd, size):
+                os.close(fd)
+                # never laid out again in place, a process still mapping the old file keeps it
+                fd = None
+        if fd is None:
+            fd = self._create(size)
+        try:
+            self._mm = mmap.mmap(fd, size)
+        except BaseException:
+            os.close(fd)
+            raise
+        # kept open for the cache lifetime, closing a descriptor of the file drops the lock
+        self._lock = FileLock(fd)
+
+        self._index = memoryview(self._mm)[index_offset:].cast('I')
+
+        magic, capacity, entry_size, _, _, salt = ReplayCache.HEADER.unpack_from(self._mm, 0)
+        if (magic, capacity, entry_size) == (ReplayCache.MAGIC, self.capacity, self.entry_size):
+            self._salt = salt
+        else:
+            self._salt = os.urandom(16)
+            self._set_head(0, 0)
+
+    @staticmethod
+    def fingerprint_size(fp_rate: float) -> int:
+        """Fingerprint length in bytes for a false positive rate, 0 keeps whole keys"""
+        if not fp_rate:
+            return ReplayCache.KEY_LEN
+        # the index is at most half full, so a lookup meets less than one entry of its home position
+        bits = math.log2(0.5 / fp_rate)
+        return min(max(math.ceil(bits / 8), 1), ReplayCache.KEY_LEN)
+
+    def __len__(self):
+        return ReplayCache.HEADER.unpack_from(self._mm, 0)[4]
+
+    def __contains__(self, key: bytes):
+        entry, home = self._digest(key)
+        with self._lock:
+            return self._find(entry, home) is not None
+
+    def add(self, key: bytes, max_len: int = None):
+        """Remember ``key``, ``max_len`` is ignored as the capacity is fixed at creation."""
+        self.check_and_add(key)
+
+    def check_and_add(self, key: bytes, max_len: int = None) -> bool:
+        """Remember ``key`` if it is new, in one step no other process can come in between
+
+        Return:
+            ``bool``: False if ``key`` was already remembered.
+        """
+        entry, home = self._digest(key)
+        with self._lock:
+            if self._find(entry, home) is not None:
+                return False
+            head, count = ReplayCache.HEADER.unpack_from(self._mm, 0)[3:5]
+            if count >= self.capacity:
+                self._unlink(head)
+            else:
+                count += 1
+            offset = self._ring_offset + head * self.entry_size
+            self._mm[offset:offset + self.entry_size] = entry
+            pos = home
+            while self._index[pos]:
+                pos = (pos + 1) & self._mask
+            self._index[pos] = head + 1
+            self._set_head((head + 1) % self.capacity, count)
+        return True
+
+    def flush(self):
+        """Write the backing file to disk"""
+        if self.path is not None:
+            self._mm.flush()
+
+    def _matches(self, fd: int, size: int) -> bool:
+        """Whether a file has this cache layout"""
+        if os.fstat(fd).st_size != size:
+            return False
+        magic, capacity, entry_size = ReplayCache.HEADER.unpack(os.pread(fd, ReplayCache.HEADER.size, 0))[:3]
+        return (magic, capacity, entry_size) == (ReplayCache.MAGIC, self.capacity, self.entry_size)
+
+    def _create(self, size: int) -> int:
+        """Descriptor of a new zeroed file, renamed over ``path`` if set"""
+        if self.path is not None:
+            temp = '%s.%d' % (self.path, os.getpid())
+            fd = os.open(temp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        elif hasattr(os, 'memfd_create'):
+            fd = os.memfd_create('mtproxy-replay-cache')
+        else:
+            fd, temp = tempfile.mkstemp(prefix='mtproxy-replay-cache.')
+            os.unlink(temp)
+        try:
+            os.ftruncate(fd, size)
+            if self.path is not None:
+                os.replace(temp, self.path)
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+    def _set_head(self, head: int, count: int):
+        ReplayCache.HEADER.pack_into(self._mm, 0, ReplayCache.MAGIC, self.capacity, self.entry_size,
+                                     head, count, self._salt)
+
+    def _digest(self, key: bytes):
+        digest = hashlib.blake2b(key[:ReplayCache.KEY_LEN], key=self._salt).digest()
+        home = int.from_bytes(digest[:8], 'little') & self._mask
+        if self.fingerprint_len == ReplayCache.KEY_LEN:
+            fingerprint = key[:ReplayCache.KEY_LEN]
+        else:
+            fingerprint = digest[8:8 + self.fingerprint_len]
+        return fingerprint + home.to_bytes(ReplayCache.HOME_LEN, 'little'), home
+
+    def _entry(self, slot: int) -> bytes:
+        offset = self._ring_offset + slot * self.entry_size
+        return self._mm[offset:offset + self.entry_size]
+
+    def _home(self, slot: int) -> int:
+        offset = self._ring_offset + (slot + 1) * self.entry_size
+        return int.from_bytes(self._mm[offset - ReplayCache.HOME_LEN:offset], 'little')
+
+    def _find(self, entry: bytes, home: int):
+        pos = home
+        while True:
+            slot = self._index[pos]
+            if not slot:
+                return None
+            if self._entry(slot - 1) == entry:
+                return pos
+            pos = (pos + 1) & self._mask
+
+    def _unlink(self, slot: int):
+        pos = self._find(self._entry(slot), self._home(slot))
+        if pos is None:
+            return
+        index, mask = self._index, self._mask
+        nxt = pos
+        while True:
+            nxt = (nxt + 1) & mask
+            if not index[nxt]:
+                break
+            home = self._home(index[nxt] - 1)
+            # move the entry back unless its home lies cyclically in (pos, nxt]
+            if (nxt - home) & mask >= (nxt - pos) & mask:
+                index[pos] = index[nxt]
+                pos = nxt
+        index[pos] = 0
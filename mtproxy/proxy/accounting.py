@@ -0,0 +1,293 @@
+import os
+import mmap
+import struct
+from ..utils import log
+from ..utils.ext import FileLock
+
+
+class MappedCounter:
+    """:class:`mtproxy.proxy.metrics.Counter` compatible view of a mapped counter."""
+
+    __slots__ = {'_view', '_index'}
+
+    def __init__(self, view: memoryview, index: int):
+        self._view = view
+        self._index = index
+
+    @property
+    def value(self) -> int:
+        return self._view[self._index]
+
+    @value.setter
+    def value(self, value: int):
+        self._view[self._index] = value
+
+
+class UserUsage:
+    """Counters of one user in one segment."""
+
+    __slots__ = {'connections', 'active', 'bytes_up', 'bytes_down'}
+
+    def __init__(self, view: memoryview, base: int):
+        for offset, field in enumerate(UserAccounting.FIELDS):
+            setattr(self, field, MappedCounter(view, base + offset))
+
+
+class UserAccounting:
+    """Per user usage counters in a memory-mapped file.
+
+    The file has a fixed layout, so external tools can read it without asking the
+    proxy: a header (magic, segments, slots, name size), a table of ``slots`` user names
+    and counter segments, holding ``FIELDS`` as native unsigned 64-bit integers for
+    every name slot. Each process claims a segment of its own with :meth:`claim`, under a
+    record lock held while it runs, and is the only one writing it: a handoff successor
+    doesn't count in the segment of the process it takes over from. The usage of a user
+    is the sum over segments.
+
+    Counters survive restarts, active sessions of a claimed segment are reset. Each
+    process holds a shared record lock on the file while it runs. A file of another layout
+    is migrated, keeping the totals, into a new file renamed over it, only once no other
+    process holds it: during a handoff or a worker restart the layout is kept, mappings
+    stay valid. Users missing from the name table get a free slot on first use, under an
+    exclusive record lock, which is held per process so it excludes workers forked with
+    the file open.
+
+    Args:
+        path (``str``)
+            Counter file path.
+        users (``list``)
+            :class:`mtproxy.utils.User` list to reserve slots for.
+        workers (``int``, *optional*)
+            Number of worker processes, twice as many segments are laid out so a handoff
+            successor finds free ones.
+    """
+
+    MAGIC = b'MTPUSR01'
+    HEADER = struct.Struct('<8sQQQ')
+    NAME_SIZE = 64
+    MIN_SLOTS = 64
+    FIELDS = ('connections', 'active', 'bytes_up', 'bytes_down')
+    # record lock byte ranges, independent of the contents
+    NAMES_LOCK = (0, 1)
+    HOLDERS_LOCK = (1, 1)
+    SEGMENT_LOCKS = 2
+
+    __slots__ = {'path', 'segments', 'slots', 'segment', '_fd', '_mm', '_counters', '_slot_of', '_usages'}
+
+    def __init__(self, path: str, users: list, workers: int = 1):
+        self.path = path
+        self.segment = None
+        self._slot_of = {}
+        self._usages = {}
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._locked().acquire()
+        # the file may have been replaced while waiting for the lock
+        while os.fstat(self._fd).st_ino != os.stat(path).st_ino:
+            os.close(self._fd)
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            self._locked().acquire()
+
+        try:
+            # taken for the process lifetime, a file held by another process keeps its layout
+            holders = FileLock(self._fd, *UserAccounting.HOLDERS_LOCK)
+            alone = holders.acquire(blocking=False)
+            holders.acquire(shared=True)
+
+            # closing another descriptor of the file would drop the locks
+            data = os.pread(self._fd, os.fstat(self._fd).st_size, 0)
+            previous = UserAccounting.parse(data)
+            names = set(previous or ()) | {user.name for user in users}
+            slots = UserAccounting.MIN_SLOTS
+            while slots < len(names):
+                slots <<= 1
+
+            segments = workers * 2
+            compatible = False
+            if previous is not None:
+                magic, old_segments, old_slots, name_size = UserAccounting.HEADER.unpack_from(data, 0)
+                compatible = name_size == UserAccounting.NAME_SIZE
+                if compatible:
+                    segments = max(segments, old_segments)
+                    slots = max(slots, old_slots)
+                    if not alone:
+                        # users or processes without a free slot aren't counted until the others are gone
+                        segments, slots = old_segments, old_slots
+            self.segments = segments
+            self.slots = slots
+
+            if compatible and data[:UserAccounting.HEADER.size] == self._header():
+                self._map(len(data))
+                self._load_names()
+            else:
+                self._replace(previous)
+
+            for user in users:
+                if user.name not in self._slot_of:
+                    self._claim(user.name)
+        finally:
+            self._locked().release()
+
+    @classmethod
+    def read(cls, path: str):
+        """Sum the usage of every user over the segments of a counter file
+
+        Return:
+            ``dict``: counters by field name, by user name, None if the file has no valid layout.
+        """
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            return None
+        return cls.parse(data)
+
+    @classmethod
+    def parse(cls, data: bytes):
+        """Sum the usage of every user over the segments of counter file contents
+
+        Return:
+            ``dict``: counters by field name, by user name, None if the data has no valid layout.
+        """
+        if len(data) < cls.HEADER.size:
+            return None
+        magic, segments, slots, name_size = cls.HEADER.unpack_from(data, 0)
+        fields = len(cls.FIELDS)
+        names_offset = cls.HEADER.size
+        counters_offset = names_offset + slots * name_size
+        if magic != cls.MAGIC or len(data) != counters_offset + segments * slots * fields * 8:
+            return None
+
+        counters = memoryview(data)[counters_offset:].cast('Q')
+        usage = {}
+        for slot in range(slots):
+            name = data[names_offset + slot * name_size:names_offset + (slot + 1) * name_size].rstrip(b'\0')
+            if not name:
+                continue
+            totals = usage[name.decode(errors='ignore')] = dict.fromkeys(cls.FIELDS, 0)
+            for segment in range(segments):
+                base = (segment * slots + slot) * fields
+                for offset, field in enumerate(cls.FIELDS):
+                    totals[field] += counters[base + offset]
+        return usage
+
+    def claim(self) -> bool:
+        """Take a free counter segment for this process, its left over active sessions are reset
+
+        Return:
+            ``bool``: False if every segment is held by another process, nothing is counted then.
+        """
+        if self.segment is not None:
+            return True
+        # record locks aren't inherited by forked workers
+        FileLock(self._fd, *UserAccounting.HOLDERS_LOCK).acquire(shared=True)
+        for segment in range(self.segments):
+            if FileLock(self._fd, UserAccounting.SEGMENT_LOCKS + segment, 1).acquire(blocking=False):
+                break
+        else:
+            log.warning('accounting_full', "No free segment in %s, usage of this process isn't counted", self.path)
+            return False
+
+        self.segment = segment
+        self._usages.clear()
+        fields = len(UserAccounting.FIELDS)
+        active = UserAccounting.FIELDS.index('active')
+        for slot in range(self.slots):
+            self._counters[(segment * self.slots + slot) * fields + active] = 0
+        return True
+
+    def usage(self, name: str):
+        """Counters of a user in the claimed segment, None if there is no free slot left
+
+        Return:
+            :class:`UserUsage`
+        """
+        usage = self._usages.get(name)
+        if usage is None:
+            if self.segment is None:
+                return None
+            slot = self._slot_of.get(name)
+            if slot is None:
+                with self._locked():
+                    self._load_names()
+                    slot = self._slot_of.get(name)
+                    if slot is None:
+                        slot = self._claim(name)
+                if slot is None:
+                    return None
+            usage = self._usages[name] = UserUsage(self._counters,
+                                                   (self.segment * self.slots + slot) * len(UserAccounting.FIELDS))
+        return usage
+
+    def flush(self):
+        self._mm.flush()
+
+    def close(self):
+        self._usages.clear()
+        self._counters.release()
+        self._mm.close()
+        os.close(self._fd)
+
+    def _header(self) -> bytes:
+        return UserAccounting.HEADER.pack(UserAccounting.MAGIC, self.segments, self.slots, UserAccounting.NAME_SIZE)
+
+    def _offset(self, segment: int) -> int:
+        return (UserAccounting.HEADER.size + self.slots * UserAccounting.NAME_SIZE +
+                segment * self.slots * len(UserAccounting.FIELDS) * 8)
+
+    def _replace(self, previous):
+        """Lay a new file out and rename it over the old one, which processes still mapping it keep"""
+        temp = '%s.%d' % (self.path, os.getpid())
+        fd = os.open(temp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, self._offset(self.segments))
+            # other processes opening the new file wait until it is filled
+            FileLock(fd, *UserAccounting.NAMES_LOCK).acquire()
+            FileLock(fd, *UserAccounting.HOLDERS_LOCK).acquire(shared=True)
+            os.replace(temp, self.path)
+        except BaseException:
+            os.close(fd)
+            if os.path.exists(temp):
+                os.unlink(temp)
+            raise
+        os.close(self._fd)
+        self._fd = fd
+
+        self._map(self._offset(self.segments))
+        self._mm[:UserAccounting.HEADER.size] = self._header()
+        # migrated totals are kept in the first segment
+        for name, usage in (previous or {}).items():
+            slot = self._claim(name)
+            if slot is None:
+                continue
+            base = slot * len(UserAccounting.FIELDS)
+            for offset, field in enumerate(UserAccounting.FIELDS):
+                if field != 'active':
+                    self._counters[base + offset] = usage[field]
+
+    def _map(self, size: int):
+        self._mm = mmap.mmap(self._fd, size)
+        self._counters = memoryview(self._mm)[self._offset(0):].cast('Q')
+
+    def _name_range(self, slot: int) -> slice:
+        start = UserAccounting.HEADER.size + slot * UserAccounting.NAME_SIZE
+        return slice(start, start + UserAccounting.NAME_SIZE)
+
+    def _load_names(self):
+        for slot in range(self.slots):
+            name = self._mm[self._name_range(slot)].rstrip(b'\0')
+            if name:
+                self._slot_of[name.decode(errors='ignore')] = slot
+
+    def _claim(self, name: str):
+        encoded = name.encode()[:UserAccounting.NAME_SIZE]
+        used = set(self._slot_of.values())
+        for slot in range(self.slots):
+            if slot not in used and not self._mm[self._name_range(slot)].rstrip(b'\0'):
+                self._mm[self._name_range(slot)] = encoded.ljust(UserAccounting.NAME_SIZE, b'\0')
+                self._slot_of[name] = slot
+                return slot
+        return None
+
+    def _locked(self):
+        return FileLock(self._fd, *UserAccounting.NAMES_LOCK)
+
@@ -0,0 +1,129 @@
+import time
+import socket
+
+
+class Admission:
+    """Connection limits checked at accept time, before any handshake work.
+
+    Limits the total of open client connections, the open connections per source
+    address prefix and the new connections per second per prefix, a token bucket of
+    ``ip_rate`` tokens holding at most one second of them. Per prefix state is a small
+    list keyed by an int, entries without open connections are swept once their bucket
+    is full again.
+
+    State is per process. With several workers sharing the port, each one allows its
+    share of ``max_connections``, rounded up, which evens out over many connections.
+    The kernel hashes the whole address and port tuple, so the connections of one source
+    don't spread evenly: each worker applies the per prefix limits on its own.
+
+    Args:
+        max_connections (``int``)
+            Max open client connections of all workers, 0 for no limit.
+        max_per_ip (``int``)
+            Max open connections per source prefix in each worker, 0 for no limit.
+        ip_rate (``float``)
+            New connections per second per source prefix in each worker, 0 for no limit.
+        prefix_v4 (``int``, *optional*)
+            IPv4 source prefix length.
+        prefix_v6 (``int``, *optional*)
+            IPv6 source prefix length.
+        metrics (:class:`mtproxy.proxy.metrics.Metrics`, *optional*)
+            Rejections are counted in.
+        workers (``int``, *optional*)
+            Worker processes the limits are shared between.
+    """
+
+    SWEEP = 30
+
+    __slots__ = {'max_connections', 'max_per_ip', 'ip_rate', 'prefix_v4', 'prefix_v6', 'metrics', 'workers',
+                 'active', '_sources', '_swept'}
+
+    def __init__(self, max_connections: int, max_per_ip: int, ip_rate: float, prefix_v4: int = 32,
+                 prefix_v6: int = 64, metrics=None, workers: int = 1):
+        self.workers = max(1, workers)
+        self.update(max_connections, max_per_ip, ip_rate)
+        self.prefix_v4 = prefix_v4
+        self.prefix_v6 = prefix_v6
+        self.metrics = metrics
+        self.active = 0
+        # key: [open connections, tokens, last refill]
+        self._sources = {}
+        self._swept = time.monotonic()
+
+    @classmethod
+    def is_needed(cls, max_connections: int, max_per_ip: int, ip_rate: float) -> bool:
+        return bool(max_connections or max_per_ip or ip_rate)
+
+    def update(self, max_connections: int, max_per_ip: int, ip_rate: float):
+        """Apply new limits, open connections stay counted"""
+        # this worker share
+        self.max_connections = -(-max_connections // self.workers)
+        self.max_per_ip = max_per_ip
+        self.ip_rate = ip_rate
+
+    def key(self, ip: str) -> int:
+        """Source prefix of an address, IPv6 keys are above any IPv4 one"""
+        if ':' in ip:
+            if ip.startswith('::ffff:') and '.' in ip:
+                ip = ip[7:]
+            else:
+                address = int.from_bytes(socket.inet_pton(socket.AF_INET6, ip.partition('%')[0]), 'big')
+                return address >> (128 - self.prefix_v6) | 1 << 128
+        return int.from_bytes(socket.inet_aton(ip), 'big') >> (32 - self.prefix_v4)
+
+    def admit(self, ip: str) -> bool:
+        """Count a new connection from ``ip`` if it is within the limits
+
+        Return:
+            ``bool``: True if admitted, :meth:`release` it once closed.
+        """
+        if self.max_connections and self.active >= self.max_connections:
+            self._reject('rejected_max_connections')
+            return False
+
+        if self.max_per_ip or self.ip_rate:
+            now = time.monotonic()
+            if now - self._swept > Admission.SWEEP:
+                self._sweep(now)
+
+            key = self.key(ip)
+            burst = max(1.0, self.ip_rate)
+            source = self._sources.get(key)
+            if source is None:
+                source = self._sources[key] = [0, burst, now]
+
+            if self.max_per_ip and source[0] >= self.max_per_ip:
+                self._reject('rejected_per_ip')
+                return False
+
+            if self.ip_rate:
+                tokens = min(burst, source[1] + (now - source[2]) * self.ip_rate)
+                source[2] = now
+                if tokens < 1:
+                    source[1] = tokens
+                    self._reject('rejected_ip_rate')
+                    return False
+                source[1] = tokens - 1
+            source[0] += 1
+
+        self.active += 1
+        return True
+
+    def release(self, ip: str):
+        """Uncount a closed admitted connection"""
+        self.active -= 1
+        if self._sources:
+            source = self._sources.get(self.key(ip))
+            if source is not None and source[0]:
+                source[0] -= 1
+
+    def _reject(self, reason: str):
+        if self.metrics is not None:
+            getattr(self.metrics, reason).value += 1
+
+    def _sweep(self, now: float):
+        self._swept = now
+        burst = max(1.0, self.ip_rate)
+        for key in [key for key, (active, tokens, last) in self._sources.items()
+                    if not active and (not self.ip_rate or tokens + (now - last) * self.ip_rate >= burst)]:
+            del self._sources[key]
@@ -1,6 +1,8 @@
 import asyncio
-from .streams import ClientSteamProtocol, ServerStreamProtocol
+import functools
+from .streams import ClientSteamProtocol, ServerStreamProtocol, Relay
 from ..config import Config
+from ..utils import log
 
 
 class ConnectionHandler:
@@ -13,78 +15,238 @@ class ConnectionHandler:
         self.server = server
 
     @classmethod
-    async def create(cls, reader, writer, *, config: Config=None):
+    async def create(cls, reader, writer, *, config: Config=None, admitted: str=None):
         self = cls(config, ClientSteamProtocol(config, reader, writer))
+        metrics = config.metrics
+        metrics.connections_total.value += 1
+        metrics.connections_active.value += 1
+        outcome = None
         try:
-            await self.handle_initial_handshake()
+            outcome = await self.handle_initial_handshake()
         except (asyncio.IncompleteReadError, ConnectionResetError, TimeoutError):
             pass
         finally:
-            writer.transport.abort()
+            if isinstance(outcome, asyncio.Future):
+                # relayed from transport callbacks, the connection outlives this task
+                outcome.add_done_callback(functools.partial(ConnectionHandler.closed, config, admitted))
+            else:
+                ConnectionHandler.closed(config, admitted)
+                if not outcome:
+                    writer.transport.abort()
+
+    @staticmethod
+    def closed(config: Config, admitted: str = None, *_):
+        config.metrics.connections_active.value -= 1
+        if admitted is not None:
+            config.admission.release(admitted)
 
     async def handle_initial_handshake(self):
-        self.client.init_socket(True)
+        """Handshake the client and relay its session
+
+        Return:
+            ``bool``: True if the connection failed the handshake and is held by the tarpit, or
+            :class:`asyncio.Future` done once a session relayed from transport callbacks ends.
+        """
+        metrics = self.config.metrics
+        loop = asyncio.get_event_loop()
+        self.client.init_socket(True, (self.config.to_client_high_watermark, self.config.to_client_low_watermark))
+        started = loop.time()
+        timer = self.config.timers.arm(self.config.client_handshake_timeout, self.handshake_timed_out)
         try:
-            await asyncio.wait_for(
-                self.client.handle_handshake(), timeout=self.config.client_handshake_timeout
-            )
-        except asyncio.TimeoutError:
-            return
+            await self.client.handle_handshake()
+        finally:
+            timer.cancel()
 
         if not self.client.handshaked:
-            return
-
-        (dc_ip, dc_port) = await self.client.get_telegram_dc()
-        try:
-            await self.open_telegram_connection(dc_ip, dc_port)
-        except ConnectionRefusedError:
-            print("Got connection refused while trying to connect to", dc_ip, dc_port)
-            return
-        except (OSError, asyncio.TimeoutError):
-            print("Unable to connect to", dc_ip, dc_port)
-            return
-
-        if self.server is None:
-            return
-
-        self.server.init_socket()
-
-        await self.server.handle_handshake()
-
-        if not self.server.handshaked:
-            return
-
-        if self.config.fast_mode:
-            self.client.release_writer()
-            self.server.release_reader()
+            return self.config.tarpit.hold(self.client.writer.transport)
+        metrics.handshake_duration.observe(loop.time() - started)
+
+        to_server_counters, to_client_counters = (metrics.bytes_to_server,), (metrics.bytes_to_client,)
+        usage = None
+        if self.config.accounting is not None:
+            usage = self.config.accounting.usage(self.client.user.name)
+        if usage is not None:
+            usage.connections.value += 1
+            to_server_counters += (usage.bytes_up,)
+            to_client_counters += (usage.bytes_down,)
+        to_server_buckets, to_client_buckets = (), ()
+        if self.config.shaper is not None:
+            to_server_buckets, to_client_buckets = self.config.shaper.buckets(self.client.user)
+
+        if self.config.middle_proxy_pool is not None:
+            session = await self.open_middle_proxy_session(to_client_counters)
+            if session is None:
+                return
+            # answers are multiplexed on a shared connection, only client messages are shaped
+            idle = self.arm_idle_timers()
+            relay = session.relay(to_server_buckets, to_server_counters, *idle)
+        else:
+            dc = abs(self.client.dc_idx)
+            if not self.config.dc_router.has_dc(dc):
+                return
+            started = loop.time()
+            try:
+                await self.open_telegram_connection(dc)
+            except ConnectionRefusedError:
+                metrics.dc_connect_failures.value += 1
+                log.warning('dc_connect_failed', "Got connection refused while trying to connect to DC %d", dc)
+                return
+            except (OSError, asyncio.TimeoutError):
+                metrics.dc_connect_failures.value += 1
+                log.warning('dc_connect_failed', "Unable to connect to DC %d", dc)
+                return
+            metrics.dc_connect_time.observe(loop.time() - started)
+
+            if self.server is None:
+                return
+
+            self.server.init_socket(write_limits=(self.config.to_server_high_watermark,
+                                                  self.config.to_server_low_watermark))
+
+            await self.server.handle_handshake()
+
+            if not self.server.handshaked:
+                return
+
+            if self.config.fast_mode:
+                self.client.release_writer()
+                self.server.release_reader()
+            idle = self.arm_idle_timers()
+            if self.config.relay_engine == 'protocol':
+                relay = self.relay_protocols(to_server_counters, to_client_counters,
+                                             to_server_buckets, to_client_buckets, *idle)
+            else:
+                relay = self.relay_streams(self.config.n + 1, to_server_counters, to_client_counters,
+                                           to_server_buckets, to_client_buckets, *idle)
         self.config.n += 1
-        n = self.config.n
-        telegram_to_client = self.server.reply_stream(n,
+        if usage is not None:
+            usage.active.value += 1
+        budget = self.config.budget
+        transports = ()
+        if budget is not None:
+            transports = (self.client.writer.transport,)
+            if self.server is not None:
+                transports += (self.server.writer.transport,)
+            for transport in transports:
+                budget.track(transport)
+        sampled = ()
+        if self.config.tcp_info is not None:
+            sampled = self.config.tcp_info.track(self.client.dc_idx, self.client.writer.transport,
+                                                 self.server.writer.transport if self.server is not None else None)
+        # holds no reference to the handler, so a callback relayed session keeps no more than its relay
+        finished = functools.partial(ConnectionHandler.session_finished, self.config, loop.time(), usage, idle,
+                                     transports, sampled)
+        if isinstance(relay, asyncio.Future):
+            relay.add_done_callback(finished)
+            return relay
+        try:
+            await relay
+        finally:
+            finished()
+
+    @staticmethod
+    def session_finished(config: Config, started: float, usage, idle: tuple, transports: tuple, sampled: tuple,
+                         *_):
+        for timer in idle:
+            if timer is not None:
+                timer.cancel()
+        for transport in transports:
+            config.budget.untrack(transport)
+        if sampled:
+            config.tcp_info.untrack(sampled)
+        if usage is not None:
+            usage.active.value -= 1
+        config.metrics.session_lifetime.observe(asyncio.get_event_loop().time() - started)
+
+    async def relay_streams(self, n: int, to_server_counters: tuple = (), to_client_counters: tuple = (),
+                            to_server_buckets: tuple = (), to_client_buckets: tuple = (),
+                            to_server_idle=None, to_client_idle=None):
+        """Relay data with a reader task from Telegram, the client is read in the calling task"""
+        task_tg_to_clt = asyncio.ensure_future(self.server.reply_stream(n,
             self.client.writer,
             self.config.to_client_buffer_size,
-            self.config.block_mode
+            self.config.block_mode,
+            to_client_counters,
+            to_client_buckets,
+            to_client_idle
+        ))
+        # either direction ending ends the session, the client read is woken up by the abort
+        client_transport = self.client.writer.transport
+        task_tg_to_clt.add_done_callback(lambda task: client_transport.abort())
+        try:
+            await self.client.reply_stream(n,self.server.writer, self.config.to_server_buffer_size,
+                                           counters=to_server_counters, buckets=to_server_buckets,
+                                           idle=to_server_idle)
+        finally:
+            task_tg_to_clt.cancel()
+            self.server.writer.close()
+
+    def relay_protocols(self, to_server_counters: tuple = (), to_client_counters: tuple = (),
+                        to_server_buckets: tuple = (), to_client_buckets: tuple = (),
+                        to_server_idle=None, to_client_idle=None) -> asyncio.Future:
+        """Relay data from transport callbacks with :class:`Relay`
+
+        Return:
+            :class:`asyncio.Future`: done once both connections are lost.
+        """
+        relay = Relay(self.client, self.server, self.config.fast_mode, self.config.block_mode,
+                      to_server_counters, to_client_counters, to_server_buckets, to_client_buckets,
+                      to_server_idle, to_client_idle)
+        return relay.done
+
+    def handshake_timed_out(self):
+        self.config.metrics.handshake_timeout.value += 1
+        self.client.writer.transport.abort()
+
+    def arm_idle_timers(self) -> tuple:
+        """Idle timers of the session directions, None where disabled
+
+        Return:
+            ``tuple``: (client to Telegram timer, Telegram to client timer)
+        """
+        metrics = self.config.metrics
+        # timers are given the transports, the handler may be gone before they fire
+        transports = self.client.writer.transport, self.server.writer.transport if self.server is not None else None
+        return tuple(
+            self.config.timers.arm(timeout, ConnectionHandler.idle_timed_out, counter, self.client.ip, *transports)
+            if timeout else None
+            for timeout, counter in ((self.config.client_idle_timeout, metrics.idle_timeouts_to_server),
+                                     (self.config.server_idle_timeout, metrics.idle_timeouts_to_client))
         )
-        client_to_telegram = self.client.reply_stream(n,self.server.writer, self.config.to_server_buffer_size)
-
-        task_tg_to_clt = asyncio.ensure_future(telegram_to_client)
-        task_clt_to_tg = asyncio.ensure_future(client_to_telegram)
-
-        await asyncio.wait([task_tg_to_clt, task_clt_to_tg], return_when=asyncio.FIRST_COMPLETED)
 
-        task_tg_to_clt.cancel()
-        task_clt_to_tg.cancel()
-
-        self.server.writer.close()
-
-    async def open_telegram_connection(self, address: str, port: int, max_attempts: int=3):
-
-        for _ in range(max_attempts):
-            try:
-                task = asyncio.open_connection(address, port, limit=self.config.to_client_buffer_size)
-                reader, writer = await asyncio.wait_for(task, timeout=self.config.server_connect_timeout)
-                self.server = ServerStreamProtocol(
-                    self.config, reader, writer, self.client.proto_tag, self.client.key
-                )
-            except (OSError, asyncio.TimeoutError) as E:
-                if _ >= max_attempts:
-                    raise E
+    @staticmethod
+    def idle_timed_out(counter, ip: str, client_transport, server_transport=None):
+        # both directions may time out in a tick
+        if client_transport.is_closing():
+            return
+        counter.value += 1
+        log.debug('idle_timeout', "Closing a session idle from %s", ip)
+        client_transport.abort()
+        if server_transport is not None:
+            server_transport.abort()
+
+    async def open_middle_proxy_session(self, to_client_counters: tuple = ()):
+        """Start a session on a middle proxy connection of the client DC, None if it failed"""
+        metrics = self.config.metrics
+        dc = self.client.dc_idx
+        if not self.config.middle_proxy_pool.has_dc(dc):
+            return None
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        try:
+            session = await self.config.middle_proxy_pool.session(dc, self.client, to_client_counters)
+        except (OSError, asyncio.TimeoutError) as e:
+            metrics.dc_connect_failures.value += 1
+            log.warning('dc_connect_failed', "Unable to connect to a middle proxy of DC %d: %s", dc, e)
+            return None
+        metrics.dc_connect_time.observe(loop.time() - started)
+        return session
+
+    async def open_telegram_connection(self, dc: int):
+        if self.config.dc_pool is not None:
+            reader, writer = await self.config.dc_pool.acquire(dc)
+        else:
+            reader, writer = await self.config.dc_router.connect(dc)
+        self.server = ServerStreamProtocol(
+            self.config, reader, writer, self.client.proto_tag, self.client.key
+        )
@@ -0,0 +1,151 @@
+import math
+import asyncio
+import collections
+from ..config import Config
+from ..mtproto import Keys
+from ..utils import log
+
+
+class TelegramConnectionPool:
+    """Pool of idle, already connected Telegram Data Center connections.
+
+    Connections are kept per DC and opened with ``connect``. Every ``REFILL_INTERVAL``
+    seconds the pool estimates each DC's connection rate, drops expired and closed
+    connections and opens new ones in the background, to hold about as many idle
+    connections as are taken in two intervals, up to ``max_size``.
+
+    Outside fast mode it also keeps a batch of pre-generated obfuscated2 handshakes per
+    proto tag, as they don't depend on the client.
+
+    Args:
+        config (:class:`mtproxy.config.Config`)
+            Proxy config.
+        connect (``callable``)
+            Coroutine function opening a connection to a DC number.
+        max_size (``int``)
+            Max number of idle connections per DC.
+        idle_timeout (``int``)
+            Idle connections are closed after this number of seconds.
+        header_batch (``int``, *optional*)
+            Number of pre-generated handshakes kept per proto tag.
+    """
+
+    REFILL_INTERVAL = 1
+    RATE_SMOOTHING = 0.3
+    PROTO_TAGS = (Keys.PROTO_TAG_ABRIDGED, Keys.PROTO_TAG_INTERMEDIATE, Keys.PROTO_TAG_SECURE)
+
+    __slots__ = {'config', 'connect', 'max_size', 'idle_timeout', 'header_batch', '_idle', '_taken', '_rates',
+                 '_connecting', '_headers', '_task', '_refills'}
+
+    def __init__(self, config: Config, connect, max_size: int, idle_timeout: int, header_batch: int = 64):
+        self.config = config
+        self.connect = connect
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.header_batch = header_batch
+        self._idle = collections.defaultdict(collections.deque)
+        self._taken = collections.Counter()
+        self._rates = {}
+        self._connecting = collections.Counter()
+        self._headers = {proto_tag: collections.deque() for proto_tag in self.PROTO_TAGS}
+        self._task = None
+        self._refills = set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._maintain())
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for task in self._refills:
+            task.cancel()
+        self._refills.clear()
+        for connections in self._idle.values():
+            for _, writer, _ in connections:
+                writer.transport.abort()
+        self._idle.clear()
+
+    async def acquire(self, dc: int):
+        """Take an idle connection to a DC or open a new one
+
+        Return:
+            ``tuple``: (:class:`asyncio.StreamReader`, :class:`asyncio.StreamWriter`)
+        """
+        self._taken[dc] += 1
+
+        connections = self._idle.get(dc)
+        loop_time = asyncio.get_event_loop().time()
+        while connections:
+            reader, writer, created = connections.pop()
+            if self._is_usable(reader, writer, created, loop_time):
+                return reader, writer
+            writer.transport.abort()
+
+        return await self.connect(dc)
+
+    def take_header(self, proto_tag: bytes) -> Keys:
+        """Take a pre-generated handshake, generates one if none is left"""
+        headers = self._headers.get(proto_tag)
+        if headers:
+            return headers.pop()
+        return Keys.generator(proto_tag)
+
+    def _is_usable(self, reader, writer, created: float, loop_time: float) -> bool:
+        return (loop_time - created < self.idle_timeout and
+                not writer.transport.is_closing() and
+                not reader.at_eof())
+
+    async def _maintain(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(TelegramConnectionPool.REFILL_INTERVAL)
+            now = loop.time()
+
+            for key in set(self._idle) | set(self._taken):
+                rate = self._rates.get(key, 0.0)
+                rate += (self._taken.pop(key, 0) / TelegramConnectionPool.REFILL_INTERVAL - rate) * \
+                    TelegramConnectionPool.RATE_SMOOTHING
+                self._rates[key] = rate
+
+                connections = self._idle[key]
+                for connection in [c for c in connections if not self._is_usable(*c, now)]:
+                    connections.remove(connection)
+                    connection[1].transport.abort()
+
+                target = min(self.max_size, math.ceil(rate * TelegramConnectionPool.REFILL_INTERVAL * 2))
+                while len(connections) > target:
+                    connections.popleft()[1].transport.abort()
+                for _ in range(target - len(connections) - self._connecting[key]):
+                    task = asyncio.ensure_future(self._refill(key))
+                    self._refills.add(task)
+                    task.add_done_callback(self._refilled)
+
+                if not connections and rate < 0.01:
+                    del self._idle[key]
+                    del self._rates[key]
+
+            if not self.config.fast_mode:
+                for proto_tag, headers in self._headers.items():
+                    while len(headers) < self.header_batch:
+                        headers.append(Keys.generator(proto_tag))
+
+    async def _refill(self, key: int):
+        self._connecting[key] += 1
+        try:
+            reader, writer = await self.connect(key)
+        except (OSError, asyncio.TimeoutError):
+            return
+        finally:
+            self._connecting[key] -= 1
+        if self._task is None:
+            # the pool was closed while connecting
+            writer.transport.abort()
+            return
+        self._idle[key].append((reader, writer, asyncio.get_event_loop().time()))
+
+    def _refilled(self, task):
+        self._refills.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log.warning('dc_pool_refill_failed', "Failed to open a pooled DC connection: %r", task.exception())
@@ -0,0 +1,236 @@
+import socket
+import asyncio
+from ..config import Config
+from ..mtproto import DataCenter
+
+
+class Endpoint:
+    """Telegram Data Center address with its health.
+
+    Keeps a smoothed connect RTT and a circuit breaker: after ``FAILURE_THRESHOLD``
+    failures in a row the endpoint is skipped for a cooldown, doubled on every failure
+    after it, and a single success closes the breaker again.
+
+    Args:
+        host (``str``)
+            IPv4 or IPv6 address.
+        port (``int``)
+            TCP port.
+    """
+
+    FAILURE_THRESHOLD = 2
+    COOLDOWN_MIN = 5
+    COOLDOWN_MAX = 120
+    RTT_SMOOTHING = 0.3
+
+    __slots__ = {'host', 'port', 'family', 'rtt', 'failures', 'cooldown', 'open_until'}
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.family = socket.AF_INET6 if ':' in host else socket.AF_INET
+        self.rtt = None
+        self.failures = 0
+        self.cooldown = 0
+        self.open_until = 0.0
+
+    def __repr__(self):
+        return '<Endpoint %s:%d rtt=%s failures=%d>' % (self.host, self.port, self.rtt, self.failures)
+
+    def is_available(self, now: float) -> bool:
+        return self.open_until <= now
+
+    def succeeded(self, rtt: float):
+        if self.rtt is None:
+            self.rtt = rtt
+        else:
+            self.rtt += (rtt - self.rtt) * Endpoint.RTT_SMOOTHING
+        self.failures = 0
+        self.cooldown = 0
+        self.open_until = 0.0
+
+    def outrun(self, elapsed: float):
+        """Another endpoint connected first, this one has been trying for ``elapsed`` seconds"""
+        if self.rtt is None or self.rtt < elapsed:
+            self.rtt = elapsed
+
+    def failed(self, now: float):
+        self.failures += 1
+        if self.failures >= Endpoint.FAILURE_THRESHOLD:
+            self.cooldown = min(max(self.cooldown * 2, Endpoint.COOLDOWN_MIN), Endpoint.COOLDOWN_MAX)
+            self.open_until = now + self.cooldown
+
+
+class DCRouter:
+    """Routes connections to Telegram Data Centers over their candidate endpoints.
+
+    Endpoints with an open circuit breaker are skipped, the rest are ordered by RTT,
+    alternating address families starting with the preferred one. Connects are raced
+    happy-eyeballs style: the next candidate is started after ``ATTEMPT_DELAY`` seconds
+    or as soon as the previous one fails, the first established connection wins.
+    Endpoint RTTs are refreshed by periodic connect probes.
+
+    Args:
+        config (:class:`mtproxy.config.Config`)
+            Proxy config.
+        endpoints (``dict``, *optional*)
+            Lists of (address, port) by DC number, :meth:`DataCenter.endpoints` by default.
+        probe_interval (``int``, *optional*)
+            Seconds between RTT probes, 0 disables probing.
+    """
+
+    ATTEMPT_DELAY = 0.25
+    UNKNOWN_RTT = 0.5
+
+    __slots__ = {'config', 'endpoints', 'probe_interval', '_task'}
+
+    def __init__(self, config: Config, endpoints: dict = None, probe_interval: int = 60):
+        self.config = config
+        if endpoints is None:
+            endpoints = DataCenter.endpoints(ipv6=config.ipv6 is not None)
+        self.endpoints = {
+            dc: [Endpoint(host, port) for host, port in addresses] for dc, addresses in endpoints.items()
+        }
+        self.probe_interval = probe_interval
+        self._task = None
+
+    def add_endpoints(self, endpoints: dict):
+        """Add candidate endpoints not known yet, e.g. the IPv6 ones once an IPv6 address is found
+
+        Args:
+            endpoints (``dict``)
+                Lists of (address, port) by DC number.
+        """
+        for dc, addresses in endpoints.items():
+            known = self.endpoints.setdefault(dc, [])
+            pairs = {(endpoint.host, endpoint.port) for endpoint in known}
+            known.extend(Endpoint(host, port) for host, port in addresses if (host, port) not in pairs)
+
+    def start(self):
+        if self._task is None and self.probe_interval:
+            self._task = asyncio.ensure_future(self._probe_loop())
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def has_dc(self, dc: int) -> bool:
+        return bool(self.endpoints.get(dc))
+
+    def candidates(self, dc: int) -> list:
+        """Endpoints of a DC in connect order"""
+        endpoints = self.endpoints[dc]
+        now = asyncio.get_event_loop().time()
+        available = [endpoint for endpoint in endpoints if endpoint.is_available(now)]
+        if not available:
+            # every breaker is open, fail over to the one closest to retrying
+            available = [min(endpoints, key=lambda endpoint: endpoint.open_until)]
+
+        available.sort(key=lambda endpoint: DCRouter.UNKNOWN_RTT if endpoint.rtt is None else endpoint.rtt)
+        preferred = socket.AF_INET6 if self.config.prefer_ipv6 else socket.AF_INET
+        first = [endpoint for endpoint in available if endpoint.family == preferred]
+        second = [endpoint for endpoint in available if endpoint.family != preferred]
+
+        ordered = []
+        for i in range(max(len(first), len(second))):
+            ordered.extend(family[i] for family in (first, second) if i < len(family))
+        return ordered
+
+    async def connect(self, dc: int):
+        """Open a connection to a DC
+
+        Return:
+            ``tuple``: (:class:`asyncio.StreamReader`, :class:`asyncio.StreamWriter`)
+
+        Raises:
+            :class:`OSError` if every endpoint failed, :class:`asyncio.TimeoutError` if
+            none connected in ``server_connect_timeout``.
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.config.server_connect_timeout
+        candidates = self.candidates(dc)
+        attempts = {}
+        error = None
+        try:
+            while candidates or attempts:
+                if candidates:
+                    endpoint = candidates.pop(0)
+                    attempts[asyncio.ensure_future(self._attempt(endpoint))] = (endpoint, loop.time())
+
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                if candidates:
+                    timeout = min(timeout, DCRouter.ATTEMPT_DELAY)
+
+                done, _ = await asyncio.wait(list(attempts), timeout=timeout,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    del attempts[task]
+                    if task.exception() is None:
+                        now = loop.time()
+                        for endpoint, started in attempts.values():
+                            endpoint.outrun(now - started)
+                        return task.result()
+                    error = task.exception()
+
+            now = loop.time()
+            for endpoint, _ in attempts.values():
+                endpoint.failed(now)
+            if error is None or attempts:
+                raise asyncio.TimeoutError()
+            raise error
+        finally:
+            for task in attempts:
+                task.cancel()
+                task.add_done_callback(DCRouter._close_late_connection)
+
+    async def _attempt(self, endpoint: Endpoint):
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        try:
+            connection = await asyncio.open_connection(endpoint.host, endpoint.port,
+                                                       limit=self.config.to_client_buffer_size)
+        except OSError:
+            endpoint.failed(loop.time())
+            raise
+        endpoint.succeeded(loop.time() - started)
+        return connection
+
+    @staticmethod
+    def _close_late_connection(task: asyncio.Future):
+        if not task.cancelled() and task.exception() is None:
+            task.result()[1].transport.abort()
+
+    async def _probe(self, endpoint: Endpoint):
+        try:
+            _, writer = await asyncio.wait_for(self._attempt(endpoint), self.config.server_connect_timeout)
+        except asyncio.TimeoutError:
+            endpoint.failed(asyncio.get_event_loop().time())
+        except OSError:
+            pass
+        else:
+            writer.transport.abort()
+
+    async def _probe_loop(self):
+        while True:
+            await asyncio.gather(*[
+                self._probe(endpoint) for endpoints in self.endpoints.values() for endpoint in endpoints
+            ])
+            await asyncio.sleep(self.probe_interval)
+
+
+def parse_endpoints(value: str, default_port: int = DataCenter.PORT) -> list:
+    """Parse a space or comma separated list of ``address[:port]``, IPv6 in brackets"""
+    endpoints = []
+    for item in value.replace(',', ' ').split():
+        if item.startswith('['):
+            host, _, port = item[1:].partition(']')
+            port = port.lstrip(':')
+        elif item.count(':') == 1:
+            host, port = item.split(':')
+        else:
+            host, port = item, ''
+        endpoints.append((host, int(port) if port else default_port))
+    return endpoints
@@ -0,0 +1,169 @@
+import os
+import array
+import socket
+import struct
+import asyncio
+from ..utils import log
+
+
+class Handoff:
+    """Listening sockets handoff between proxy processes, for upgrades without refused connections.
+
+    A running proxy listens on a Unix socket at ``path``. A new process connects to it
+    and gets the listening sockets of the running one as ``SCM_RIGHTS`` file
+    descriptors, serves them, then confirms. Only then the old process stops accepting
+    and drains its sessions, so the accept queue is never left unserved, and if the new
+    process fails before confirming, the old one keeps serving. The new process takes
+    the Unix socket path over for the next upgrade.
+
+    Args:
+        path (``str``)
+            Unix socket path.
+    """
+
+    TIMEOUT = 5
+    MAX_SOCKETS = 8
+    CONFIRM = b'\x01'
+
+    __slots__ = {'path', '_peer', '_sock', '_inode', '_sockets', '_on_handoff'}
+
+    def __init__(self, path: str):
+        self.path = path
+        self._peer = None
+        self._sock = None
+        self._inode = None
+        self._sockets = None
+        self._on_handoff = None
+
+    def receive(self) -> list:
+        """Take the listening sockets of a running process
+
+        Return:
+            ``list``: listening :class:`socket.socket` list, empty if no process handed them over.
+        """
+        peer = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        peer.settimeout(Handoff.TIMEOUT)
+        fds = array.array('i')
+        try:
+            peer.connect(self.path)
+            msg, ancdata, _, _ = peer.recvmsg(Handoff.MAX_SOCKETS * struct.calcsize('<i'),
+                                              socket.CMSG_LEN(Handoff.MAX_SOCKETS * fds.itemsize))
+        except OSError:
+            peer.close()
+            return []
+
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+        families = struct.unpack('<%di' % (len(msg) // struct.calcsize('<i')), msg)
+
+        sockets = []
+        for fd, family in zip(fds, families):
+            sockets.append(socket.fromfd(fd, family, socket.SOCK_STREAM))
+            os.close(fd)
+        for fd in fds[len(families):]:
+            os.close(fd)
+
+        if sockets:
+            self._peer = peer
+        else:
+            peer.close()
+        return sockets
+
+    def confirm(self):
+        """Tell the old process the received sockets are served, it stops accepting then"""
+        if self._peer is None:
+            return
+        try:
+            self._peer.sendall(Handoff.CONFIRM)
+        except OSError:
+            pass
+        self._peer.close()
+        self._peer = None
+
+    def listen(self, sockets, on_handoff):
+        """Hand the listening sockets over to the next process
+
+        Args:
+            sockets (``callable``)
+                Returns the listening sockets to hand over.
+            on_handoff (``callable``)
+                Called once the next process confirmed it serves them.
+        """
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+        self._sockets = sockets
+        self._on_handoff = on_handoff
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        self._sock.listen(1)
+        self._sock.setblocking(False)
+        self._inode = os.stat(self.path).st_ino
+        asyncio.get_event_loop().add_reader(self._sock.fileno(), self._accept)
+
+    def close(self):
+        """Stop listening, the path is removed unless a newer process took it over"""
+        if self._sock is None:
+            return
+        asyncio.get_event_loop().remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+        try:
+            if os.stat(self.path).st_ino == self._inode:
+                os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _accept(self):
+        try:
+            conn, _ = self._sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+
+        conn.setblocking(False)
+        # a new process that doesn't confirm in time is given up on, the old one keeps serving
+        timer = asyncio.get_event_loop().call_later(Handoff.TIMEOUT, self._abandon, conn)
+        self._send(conn, self._sockets(), timer)
+
+    def _send(self, conn, sockets: list, timer):
+        loop = asyncio.get_event_loop()
+        loop.remove_writer(conn.fileno())
+        try:
+            conn.sendmsg([struct.pack('<%di' % len(sockets), *(sock.family for sock in sockets))],
+                         [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                           array.array('i', (sock.fileno() for sock in sockets)))])
+        except (BlockingIOError, InterruptedError):
+            loop.add_writer(conn.fileno(), self._send, conn, sockets, timer)
+            return
+        except OSError as e:
+            log.warning('handoff_failed', "Failed to hand the listening sockets over: %s", e)
+            timer.cancel()
+            conn.close()
+            return
+
+        loop.add_reader(conn.fileno(), self._confirmed, conn, timer)
+
+    def _abandon(self, conn):
+        loop = asyncio.get_event_loop()
+        loop.remove_writer(conn.fileno())
+        loop.remove_reader(conn.fileno())
+        conn.close()
+        log.warning('handoff_failed', "The new process didn't take the listening sockets over in time")
+
+    def _confirmed(self, conn, timer):
+        timer.cancel()
+        asyncio.get_event_loop().remove_reader(conn.fileno())
+        try:
+            data = conn.recv(1)
+        except OSError:
+            data = b''
+        conn.close()
+
+        if data != Handoff.CONFIRM:
+            log.warning('handoff_failed', "The new process didn't take the listening sockets over")
+            return
+        self.close()
+        self._on_handoff()
@@ -0,0 +1,137 @@
+import asyncio
+from ..utils import log
+
+
+class MemoryBudget:
+    """Process wide budget of relay data buffered in transport write buffers.
+
+    Relayed transports are tracked while their session runs. Once per ``SWEEP`` seconds
+    their write buffers are summed, and the budget is shared between the ones holding
+    data: each transport gets ``limit`` divided by their number as its high-water mark,
+    a power of two between ``MIN_SHARE`` and ``MAX_SHARE``, halved while the budget is
+    exceeded. Transports tracked between sweeps get at most ``limit`` divided by the
+    number of tracked ones, until the next sweep applies the share to every transport.
+    A share lowers the watermarks a transport had when tracked, they are left as they
+    were while the share is ``MAX_SHARE``. A transport over its mark pauses its source,
+    through the stream writers drain or the relay protocols flow control, and relays
+    read at most a share at once.
+    Writers over their low-water mark that don't send anything for ``stall_timeout``
+    seconds are aborted.
+
+    Args:
+        limit (``int``)
+            Bytes of buffered relay data, 0 for no limit.
+        stall_timeout (``float``)
+            Seconds a writer may hold data without progress, 0 disables eviction.
+        metrics (:class:`mtproxy.proxy.metrics.Metrics`, *optional*)
+            Budget use and evictions are exposed in.
+    """
+
+    SWEEP = 1.0
+    MIN_SHARE = 4096
+    # asyncio default high-water mark
+    MAX_SHARE = 65536
+
+    __slots__ = {'limit', 'stall_timeout', 'metrics', 'used', 'share', '_writers', '_handle'}
+
+    def __init__(self, limit: int, stall_timeout: float, metrics=None):
+        self.limit = limit
+        self.stall_timeout = stall_timeout
+        self.metrics = metrics
+        self.used = 0
+        self.share = MemoryBudget.MAX_SHARE
+        # transport: [buffered at the last sweep, stalled since, own high-water mark, own low-water mark]
+        self._writers = {}
+        self._handle = None
+
+    @classmethod
+    def is_needed(cls, limit: int, stall_timeout: float) -> bool:
+        return bool(limit or stall_timeout)
+
+    def update(self, limit: int, stall_timeout: float):
+        """Apply new limits, from the next sweep"""
+        self.limit = limit
+        self.stall_timeout = stall_timeout
+
+    def start(self):
+        if self._handle is None:
+            self._handle = asyncio.get_event_loop().call_later(MemoryBudget.SWEEP, self._sweep)
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._writers.clear()
+
+    def track(self, transport):
+        """Count a relayed transport write buffer in, until :meth:`untrack`"""
+        low, high = transport.get_write_buffer_limits()
+        state = self._writers[transport] = [0, None, high, low]
+        share = self.share
+        if self.limit:
+            # until the next sweep, as if all tracked transports were holding data
+            share = min(share, self._round(self.limit // len(self._writers)))
+        MemoryBudget._apply(transport, state, share)
+
+    def untrack(self, transport):
+        self._writers.pop(transport, None)
+
+    def _sweep(self):
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        used = busy = 0
+        stalled = []
+        for transport, state in self._writers.items():
+            size = transport.get_write_buffer_size()
+            used += size
+            if not size:
+                state[0], state[1] = 0, None
+                continue
+            busy += 1
+            # a buffer over its low-water mark not shrinking between sweeps is taken as no progress
+            if self.stall_timeout and size >= state[0] and size > transport.get_write_buffer_limits()[0]:
+                if state[1] is None:
+                    state[1] = now
+                elif now - state[1] >= self.stall_timeout:
+                    stalled.append(transport)
+            else:
+                state[1] = None
+            state[0] = size
+        self.used = used
+
+        for transport in stalled:
+            log.debug('write_stall', "Evicting a connection that didn't send anything for %d seconds",
+                      self.stall_timeout)
+            self._writers.pop(transport, None)
+            transport.abort()
+
+        share = MemoryBudget.MAX_SHARE
+        if self.limit:
+            share = self.limit // max(busy, 1)
+            if used > self.limit:
+                share = min(share, self.share // 2)
+            share = self._round(share)
+        self.share = share
+        # also catches transports tracked since the last sweep with a smaller share
+        for transport, state in self._writers.items():
+            MemoryBudget._apply(transport, state, share)
+
+        if self.metrics is not None:
+            self.metrics.memory_budget_used.value = used
+            self.metrics.memory_budget_share.value = share
+            self.metrics.writers_evicted.value += len(stalled)
+        self._handle = loop.call_later(MemoryBudget.SWEEP, self._sweep)
+
+    @staticmethod
+    def _apply(transport, state: list, share: int):
+        high, low = state[2], state[3]
+        if share < MemoryBudget.MAX_SHARE and share < high:
+            high, low = share, min(low, share // 4)
+        if transport.get_write_buffer_limits() != (low, high):
+            transport.set_write_buffer_limits(high, low)
+
+    @staticmethod
+    def _round(share: int) -> int:
+        """Power of two between ``MIN_SHARE`` and ``MAX_SHARE``, limits change less often"""
+        share = max(MemoryBudget.MIN_SHARE, min(share, MemoryBudget.MAX_SHARE))
+        return 1 << share.bit_length() - 1
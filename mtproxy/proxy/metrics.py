@@ -0,0 +1,220 @@
+import bisect
+import asyncio
+
+
+class Counter:
+    """Counter or gauge value, updated in place so the hot path costs a slot access."""
+
+    __slots__ = {'value'}
+
+    def __init__(self):
+        self.value = 0
+
+
+class Histogram:
+    """Cumulative histogram with fixed bucket bounds.
+
+    Args:
+        bounds (``tuple``)
+            Sorted upper bounds of the buckets, the ``+Inf`` bucket is implied.
+    """
+
+    __slots__ = {'bounds', 'counts', 'sum', 'count'}
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class LabeledHistogram:
+    """Histograms of a metric by label values, made on first use.
+
+    Args:
+        bounds (``tuple``)
+            Sorted upper bounds of the buckets, the ``+Inf`` bucket is implied.
+    """
+
+    __slots__ = {'bounds', 'children'}
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.children = {}
+
+    def labels(self, *values) -> Histogram:
+        histogram = self.children.get(values)
+        if histogram is None:
+            histogram = self.children[values] = Histogram(self.bounds)
+        return histogram
+
+
+class Metrics:
+    """Proxy metrics in the Prometheus text format.
+
+    Attributes:
+        connections_active, connections_total (:class:`Counter`)
+            Client connections.
+        rejected_max_connections, rejected_per_ip, rejected_ip_rate (:class:`Counter`)
+            Client connections rejected at accept time by limit.
+        bytes_to_client, bytes_to_server (:class:`Counter`)
+            Relayed bytes per direction.
+        handshake_bad_proto_tag, handshake_replay, handshake_timeout (:class:`Counter`)
+            Client handshake failures by reason.
+        first_packet_dropped (:class:`Counter`)
+            Connections dropped by the first packet active fingerprinting check.
+        tarpit_held, tarpit_overflow, failed_ip_hits (:class:`Counter`)
+            Connections held after a failed handshake, closed since the tarpit was full, and
+            held right at accept since their IP failed recently.
+        dc_connect_failures (:class:`Counter`)
+            Failed Telegram connects.
+        memory_budget_used, memory_budget_share, writers_evicted (:class:`Counter`)
+            Relay data buffered in write buffers, the high-water mark of each write buffer and
+            connections closed since their writer stalled.
+        idle_timeouts_to_server, idle_timeouts_to_client (:class:`Counter`)
+            Sessions closed since the client, or Telegram, sent nothing for the idle timeout.
+        handshake_duration, dc_connect_time, session_lifetime (:class:`Histogram`)
+            Durations in seconds.
+        event_loop_lag (:class:`Histogram`)
+            Delay of the TCP_INFO sampler ticks, how late the event loop runs callbacks.
+        tcp_rtt, tcp_cwnd, tcp_unacked, tcp_retransmits (:class:`LabeledHistogram`)
+            TCP_INFO samples of session sockets by DC and direction: smoothed RTT in seconds,
+            congestion window in segments, bytes in flight and segments retransmitted since the
+            previous sample.
+    """
+
+    COUNTERS = (
+        ('connections_active', 'mtproxy_connections_active', 'gauge', 'Client connections currently open.', ''),
+        ('connections_total', 'mtproxy_connections_total', 'counter', 'Accepted client connections.', ''),
+        ('rejected_max_connections', 'mtproxy_connections_rejected_total', 'counter',
+         'Client connections rejected at accept time.', 'reason="max_connections"'),
+        ('rejected_per_ip', 'mtproxy_connections_rejected_total', 'counter',
+         'Client connections rejected at accept time.', 'reason="per_ip"'),
+        ('rejected_ip_rate', 'mtproxy_connections_rejected_total', 'counter',
+         'Client connections rejected at accept time.', 'reason="ip_rate"'),
+        ('bytes_to_client', 'mtproxy_bytes_total', 'counter', 'Relayed bytes.', 'direction="to_client"'),
+        ('bytes_to_server', 'mtproxy_bytes_total', 'counter', 'Relayed bytes.', 'direction="to_server"'),
+        ('handshake_bad_proto_tag', 'mtproxy_handshake_failures_total', 'counter',
+         'Failed client handshakes.', 'reason="bad_proto_tag"'),
+        ('handshake_replay', 'mtproxy_handshake_failures_total', 'counter',
+         'Failed client handshakes.', 'reason="replay"'),
+        ('handshake_timeout', 'mtproxy_handshake_failures_total', 'counter',
+         'Failed client handshakes.', 'reason="timeout"'),
+        ('first_packet_dropped', 'mtproxy_handshake_failures_total', 'counter',
+         'Failed client handshakes.', 'reason="first_packet"'),
+        ('tarpit_held', 'mtproxy_tarpit_connections', 'gauge', 'Connections held after a failed handshake.', ''),
+        ('tarpit_overflow', 'mtproxy_tarpit_overflow_total', 'counter',
+         'Failed handshake connections closed since the tarpit was full.', ''),
+        ('failed_ip_hits', 'mtproxy_failed_ip_hits_total', 'counter',
+         'Connections held at accept since their IP failed a handshake recently.', ''),
+        ('dc_connect_failures', 'mtproxy_dc_connect_failures_total', 'counter', 'Failed Telegram connects.', ''),
+        ('memory_budget_used', 'mtproxy_memory_budget_used_bytes', 'gauge',
+         'Relay data buffered in write buffers.', ''),
+        ('memory_budget_share', 'mtproxy_memory_budget_share_bytes', 'gauge',
+         'High-water mark of each relay write buffer.', ''),
+        ('writers_evicted', 'mtproxy_stalled_writers_evicted_total', 'counter',
+         'Connections closed since their writer made no progress.', ''),
+        ('idle_timeouts_to_server', 'mtproxy_idle_timeouts_total', 'counter',
+         'Sessions closed since a direction was idle for its timeout.', 'direction="to_server"'),
+        ('idle_timeouts_to_client', 'mtproxy_idle_timeouts_total', 'counter',
+         'Sessions closed since a direction was idle for its timeout.', 'direction="to_client"'),
+    )
+
+    HISTOGRAMS = (
+        ('handshake_duration', 'mtproxy_handshake_duration_seconds', 'Client handshake duration.',
+         (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)),
+        ('dc_connect_time', 'mtproxy_dc_connect_seconds', 'Telegram connect time.',
+         (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)),
+        ('session_lifetime', 'mtproxy_session_lifetime_seconds', 'Relayed session lifetime.',
+         (1, 5, 10, 30, 60, 300, 600, 1800, 3600, 21600)),
+        ('event_loop_lag', 'mtproxy_event_loop_lag_seconds', 'Delay of the TCP_INFO sampler ticks.',
+         (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)),
+    )
+
+    LABELED_HISTOGRAMS = (
+        ('tcp_rtt', 'mtproxy_tcp_rtt_seconds', 'Smoothed RTT of sampled session sockets.', ('dc', 'direction'),
+         (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)),
+        ('tcp_cwnd', 'mtproxy_tcp_cwnd_segments', 'Congestion window of sampled session sockets.',
+         ('dc', 'direction'), (2, 4, 10, 20, 50, 100, 200, 500, 1000)),
+        ('tcp_unacked', 'mtproxy_tcp_unacked_bytes', 'Bytes in flight on sampled session sockets.',
+         ('dc', 'direction'), (0, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)),
+        ('tcp_retransmits', 'mtproxy_tcp_retransmits', 'Segments retransmitted between two samples of a socket.',
+         ('dc', 'direction'), (0, 1, 2, 5, 10, 50, 100)),
+    )
+
+    __slots__ = {name for name, *_ in COUNTERS} | {name for name, *_ in HISTOGRAMS} | \
+        {name for name, *_ in LABELED_HISTOGRAMS} | {'_server'}
+
+    def __init__(self):
+        for name, *_ in Metrics.COUNTERS:
+            setattr(self, name, Counter())
+        for name, _, _, bounds in Metrics.HISTOGRAMS:
+            setattr(self, name, Histogram(bounds))
+        for name, _, _, _, bounds in Metrics.LABELED_HISTOGRAMS:
+            setattr(self, name, LabeledHistogram(bounds))
+        self._server = None
+
+    def render(self) -> str:
+        """Metrics in the Prometheus text exposition format"""
+        lines = []
+        described = set()
+        for name, metric, kind, description, labels in Metrics.COUNTERS:
+            if metric not in described:
+                described.add(metric)
+                lines.append('# HELP %s %s' % (metric, description))
+                lines.append('# TYPE %s %s' % (metric, kind))
+            lines.append('%s%s %d' % (metric, '{%s}' % labels if labels else '', getattr(self, name).value))
+
+        for name, metric, description, bounds in Metrics.HISTOGRAMS:
+            lines.append('# HELP %s %s' % (metric, description))
+            lines.append('# TYPE %s histogram' % metric)
+            Metrics._render_histogram(lines, metric, '', getattr(self, name))
+
+        for name, metric, description, label_names, bounds in Metrics.LABELED_HISTOGRAMS:
+            lines.append('# HELP %s %s' % (metric, description))
+            lines.append('# TYPE %s histogram' % metric)
+            for values, histogram in sorted(getattr(self, name).children.items()):
+                labels = ','.join('%s="%s"' % label for label in zip(label_names, values))
+                Metrics._render_histogram(lines, metric, labels, histogram)
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _render_histogram(lines: list, metric: str, labels: str, histogram: Histogram):
+        cumulative = 0
+        for bound, count in zip(histogram.bounds + ('+Inf',), histogram.counts):
+            cumulative += count
+            lines.append('%s_bucket{%sle="%s"} %d' % (metric, labels + ',' if labels else '', bound, cumulative))
+        suffix = '{%s}' % labels if labels else ''
+        lines.append('%s_sum%s %f' % (metric, suffix, histogram.sum))
+        lines.append('%s_count%s %d' % (metric, suffix, histogram.count))
+
+    async def start_server(self, host: str, port: int, reuse_port: bool = False):
+        """Serve the metrics over HTTP at ``/metrics``"""
+        self._server = await asyncio.start_server(self._handle_request, host, port, reuse_port=reuse_port)
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    async def _handle_request(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=10)
+            method, path = request.split(b' ', 2)[:2]
+            if method == b'GET' and path.split(b'?')[0] == b'/metrics':
+                status, body = '200 OK', self.render().encode()
+            else:
+                status, body = '404 Not Found', b'Not Found\n'
+            writer.write(('HTTP/1.0 %s\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                          'Content-Length: %d\r\nConnection: close\r\n\r\n' % (status, len(body))).encode() + body)
+            await writer.drain()
+        except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
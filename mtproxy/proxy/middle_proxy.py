@@ -0,0 +1,521 @@
+import os
+import re
+import time
+import zlib
+import random
+import socket
+import asyncio
+import hashlib
+import urllib.request
+from ..mtproto import AESCBC, Keys
+from ..utils import log
+from .shaper import throttle
+
+RPC_NONCE = b'\xaa\x87\xcb\x7a'
+RPC_HANDSHAKE = b'\xf5\xee\x82\x76'
+RPC_PROXY_REQ = b'\xee\xf1\xce\x36'
+RPC_PROXY_ANS = b'\x0d\xda\x03\x44'
+RPC_CLOSE_CONN = b'\x5d\x42\xcf\x1f'
+RPC_CLOSE_EXT = b'\xa2\x34\xb6\x5e'
+RPC_SIMPLE_ACK = b'\x9b\x40\xac\x3b'
+RPC_PING = b'\xdf\xa2\x30\x57'
+RPC_PONG = b'\xa7\xea\x30\x84'
+RPC_FLAGS = b'\x00\x00\x00\x00'
+CRYPTO_AES = b'\x01\x00\x00\x00'
+PROXY_TAG = b'\xae\x26\x1e\xdb'
+# the extra header size is fixed for this length
+AD_TAG_LEN = 16
+PROCESS_ID = b'IPIPPRPDTIME'
+PADDING = b'\x04\x00\x00\x00'
+
+FLAG_NOT_ENCRYPTED = 0x2
+FLAG_HAS_AD_TAG = 0x8
+FLAG_MAGIC = 0x1000
+FLAG_EXTMODE2 = 0x20000
+FLAG_PAD = 0x8000000
+FLAG_INTERMEDIATE = 0x20000000
+FLAG_ABRIDGED = 0x40000000
+FLAG_QUICKACK = 0x80000000
+
+PROTO_FLAGS = {
+    Keys.PROTO_TAG_ABRIDGED: FLAG_ABRIDGED,
+    Keys.PROTO_TAG_INTERMEDIATE: FLAG_INTERMEDIATE,
+    Keys.PROTO_TAG_SECURE: FLAG_INTERMEDIATE | FLAG_PAD,
+}
+
+SECRET_URL = 'https://core.telegram.org/getProxySecret'
+CONFIG_URLS = ('https://core.telegram.org/getProxyConfig', 'https://core.telegram.org/getProxyConfigV6')
+
+MAX_MESSAGE = 1 << 24
+
+
+def derive_keys(purpose: bytes, nonce_srv: bytes, nonce_clt: bytes, clt_ts: bytes, srv_ip: bytes, clt_port: bytes,
+                clt_ip: bytes, srv_port: bytes, secret: bytes, clt_ipv6: bytes = None, srv_ipv6: bytes = None) -> tuple:
+    """AES-CBC key and iv of a middle proxy connection direction, ``purpose`` is b'CLIENT' for
+    proxy to middle proxy traffic and b'SERVER' for the other way
+
+    Return:
+        ``tuple``: (key, iv)
+    """
+    if not clt_ip or not srv_ip:
+        clt_ip = srv_ip = bytes(4)
+    s = nonce_srv + nonce_clt + clt_ts + srv_ip + clt_port + purpose + clt_ip + srv_port + secret + nonce_srv
+    if clt_ipv6 and srv_ipv6:
+        s += clt_ipv6 + srv_ipv6
+    s += nonce_clt
+    key = hashlib.md5(s[1:]).digest()[:12] + hashlib.sha1(s).digest()
+    iv = hashlib.md5(s[2:]).digest()
+    return key, iv
+
+
+def ip_port_bytes(ip: str, port: int) -> bytes:
+    """Address as an IPv6 or IPv4-mapped address and a 32-bit port"""
+    if ':' in ip:
+        address = socket.inet_pton(socket.AF_INET6, ip.partition('%')[0])
+    else:
+        address = bytes(10) + b'\xff\xff' + socket.inet_aton(ip)
+    return address + int.to_bytes(port, 4, 'little')
+
+
+def parse_ad_tag(value: str) -> bytes:
+    """Parse a promoted channel tag, 32 hex digits
+
+    Raises:
+        :class:`ValueError`: if the tag is not 16 bytes in hex.
+    """
+    value = value.strip()
+    if not re.fullmatch('[0-9a-fA-F]{%d}' % (AD_TAG_LEN * 2), value):
+        raise ValueError("ad_tag must be %d hex digits, got %r" % (AD_TAG_LEN * 2, value))
+    return bytes.fromhex(value)
+
+
+def fetch_proxy_secret(url: str = SECRET_URL):
+    """Middle proxy secret, None if it can't be fetched"""
+    try:
+        with urllib.request.urlopen(url, timeout=10) as f:
+            return f.read() if f.status == 200 else None
+    except Exception:
+        return None
+
+
+def fetch_middle_proxies(urls: tuple = CONFIG_URLS) -> dict:
+    """Middle proxy (address, port) lists by DC number, from the Telegram proxy configs"""
+    middle_proxies = {}
+    for url in urls:
+        try:
+            with urllib.request.urlopen(url, timeout=10) as f:
+                if f.status != 200:
+                    continue
+                text = f.read().decode()
+        except Exception:
+            continue
+        for dc, host, port in re.findall(r'proxy_for\s+(-?\d+)\s+(\S+):(\d+)\s*;', text):
+            middle_proxies.setdefault(int(dc), []).append((host.strip('[]'), int(port)))
+    return middle_proxies
+
+
+class MiddleProxyConnection(asyncio.Protocol):
+    """Connection to a Telegram middle proxy, multiplexing client sessions.
+
+    Speaks the RPC framing, a length, a sequence number and a CRC32 around every
+    message, AES-CBC encrypted once the nonce exchange is done. Answers are dispatched
+    to sessions by connection id from :meth:`data_received`, writers wait for the shared
+    transport with :meth:`drain`. If the connection is lost, its sessions are closed.
+
+    Args:
+        secret (``bytes``)
+            Middle proxy secret.
+        ipv4 (``str``, *optional*)
+            Public IPv4 address, used for the keys behind NAT.
+        ipv6 (``str``, *optional*)
+            Public IPv6 address.
+    """
+
+    __slots__ = {'secret', 'ipv4', 'ipv6', 'transport', 'sessions', 'ready', 'our_ip_port', 'encryptor', 'decryptor',
+                 'write_seq', 'read_seq', '_nonce', '_ts', '_raw', '_buffer', '_paused', '_drain_waiters'}
+
+    def __init__(self, secret: bytes, ipv4: str = None, ipv6: str = None):
+        self.secret = secret
+        self.ipv4 = ipv4
+        self.ipv6 = ipv6
+        self.transport = None
+        self.sessions = {}
+        self.ready = asyncio.get_event_loop().create_future()
+        self.our_ip_port = None
+        self.encryptor = None
+        self.decryptor = None
+        self.write_seq = -2
+        self.read_seq = -2
+        self._nonce = os.urandom(16)
+        self._ts = int.to_bytes(int(time.time()) % 2 ** 32, 4, 'little')
+        self._raw = bytearray()
+        self._buffer = bytearray()
+        self._paused = False
+        self._drain_waiters = []
+
+    @property
+    def closed(self) -> bool:
+        return self.transport is None or self.transport.is_closing()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send(RPC_NONCE + self.secret[:4] + CRYPTO_AES + self._ts + self._nonce)
+
+    def connection_lost(self, exc):
+        if not self.ready.done():
+            self.ready.set_exception(ConnectionError("Middle proxy connection lost"))
+        for session in list(self.sessions.values()):
+            session.close(notify=False)
+        self._wake_writers()
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        self._wake_writers()
+
+    async def drain(self):
+        """Wait until the transport buffer is below its high-water mark"""
+        if self._paused and not self.closed:
+            waiter = asyncio.get_event_loop().create_future()
+            self._drain_waiters.append(waiter)
+            await waiter
+
+    def send(self, message: bytes):
+        frame = bytearray(int.to_bytes(len(message) + 12, 4, 'little'))
+        frame += int.to_bytes(self.write_seq, 4, 'little', signed=True)
+        frame += message
+        frame += int.to_bytes(zlib.crc32(frame), 4, 'little')
+        frame += PADDING * (-len(frame) % 16 // 4)
+        self.write_seq += 1
+        self.transport.write(self.encryptor.encrypt(bytes(frame)) if self.encryptor else frame)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.abort()
+
+    def data_received(self, data):
+        if self.decryptor is not None:
+            raw = self._raw
+            raw += data
+            size = len(raw) - len(raw) % 16
+            if not size:
+                return
+            self._buffer += self.decryptor.decrypt(bytes(raw[:size]))
+            del raw[:size]
+        else:
+            self._buffer += data
+
+        buffer = self._buffer
+        position = 0
+        while len(buffer) - position >= 4:
+            length = int.from_bytes(buffer[position:position + 4], 'little')
+            if length == 4:
+                position += 4
+                continue
+            if length < 12 or length % 4 or length > MAX_MESSAGE:
+                return self._fail("bad frame length %d" % length)
+            if len(buffer) - position < length:
+                break
+
+            frame = bytes(buffer[position:position + length])
+            position += length
+            if int.from_bytes(frame[-4:], 'little') != zlib.crc32(frame[:-4]):
+                return self._fail("bad frame checksum")
+            if int.from_bytes(frame[4:8], 'little', signed=True) != self.read_seq:
+                return self._fail("bad frame sequence number")
+            self.read_seq += 1
+            self._message(frame[8:-4])
+            if self.closed:
+                return
+        del buffer[:position]
+
+    def _message(self, message: bytes):
+        kind = message[:4]
+        if kind == RPC_PROXY_ANS:
+            session = self.sessions.get(message[8:16])
+            if session is not None:
+                session.deliver(message[16:])
+        elif kind == RPC_SIMPLE_ACK:
+            session = self.sessions.get(message[4:12])
+            if session is not None:
+                session.simple_ack(message[12:16])
+        elif kind == RPC_CLOSE_EXT:
+            session = self.sessions.get(message[4:12])
+            if session is not None:
+                session.close(notify=False)
+        elif kind == RPC_PING:
+            self.send(RPC_PONG + message[4:12])
+        elif kind == RPC_NONCE and self.encryptor is None:
+            self._handle_nonce(message)
+        elif kind == RPC_HANDSHAKE and not self.ready.done():
+            if message[20:32] != PROCESS_ID:
+                return self._fail("bad handshake answer")
+            self.ready.set_result(None)
+
+    def _handle_nonce(self, message: bytes):
+        if len(message) != 32 or message[4:8] != self.secret[:4] or message[8:12] != CRYPTO_AES:
+            return self._fail("bad nonce answer")
+
+        srv_ip, srv_port = self.transport.get_extra_info('peername')[:2]
+        clt_ip, clt_port = self.transport.get_extra_info('sockname')[:2]
+        if ':' in srv_ip:
+            clt_ip = self.ipv6 or clt_ip
+            v4 = {'srv_ip': None, 'clt_ip': None,
+                  'srv_ipv6': socket.inet_pton(socket.AF_INET6, srv_ip.partition('%')[0]),
+                  'clt_ipv6': socket.inet_pton(socket.AF_INET6, clt_ip.partition('%')[0])}
+        else:
+            # the middle proxy sees the public address behind NAT
+            clt_ip = self.ipv4 or clt_ip
+            v4 = {'srv_ip': socket.inet_aton(srv_ip)[::-1], 'clt_ip': socket.inet_aton(clt_ip)[::-1]}
+        self.our_ip_port = ip_port_bytes(clt_ip, clt_port)
+
+        args = dict(nonce_srv=message[16:32], nonce_clt=self._nonce, clt_ts=self._ts,
+                    srv_port=int.to_bytes(srv_port, 2, 'little'), clt_port=int.to_bytes(clt_port, 2, 'little'),
+                    secret=self.secret, **v4)
+        self.encryptor = AESCBC(*derive_keys(b'CLIENT', **args))
+        self.decryptor = AESCBC(*derive_keys(b'SERVER', **args))
+        self.send(RPC_HANDSHAKE + RPC_FLAGS + PROCESS_ID + PROCESS_ID)
+
+    def timed_out(self):
+        if not self.ready.done():
+            self._fail("connect timed out")
+
+    def _fail(self, reason: str):
+        log.warning('middle_proxy_error', "Middle proxy connection failed: %s", reason)
+        if not self.ready.done():
+            self.ready.set_exception(ConnectionError(reason))
+        self.close()
+
+    def _wake_writers(self):
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+
+class MiddleProxySession:
+    """Client session relayed through a :class:`MiddleProxyConnection`.
+
+    Client messages are read by transport framing and sent as ``RPC_PROXY_REQ``
+    messages, answers are framed back for the client from the connection callbacks.
+    A client not reading its answers is closed once ``MAX_BACKLOG`` bytes are buffered,
+    as the shared connection can't wait for it.
+
+    Args:
+        connection (:class:`MiddleProxyConnection`)
+            Upstream connection.
+        client (:class:`mtproxy.proxy.streams.ClientSteamProtocol`)
+            Handshaked client.
+        ad_tag (``bytes``, *optional*)
+            16 bytes promoted channel tag.
+        counters (``tuple``, *optional*)
+            Counters of the bytes sent to the client.
+    """
+
+    MAX_BACKLOG = 1 << 22
+
+    __slots__ = {'connection', 'conn_id', 'client', 'flags', 'header', 'counters', 'idle', 'closed'}
+
+    def __init__(self, connection: MiddleProxyConnection, client, ad_tag: bytes = None, counters: tuple = ()):
+        self.connection = connection
+        self.conn_id = os.urandom(8)
+        while self.conn_id in connection.sessions:
+            self.conn_id = os.urandom(8)
+        self.client = client
+        self.flags = FLAG_MAGIC | FLAG_EXTMODE2 | PROTO_FLAGS[client.proto_tag]
+        self.header = self.conn_id + ip_port_bytes(client.ip, client.port) + connection.our_ip_port
+        if ad_tag:
+            self.flags |= FLAG_HAS_AD_TAG
+            self.header += b'\x18\x00\x00\x00' + PROXY_TAG + bytes((len(ad_tag),)) + ad_tag + bytes(3)
+        self.counters = counters
+        self.idle = None
+        self.closed = False
+        connection.sessions[self.conn_id] = self
+
+    async def read_message(self) -> tuple:
+        """Read a client message
+
+        Return:
+            ``tuple``: (message, quick ack requested)
+        """
+        reader = self.client.reader
+        if self.client.proto_tag == Keys.PROTO_TAG_ABRIDGED:
+            length = (await reader.readexactly(1))[0]
+            quickack = length & 0x80
+            length &= 0x7f
+            if length == 0x7f:
+                length = int.from_bytes(await reader.readexactly(3), 'little')
+            length *= 4
+        else:
+            length = int.from_bytes(await reader.readexactly(4), 'little')
+            quickack = length & 0x80000000
+            length &= 0x7fffffff
+        if not 8 <= length <= MAX_MESSAGE:
+            raise ValueError("Bad client message length %d" % length)
+
+        message = await reader.readexactly(length)
+        if self.client.proto_tag == Keys.PROTO_TAG_SECURE:
+            message = message[:length - length % 4]
+        return message, quickack
+
+    def send(self, message: bytes, quickack: bool = False):
+        flags = self.flags
+        if quickack:
+            flags |= FLAG_QUICKACK
+        if message[:8] == bytes(8):
+            flags |= FLAG_NOT_ENCRYPTED
+        self.connection.send(RPC_PROXY_REQ + int.to_bytes(flags, 4, 'little') + self.header + message)
+
+    def deliver(self, message: bytes):
+        """Frame an answer for the client"""
+        writer = self.client.writer
+        if writer.transport.get_write_buffer_size() > MiddleProxySession.MAX_BACKLOG:
+            log.debug('middle_proxy_backlog', "Closing a client session not reading its answers")
+            return self.close()
+
+        if self.idle is not None:
+            self.idle.touch()
+        for counter in self.counters:
+            counter.value += len(message)
+        proto_tag = self.client.proto_tag
+        if proto_tag == Keys.PROTO_TAG_ABRIDGED:
+            length = len(message) // 4
+            if length < 0x7f:
+                writer.write(bytes((length,)) + message)
+            else:
+                writer.write(b'\x7f' + int.to_bytes(length, 3, 'little') + message)
+        elif proto_tag == Keys.PROTO_TAG_SECURE:
+            padding = os.urandom(random.randrange(4))
+            writer.write(int.to_bytes(len(message) + len(padding), 4, 'little') + message + padding)
+        else:
+            writer.write(int.to_bytes(len(message), 4, 'little') + message)
+
+    def simple_ack(self, confirm: bytes):
+        if self.client.proto_tag == Keys.PROTO_TAG_ABRIDGED:
+            confirm = confirm[::-1]
+        self.client.writer.write(confirm)
+
+    def close(self, notify: bool = True):
+        """End the session, telling the middle proxy if ``notify``"""
+        if self.closed:
+            return
+        self.closed = True
+        self.connection.sessions.pop(self.conn_id, None)
+        if notify and not self.connection.closed:
+            self.connection.send(RPC_CLOSE_CONN + self.conn_id)
+        self.client.writer.transport.abort()
+
+    async def relay(self, buckets: tuple = (), counters: tuple = (), to_server_idle=None, to_client_idle=None):
+        """Relay client messages until the session ends
+
+        Args:
+            buckets (``tuple``, *optional*)
+                :class:`mtproxy.proxy.shaper.TokenBucket` tuple limiting client messages.
+            counters (``tuple``, *optional*)
+                Counters of the bytes sent by the client.
+            to_server_idle, to_client_idle (:class:`mtproxy.proxy.timing_wheel.Timer`, *optional*)
+                Idle timeouts of the client messages and of the answers.
+        """
+        self.idle = to_client_idle
+        try:
+            while not self.closed:
+                message, quickack = await self.read_message()
+                if to_server_idle is not None:
+                    to_server_idle.touch()
+                for counter in counters:
+                    counter.value += len(message)
+                self.send(message, quickack)
+                await self.connection.drain()
+                if buckets:
+                    await throttle(self.client.writer.transport, buckets, len(message))
+        except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+            log.debug('session_error', "Middle proxy session closed: %s", e)
+        finally:
+            self.close()
+
+
+class MiddleProxyPool:
+    """Small persistent pool of middle proxy connections per DC.
+
+    Up to ``size`` connections are opened per DC as sessions come, each new session goes
+    to the one with the fewest sessions. Closed connections are replaced on demand.
+
+    Args:
+        config (:class:`mtproxy.config.Config`)
+            Proxy config, with the middle proxy secret and addresses.
+        size (``int``)
+            Connections per DC.
+    """
+
+    __slots__ = {'config', 'size', 'secret', 'middle_proxies', 'ad_tag', 'discovery', '_connections'}
+
+    def __init__(self, config, size: int):
+        self.config = config
+        self.size = size
+        self.secret = bytes.fromhex(config.middle_proxy_secret)
+        self.middle_proxies = config.middle_proxies
+        self.ad_tag = parse_ad_tag(config.ad_tag) if config.ad_tag else None
+        # connections wait for the external addresses lookup, their keys are derived from them
+        self.discovery = None
+        self._connections = {}
+
+    def has_dc(self, dc: int) -> bool:
+        return bool(self.middle_proxies.get(dc) or self.middle_proxies.get(abs(dc)))
+
+    async def session(self, dc: int, client, counters: tuple = ()) -> MiddleProxySession:
+        """Start a session of ``client`` on a connection to a middle proxy of ``dc``
+
+        Raises:
+            :class:`OSError`: if the connection failed or timed out.
+        """
+        if self.discovery is not None and not self.discovery.done():
+            await asyncio.wait([self.discovery])
+        connections = self._connections.setdefault(dc, [])
+        connections[:] = [connection for connection in connections
+                          if not (connection.ready.done() and (connection.ready.exception() or connection.closed))]
+        if len(connections) < self.size:
+            connections.append(self._connect(dc))
+
+        connection = min(connections, key=lambda connection: (not connection.ready.done(), len(connection.sessions)))
+        await asyncio.shield(connection.ready)
+        if connection.closed:
+            raise ConnectionError("Middle proxy connection closed")
+
+        return MiddleProxySession(connection, client, self.ad_tag, counters)
+
+    def close(self):
+        for connections in self._connections.values():
+            for connection in connections:
+                connection.close()
+        self._connections.clear()
+
+    def _connect(self, dc: int) -> MiddleProxyConnection:
+        connection = MiddleProxyConnection(self.secret, self.config.ipv4, self.config.ipv6)
+        # the future may fail before anyone waits for it
+        connection.ready.add_done_callback(lambda ready: ready.cancelled() or ready.exception())
+        timer = self.config.timers.arm(self.config.server_connect_timeout, connection.timed_out)
+        connection.ready.add_done_callback(lambda ready: timer.cancel())
+
+        candidates = self.middle_proxies.get(dc) or self.middle_proxies.get(abs(dc))
+        preferred = [endpoint for endpoint in candidates if (':' in endpoint[0]) == bool(self.config.prefer_ipv6)]
+        host, port = random.choice(preferred or candidates)
+        loop = asyncio.get_event_loop()
+
+        async def connect():
+            try:
+                await loop.create_connection(lambda: connection, host, port)
+            except OSError as e:
+                if not connection.ready.done():
+                    connection.ready.set_exception(e)
+                return
+            # timed out while connecting
+            if connection.ready.done() and connection.ready.exception() is not None:
+                connection.close()
+
+        asyncio.ensure_future(connect())
+        return connection
@@ -1,11 +1,26 @@
-from functools import partial
+import copy
+import signal
 import asyncio
 import socket
 import urllib.parse
-from configparser import ConfigParser
+from configparser import ConfigParser, Error as ConfigError
 from .connection_handler import ConnectionHandler
-from ..utils import IPInfo, AsyncTools, User
+from .supervisor import Supervisor
+from .dc_pool import TelegramConnectionPool
+from .dc_router import DCRouter, parse_endpoints
+from .metrics import Metrics
+from .accounting import UserAccounting
+from .shaper import Shaper, parse_rate
+from .handoff import Handoff
+from .admission import Admission
+from .tarpit import Tarpit
+from .memory_budget import MemoryBudget
+from .tcp_info import TCPInfoSampler
+from .timing_wheel import TimingWheel
+from .middle_proxy import MiddleProxyPool, fetch_proxy_secret, fetch_middle_proxies, parse_ad_tag
+from ..utils import IPInfo, AsyncTools, User, log
 from ..config import Config
+from ..mtproto import AES, DataCenter, HandshakeEngine, Keys, ReplayCache
 
 
 class MTProxy:
@@ -32,23 +47,139 @@ class MTProxy:
             Keep alive period for clients in secs.
         client_ack_timeout (``int``, *optional*)
             if client doesn't confirm data for this number of seconds, it is dropped
+        client_idle_timeout (``int``, *optional*)
+            Close a session after the client sent nothing for this number of seconds, 0 disables.
+        server_idle_timeout (``int``, *optional*)
+            Close a session after Telegram sent nothing for this number of seconds, 0 disables.
         server_connect_timeout (``int``, *optional*)
             Telegram servers connect timeout in seconds.
         to_client_buffer_size (``int``, *optional*)
             Max socket buffer size to the client direction, the more the faster, but more RAM hungry.
         to_server_buffer_size (``int``, *optional*)
             Max socket buffer size to the telegram servers direction.
+        min_buffer_size (``int``, *optional*)
+            Read size and socket send buffers sessions start with, grown up to the max ones for bulk
+            transfers and shrunk back when idle or interactive.
+        to_client_high_watermark (``int``, *optional*)
+            Bytes waiting in the proxy to be sent to a client over which reading from Telegram pauses.
+        to_client_low_watermark (``int``, *optional*)
+            Bytes waiting to be sent to a client under which reading from Telegram resumes.
+        to_server_high_watermark (``int``, *optional*)
+            Bytes waiting in the proxy to be sent to Telegram over which reading from the client pauses.
+        to_server_low_watermark (``int``, *optional*)
+            Bytes waiting to be sent to Telegram under which reading from the client resumes.
+        tcp_nodelay (``bool``, *optional*)
+            if True, sockets send small writes without waiting for the ACK of the previous ones.
+        tcp_notsent_lowat (``int``, *optional*)
+            Max bytes not sent yet kept in a socket send buffer, 0 for the kernel default.
+        write_coalesce_window (``float``, *optional*)
+            Seconds small relayed writes are held back to leave in full segments, 0 disables.
         block_mode (``bool``, *optional*)
             if True, Drop client if first packet is bad.
         reply_check_length (``int``, *optional*)
             Length of used handshake randoms for active fingerprinting protection.
+        reply_check_fp_rate (``float``, *optional*)
+            False positive rate of the used handshake randoms check, 0 to store whole randoms.
+        reply_check_file (``str``, *optional*)
+            File to keep used handshake randoms in across restarts.
+        relay_engine (``str``, *optional*)
+            'stream' to relay data with reader tasks, 'protocol' to relay it from transport callbacks, with no
+            task for idle sessions.
+        splice (``bool``, *optional*)
+            if True, in fast mode the stream engine relays telegram to client traffic in kernel with splice().
+        dc_pool_size (``int``, *optional*)
+            Max idle pre-connected telegram connections per DC address, 0 disables the pool.
+        dc_pool_idle_timeout (``int``, *optional*)
+            Idle pre-connected telegram connections are closed after this number of seconds.
+        dc_probe_interval (``int``, *optional*)
+            Seconds between telegram servers RTT probes, 0 disables probing.
+        datacenters (``dict``, *optional*)
+            Candidate (address, port) lists by DC number, built-in addresses if Ignored.
+        metrics_port (``int``, *optional*)
+            Port of the Prometheus metrics endpoint, worker N listens on metrics_port + N, 0 disables it.
+        metrics_addr (``str``, *optional*)
+            Listen address of the Prometheus metrics endpoint.
+        user_stats_file (``str``, *optional*)
+            Memory-mapped file to keep per user connections and traffic counters in, disabled if Ignored.
+        rate_limit (``int``, *optional*)
+            Global bytes per second limit in each direction, 0 for no limit. Users may have their own rate.
+        crypto_backend (``str``, *optional*)
+            AES-CTR library, 'cryptography', 'pycryptodome' or 'tgcrypto', 'auto' picks the fastest installed.
+        log_level (``str``, *optional*)
+            'debug', 'info', 'warning' or 'error'.
+        log_json (``bool``, *optional*)
+            if True, log a compact JSON object per line.
+        log_rate (``float``, *optional*)
+            Max log messages per second of each type, 0 for no limit.
+        log_sample (``int``, *optional*)
+            Log one in this number of messages of each type.
+        handoff_socket (``str``, *optional*)
+            Unix socket path to take the listening sockets over from a running proxy and hand them to the next one.
+        drain_timeout (``int``, *optional*)
+            Max seconds to keep relaying established sessions after the listening sockets were handed over, or the
+            workers got SIGTERM.
+        max_connections (``int``, *optional*)
+            Max open client connections, split between workers, 0 for no limit.
+        max_connections_per_ip (``int``, *optional*)
+            Max open client connections per source IP prefix in each worker, 0 for no limit.
+        ip_connect_rate (``float``, *optional*)
+            Max new client connections per second per source IP prefix in each worker, 0 for no limit.
+        ip_prefix_v4 (``int``, *optional*)
+            IPv4 source prefix length the per IP limits apply to.
+        ip_prefix_v6 (``int``, *optional*)
+            IPv6 source prefix length the per IP limits apply to.
+        tarpit_max_connections (``int``, *optional*)
+            Max connections frozen after a failed handshake, further ones are closed.
+        tarpit_hold_time (``float``, *optional*)
+            Seconds a connection is frozen after a failed handshake.
+        fail_cache_ttl (``float``, *optional*)
+            Seconds connections from an IP that failed a handshake are frozen with no handshake, 0 disables.
+        memory_budget (``int``, *optional*)
+            Bytes of relay data buffered in write buffers, shared between the sessions, 0 for no limit.
+        write_stall_timeout (``float``, *optional*)
+            Seconds a session writer may hold data without sending any before it's closed, 0 disables.
+        tcp_info_interval (``float``, *optional*)
+            Seconds between two TCP_INFO samples of a sampled session sockets, 0 disables. Linux only.
+        tcp_info_sample (``float``, *optional*)
+            Share of the sessions whose sockets are sampled, between 0 and 1.
+        middle_proxy (``bool``, *optional*)
+            if True, relay through Telegram middle proxies, multiplexing sessions over few connections per DC.
+        middle_proxy_connections (``int``, *optional*)
+            Middle proxy connections per DC.
+        middle_proxy_secret (``str``, *optional*)
+            Middle proxy secret in hex, fetched from Telegram if Ignored.
+        middle_proxies (``dict``, *optional*)
+            Middle proxy (address, port) lists by DC number, fetched from Telegram if Ignored.
+        ad_tag (``str``, *optional*)
+            Promoted channel tag in hex, from @MTProxybot, enables middle_proxy.
         ipv4 (``str``, *optional*)
             IPv4 address to show data. if Ignored, will be Obtained.
         ipv6 (``sre``, *optional*)
             IPv6 address to show data. if Ignored, will be Obtained.
+        ip_discovery (``bool``, *optional*)
+            if True, look the addresses that aren't set up once started.
+        ipv4_url (``str``, *optional*)
+            URL answering with the IPv4 address, public services if Ignored.
+        ipv6_url (``str``, *optional*)
+            URL answering with the IPv6 address, public services if Ignored.
+        ip_cache_file (``str``, *optional*)
+            File the looked up addresses are cached in, no cache if Ignored.
+        ip_cache_ttl (``float``, *optional*)
+            Seconds cached addresses are used for.
     """
 
-    __slots__ = {'config', '_loop', 'server_v4', 'server_v6', 'is_connected', '_disconnected'}
+    # options only applied by a restart, kept by :meth:`reload`
+    RESTART_OPTIONS = ('port', 'listen_addr_ipv4', 'listen_addr_ipv6', 'reply_check_length', 'reply_check_fp_rate',
+                       'reply_check_file', 'dc_pool_size', 'dc_pool_idle_timeout', 'dc_probe_interval',
+                       'datacenters', 'metrics_port', 'metrics_addr', 'user_stats_file', 'crypto_backend',
+                       'handoff_socket', 'ip_prefix_v4', 'ip_prefix_v6', 'middle_proxy', 'middle_proxy_connections',
+                       'middle_proxy_secret', 'middle_proxies', 'ip_discovery', 'ipv4_url', 'ipv6_url',
+                       'ip_cache_file', 'ip_cache_ttl')
+
+    DRAIN_POLL = 0.5
+
+    __slots__ = {'config', 'config_file', '_loop', 'server_v4', 'server_v6', 'is_connected', '_disconnected',
+                 '_handoff', '_discovery'}
 
     def __init__(self,
                  loop=None,
@@ -61,24 +192,64 @@ class MTProxy:
                  client_handshake_timeout: int = 10,
                  client_keepalive: int = 10 * 60,
                  client_ack_timeout: int = 5 * 60,
+                 client_idle_timeout: int = 0,
+                 server_idle_timeout: int = 0,
                  server_connect_timeout: int = 10,
                  to_client_buffer_size: int = 131072,
                  to_server_buffer_size: int = 65536,
+                 min_buffer_size: int = 8192,
+                 to_client_high_watermark: int = 65536,
+                 to_client_low_watermark: int = 16384,
+                 to_server_high_watermark: int = 65536,
+                 to_server_low_watermark: int = 16384,
+                 tcp_nodelay: bool = True,
+                 tcp_notsent_lowat: int = 0,
+                 write_coalesce_window: float = 0,
                  block_mode: bool = True,
                  reply_check_length: int=32768,
+                 reply_check_fp_rate: float=1e-9,
+                 reply_check_file: str=None,
+                 relay_engine: str='stream',
+                 splice: bool=True,
+                 dc_pool_size: int=16,
+                 dc_pool_idle_timeout: int=30,
+                 dc_probe_interval: int=60,
+                 datacenters: dict=None,
+                 metrics_port: int=0,
+                 metrics_addr: str='127.0.0.1',
+                 user_stats_file: str=None,
+                 rate_limit: int=0,
+                 crypto_backend: str='auto',
+                 log_level: str='info',
+                 log_json: bool=False,
+                 log_rate: float=10,
+                 log_sample: int=1,
+                 handoff_socket: str=None,
+                 drain_timeout: int=60,
+                 max_connections: int=0,
+                 max_connections_per_ip: int=0,
+                 ip_connect_rate: float=0,
+                 ip_prefix_v4: int=32,
+                 ip_prefix_v6: int=64,
+                 tarpit_max_connections: int=1000,
+                 tarpit_hold_time: float=60,
+                 fail_cache_ttl: float=30,
+                 memory_budget: int=0,
+                 write_stall_timeout: float=0,
+                 tcp_info_interval: float=0,
+                 tcp_info_sample: float=0.01,
+                 middle_proxy: bool=False,
+                 middle_proxy_connections: int=4,
+                 middle_proxy_secret: str=None,
+                 middle_proxies: dict=None,
+                 ad_tag: str=None,
                  ipv4: str = None,
-                 ipv6: str = None,):
-
-        ip_info = IPInfo()
-
-        if ipv4 is None:
-            ipv4 = ip_info.IPV4
-
-        if ipv6 is None:
-            ipv6 = ip_info.IPV6
-
-        if ipv6 is None:
-            prefer_ipv6 = False
+                 ipv6: str = None,
+                 ip_discovery: bool = True,
+                 ipv4_url: str = None,
+                 ipv6_url: str = None,
+                 ip_cache_file: str = None,
+                 ip_cache_ttl: float = IPInfo.CACHE_TTL,):
 
         self.config = Config(port=port,
                              fast_mode=fast_mode,
@@ -89,16 +260,70 @@ class MTProxy:
                              client_keepalive=client_keepalive,
                              client_handshake_timeout=client_handshake_timeout,
                              client_ack_timeout=client_ack_timeout,
+                             client_idle_timeout=client_idle_timeout,
+                             server_idle_timeout=server_idle_timeout,
                              server_connect_timeout=server_connect_timeout,
                              to_client_buffer_size=to_client_buffer_size,
                              to_server_buffer_size=to_server_buffer_size,
+                             min_buffer_size=min_buffer_size,
+                             to_client_high_watermark=to_client_high_watermark,
+                             to_client_low_watermark=to_client_low_watermark,
+                             to_server_high_watermark=to_server_high_watermark,
+                             to_server_low_watermark=to_server_low_watermark,
+                             tcp_nodelay=tcp_nodelay,
+                             tcp_notsent_lowat=tcp_notsent_lowat,
+                             write_coalesce_window=write_coalesce_window,
                              block_mode=block_mode,
                              reply_check_length=reply_check_length,
+                             reply_check_fp_rate=reply_check_fp_rate,
+                             reply_check_file=reply_check_file,
+                             relay_engine=relay_engine,
+                             splice=splice,
+                             dc_pool_size=dc_pool_size,
+                             dc_pool_idle_timeout=dc_pool_idle_timeout,
+                             dc_probe_interval=dc_probe_interval,
+                             datacenters=datacenters,
+                             metrics_port=metrics_port,
+                             metrics_addr=metrics_addr,
+                             user_stats_file=user_stats_file,
+                             rate_limit=rate_limit,
+                             crypto_backend=crypto_backend,
+                             log_level=log_level,
+                             log_json=log_json,
+                             log_rate=log_rate,
+                             log_sample=log_sample,
+                             handoff_socket=handoff_socket,
+                             drain_timeout=drain_timeout,
+                             max_connections=max_connections,
+                             max_connections_per_ip=max_connections_per_ip,
+                             ip_connect_rate=ip_connect_rate,
+                             ip_prefix_v4=ip_prefix_v4,
+                             ip_prefix_v6=ip_prefix_v6,
+                             tarpit_max_connections=tarpit_max_connections,
+                             tarpit_hold_time=tarpit_hold_time,
+                             fail_cache_ttl=fail_cache_ttl,
+                             memory_budget=memory_budget,
+                             write_stall_timeout=write_stall_timeout,
+                             tcp_info_interval=tcp_info_interval,
+                             tcp_info_sample=tcp_info_sample,
+                             middle_proxy=middle_proxy,
+                             middle_proxy_connections=middle_proxy_connections,
+                             middle_proxy_secret=middle_proxy_secret,
+                             middle_proxies=middle_proxies,
+                             ad_tag=ad_tag,
                              ipv4=ipv4,
-                             ipv6=ipv6)
-
+                             ipv6=ipv6,
+                             ip_discovery=ip_discovery,
+                             ipv4_url=ipv4_url,
+                             ipv6_url=ipv6_url,
+                             ip_cache_file=ip_cache_file,
+                             ip_cache_ttl=ip_cache_ttl)
+
+        self.config_file = None
         self.server_v4 = None
         self.server_v6 = None
+        self._handoff = None
+        self._discovery = None
 
         self._loop = loop if loop else AsyncTools.get_loop()
         self._loop.set_exception_handler(AsyncTools.loop_exception_handler)
@@ -117,24 +342,285 @@ class MTProxy:
 
         self.is_connected = True
 
-        reuse_port = hasattr(socket, "SO_REUSEPORT")
+        self.setup_logging()
+        self.setup_crypto()
+        self.setup_replay_cache()
+        self.setup_accounting()
+        self.setup_middle_proxy()
+
+        listening = {}
+        if self.config.handoff_socket:
+            path = self.config.handoff_socket
+            if self.config.worker_id:
+                path = '%s.%d' % (path, self.config.worker_id)
+            self._handoff = Handoff(path)
+            for sock in self._handoff.receive():
+                if sock.family in listening:
+                    sock.close()
+                else:
+                    listening[sock.family] = sock
+            if listening:
+                log.info('handoff', "Took %d listening sockets over", len(listening))
+
+        if self.config.accounting is not None:
+            self.config.accounting.claim()
+        self.config.metrics = Metrics()
+        self.config.handshake_engine = HandshakeEngine(self.config.users, self.config.secure_only)
+        if Shaper.is_needed(self.config.rate_limit, self.config.users):
+            self.config.shaper = Shaper(self.config.rate_limit, self.config.users)
+        if Admission.is_needed(self.config.max_connections, self.config.max_connections_per_ip,
+                               self.config.ip_connect_rate):
+            self.config.admission = Admission(self.config.max_connections, self.config.max_connections_per_ip,
+                                              self.config.ip_connect_rate, self.config.ip_prefix_v4,
+                                              self.config.ip_prefix_v6, self.config.metrics,
+                                              self.config.workers)
+        self.config.timers = TimingWheel()
+        self.config.tarpit = Tarpit(self.config.tarpit_max_connections, self.config.tarpit_hold_time,
+                                    self.config.fail_cache_ttl, self.config.metrics)
+        if MemoryBudget.is_needed(self.config.memory_budget, self.config.write_stall_timeout):
+            self.config.budget = MemoryBudget(self.config.memory_budget, self.config.write_stall_timeout,
+                                              self.config.metrics)
+        if TCPInfoSampler.is_needed(self.config.tcp_info_interval, self.config.tcp_info_sample):
+            self.config.tcp_info = TCPInfoSampler(self.config.tcp_info_interval, self.config.tcp_info_sample,
+                                                  self.config.metrics)
+        self.config.dc_router = DCRouter(self.config, self.config.datacenters, self.config.dc_probe_interval)
+        if self.config.middle_proxy:
+            self.config.middle_proxy_pool = MiddleProxyPool(self.config, self.config.middle_proxy_connections)
+        elif self.config.dc_pool_size > 0:
+            self.config.dc_pool = TelegramConnectionPool(self.config, self.config.dc_router.connect,
+                                                         self.config.dc_pool_size,
+                                                         self.config.dc_pool_idle_timeout)
 
-        handle_client = partial(ConnectionHandler.create, config=self.config)
+        reuse_port = hasattr(socket, "SO_REUSEPORT")
 
-        c_v4 = asyncio.start_server(handle_client, self.config.listen_addr_ipv4, self.config.port,
-                                    limit=self.config.to_server_buffer_size,
-                                    reuse_port=reuse_port, loop=self._loop)
+        if socket.AF_INET in listening:
+            c_v4 = asyncio.start_server(self._handle_client, sock=listening[socket.AF_INET],
+                                        limit=self.config.to_server_buffer_size)
+        else:
+            c_v4 = asyncio.start_server(self._handle_client, self.config.listen_addr_ipv4, self.config.port,
+                                        limit=self.config.to_server_buffer_size,
+                                        reuse_port=reuse_port)
 
         self.server_v4 = self._loop.run_until_complete(c_v4)
 
-        if socket.has_ipv6:
-            c_v6 = asyncio.start_server(handle_client, self.config.listen_addr_ipv6, self.config.port,
-                                        limit=self.config.to_server_buffer_size, reuse_port=reuse_port, loop=self._loop)
+        if socket.AF_INET6 in listening:
+            c_v6 = asyncio.start_server(self._handle_client, sock=listening[socket.AF_INET6],
+                                        limit=self.config.to_server_buffer_size)
             self.server_v6 = self._loop.run_until_complete(c_v6)
+        elif socket.has_ipv6:
+            c_v6 = asyncio.start_server(self._handle_client, self.config.listen_addr_ipv6, self.config.port,
+                                        limit=self.config.to_server_buffer_size, reuse_port=reuse_port)
+            self.server_v6 = self._loop.run_until_complete(c_v6)
+
+        if self._handoff is not None:
+            self._handoff.confirm()
+            self._handoff.listen(self._listening_sockets, self.drain)
+
+        if self.config.metrics_port:
+            # in a handoff the previous process serves its metrics until it drained
+            self._loop.run_until_complete(self.config.metrics.start_server(
+                self.config.metrics_addr, self.config.metrics_port + self.config.worker_id,
+                reuse_port=reuse_port and self._handoff is not None
+            ))
 
         if self._disconnected is None or self._disconnected.done():
             self._disconnected = self._loop.create_future()
 
+        if self.config.middle_proxy_pool is None:
+            self._loop.call_soon(self.config.dc_router.start)
+        if self.config.dc_pool is not None:
+            self._loop.call_soon(self.config.dc_pool.start)
+        if self.config.shaper is not None:
+            self._loop.call_soon(self.config.shaper.start)
+        if self.config.budget is not None:
+            self._loop.call_soon(self.config.budget.start)
+        if self.config.tcp_info is not None:
+            self._loop.call_soon(self.config.tcp_info.start)
+        self._loop.call_soon(self.config.timers.start)
+
+        # looked up once listening, unless done by setup_ip_info before forking workers
+        if self._discovery is None and IPInfo.is_needed(self.config.ip_discovery, self.config.ipv4,
+                                                        self.config.ipv6):
+            self._discovery = self._loop.create_task(self.discover_ip())
+        else:
+            if self.config.ipv6 is None:
+                self.config.prefer_ipv6 = False
+            self._discovery = self._loop.create_future()
+            self._discovery.set_result(None)
+        if self.config.middle_proxy_pool is not None:
+            # middle proxy keys are derived from the external addresses
+            self.config.middle_proxy_pool.discovery = self._discovery
+
+        if self.config_file and hasattr(signal, 'SIGHUP'):
+            self._loop.add_signal_handler(signal.SIGHUP, self.reload)
+
+    @property
+    def ip_discovery(self) -> asyncio.Future:
+        """Done once the external addresses are known, after :meth:`start`"""
+        return self._discovery
+
+    def setup_ip_info(self):
+        """Look the external addresses up now, e.g. once for all the workers before forking them"""
+        if self._discovery is not None:
+            return
+
+        if IPInfo.is_needed(self.config.ip_discovery, self.config.ipv4, self.config.ipv6):
+            self._loop.run_until_complete(self.discover_ip())
+        elif self.config.ipv6 is None:
+            self.config.prefer_ipv6 = False
+        self._discovery = self._loop.create_future()
+        self._discovery.set_result(None)
+
+    async def discover_ip(self):
+        """Look the external addresses that aren't set up"""
+        config = self.config
+        ip_info = IPInfo(config.ipv4_url, config.ipv6_url, config.ip_cache_file, config.ip_cache_ttl)
+        ipv4, ipv6 = await ip_info.discover(not config.ipv4, not config.ipv6)
+
+        # the config may have been reloaded meanwhile
+        config = self.config
+        if not config.ipv4:
+            config.ipv4 = ipv4
+        if not config.ipv6:
+            config.ipv6 = ipv6
+        if not config.ipv6:
+            config.prefer_ipv6 = False
+        elif config.prefer_ipv6:
+            log.info('ip_info', "IPv6 found, using it for external communication")
+        if config.ipv6 and config.dc_router is not None and config.datacenters is None:
+            # the router was made before the lookup, with the IPv4 Data Centers only
+            config.dc_router.add_endpoints(DataCenter.endpoints(ipv6=True))
+        log.info('ip_info', "External addresses: IPv4 %s, IPv6 %s", config.ipv4, config.ipv6)
+
+    def _listening_sockets(self) -> list:
+        return [sock for server in (self.server_v4, self.server_v6) if server for sock in server.sockets]
+
+    def drain(self, timeout: int = None):
+        """Stop accepting connections and disconnect once established sessions are finished
+
+        Args:
+            timeout (``int``, *optional*)
+                Max seconds to wait for the sessions, ``drain_timeout`` if Ignored.
+        """
+        if timeout is None:
+            timeout = self.config.drain_timeout
+
+        for server in (self.server_v4, self.server_v6):
+            if server:
+                server.close()
+        if self.config.dc_pool is not None:
+            self.config.dc_pool.close()
+        self.config.metrics.close()
+
+        log.info('drain', "Stopped accepting, draining %d sessions", self.config.metrics.connections_active.value)
+        self._check_drained(self._loop.time() + timeout)
+
+    def _check_drained(self, deadline: float):
+        if self.config.metrics.connections_active.value and self._loop.time() < deadline:
+            self.config.timers.arm(MTProxy.DRAIN_POLL, self._check_drained, deadline)
+            return
+
+        log.info('drained', "Drained, %d sessions left", self.config.metrics.connections_active.value)
+        if self._disconnected is not None and not self._disconnected.done():
+            self._disconnected.set_result(None)
+
+    def _handle_client(self, reader, writer):
+        # the config is looked up per connection, so reloads apply to new connections only
+        config = self.config
+        peer = writer.get_extra_info('peername')
+        if not peer:
+            writer.transport.abort()
+            return None
+
+        # repeat offenders and over limit connections are handled before a task or any handshake state is made
+        if config.tarpit.recently_failed(peer[0]):
+            if not config.tarpit.hold(writer.transport):
+                writer.transport.abort()
+            return None
+        if config.admission is None:
+            return ConnectionHandler.create(reader, writer, config=config)
+        if not config.admission.admit(peer[0]):
+            writer.transport.abort()
+            return None
+        return ConnectionHandler.create(reader, writer, config=config, admitted=peer[0])
+
+    def setup_logging(self):
+        """Apply the log settings"""
+        log.setup(self.config.log_level, self.config.log_json, self.config.log_rate, self.config.log_sample)
+
+    def setup_crypto(self):
+        """Select the AES-CTR backend, calibrating the installed ones in 'auto' mode"""
+        if AES.backend is not None:
+            return
+
+        backend = AES.select(self.config.crypto_backend)
+        log.info('crypto_backend', "Using the %s crypto backend", backend.name)
+
+    def setup_replay_cache(self):
+        """Replace the in-process used handshakes cache by a fixed-memory :class:`ReplayCache`"""
+        if isinstance(Keys.used_dec_keys, ReplayCache):
+            return
+
+        Keys.used_dec_keys = ReplayCache(self.config.reply_check_length,
+                                         fp_rate=self.config.reply_check_fp_rate,
+                                         path=self.config.reply_check_file)
+
+    def setup_middle_proxy(self):
+        """Fetch the middle proxy secret and addresses from Telegram, unless configured
+
+        Raises:
+            :class:`ConnectionError`: if they can't be fetched.
+            :class:`ValueError`: if ``ad_tag`` is not valid.
+        """
+        if self.config.ad_tag:
+            parse_ad_tag(self.config.ad_tag)
+        if self.config.ad_tag and not self.config.middle_proxy:
+            self.config.middle_proxy = True
+        if not self.config.middle_proxy:
+            return
+
+        if not self.config.middle_proxy_secret:
+            secret = fetch_proxy_secret()
+            if not secret:
+                raise ConnectionError("Failed to fetch the middle proxy secret")
+            self.config.middle_proxy_secret = secret.hex()
+        if not self.config.middle_proxies:
+            self.config.middle_proxies = fetch_middle_proxies()
+            if not self.config.middle_proxies:
+                raise ConnectionError("Failed to fetch the middle proxy addresses")
+
+    def setup_accounting(self, workers: int = 1):
+        """Open the per user counters file, with segments for ``workers`` processes and their handoff successors"""
+        if self.config.accounting is not None or not self.config.user_stats_file:
+            return
+
+        self.config.accounting = UserAccounting(self.config.user_stats_file, self.config.users, workers)
+
+    def run_workers(self, workers: int):
+        """Run the proxy in ``workers`` forked processes sharing the listening port
+
+        Args:
+            workers (``int``)
+                Number of worker processes.
+
+        Raises:
+            :class:`RuntimeError`: if ``SO_REUSEPORT`` or ``fork`` is not available.
+        """
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise RuntimeError("Worker mode requires SO_REUSEPORT")
+
+        Supervisor(self, workers).run()
+
+    def reset_loop(self):
+        """Replace the event loop by a fresh one, used in forked worker processes"""
+        if self.is_connected:
+            raise ConnectionError("Can't replace the loop of a started proxy")
+
+        self._loop.close()
+        self._loop = AsyncTools.new_loop()
+        self._loop.set_exception_handler(AsyncTools.loop_exception_handler)
+        self._disconnected = None
+
     def run_until_disconnected(self):
         if self._loop.is_running():
             return self.disconnected
@@ -147,7 +633,7 @@ class MTProxy:
 
     @property
     def disconnected(self):
-        return asyncio.shield(self._disconnected, loop=self._loop)
+        return asyncio.shield(self._disconnected)
 
     def disconnect(self):
 
@@ -156,12 +642,38 @@ class MTProxy:
 
         self.is_connected = False
 
+        if self.config_file and hasattr(signal, 'SIGHUP'):
+            self._loop.remove_signal_handler(signal.SIGHUP)
+
         if self.server_v4:
             self.server_v4.close()
 
         if self.server_v6:
             self.server_v6.close()
 
+        self.config.dc_router.close()
+        if self.config.dc_pool is not None:
+            self.config.dc_pool.close()
+        if self.config.middle_proxy_pool is not None:
+            self.config.middle_proxy_pool.close()
+
+        self.config.metrics.close()
+        if self.config.shaper is not None:
+            self.config.shaper.close()
+        if self._handoff is not None:
+            self._handoff.close()
+            self._handoff = None
+        self.config.tarpit.close()
+        if self.config.budget is not None:
+            self.config.budget.close()
+        if self.config.tcp_info is not None:
+            self.config.tcp_info.close()
+        self.config.timers.close()
+        if self._discovery is not None and not self._discovery.done():
+            self._discovery.cancel()
+        if self.config.accounting is not None:
+            self.config.accounting.flush()
+
         # if self._disconnected and not self._disconnected.done():
         #    self._disconnected.set_result(None)
 
@@ -172,19 +684,121 @@ class MTProxy:
             config_file (``str``)
                 config file path
         """
+        users = MTProxy._read_file(self.config, config_file)
+        if users is not None:
+            self.config.users.extend(users)
+        self.config_file = config_file
+
+    def reload(self, config_file: str = None) -> bool:
+        """Reload config data and users from file, e.g. on SIGHUP
+
+        The users and the handshake index are swapped at once, new connections get the new
+        settings and users while established sessions keep the ones they started with.
+        Options in ``RESTART_OPTIONS`` keep their current values until a restart.
+
+        Args:
+            config_file (``str``, *optional*)
+                config file path, the last loaded one if Ignored.
+
+        Return:
+            ``bool``: True if the config was reloaded, False if the file could not be read.
+        """
+        config_file = config_file or self.config_file
+        if not config_file:
+            raise ValueError("No config file to reload")
+
+        config = copy.copy(self.config)
+        try:
+            config.users = MTProxy._read_file(config, config_file)
+        except (ValueError, ConfigError) as e:
+            log.error('reload_failed', "Failed to reload %s: %s", config_file, e)
+            return False
+        if config.users is None:
+            log.error('reload_failed', "Failed to reload %s: can't read the file", config_file)
+            return False
+
+        for option in MTProxy.RESTART_OPTIONS:
+            if getattr(config, option) != getattr(self.config, option):
+                log.warning('reload_restart', "%s change is applied after a restart", option)
+                setattr(config, option, getattr(self.config, option))
+
+        if self.is_connected:
+            config.handshake_engine = HandshakeEngine(config.users, config.secure_only)
+            if config.shaper is not None:
+                config.shaper.update(config.rate_limit, config.users)
+            elif Shaper.is_needed(config.rate_limit, config.users):
+                config.shaper = Shaper(config.rate_limit, config.users)
+                config.shaper.start()
+            if config.admission is not None:
+                config.admission.update(config.max_connections, config.max_connections_per_ip,
+                                        config.ip_connect_rate)
+            elif Admission.is_needed(config.max_connections, config.max_connections_per_ip,
+                                     config.ip_connect_rate):
+                config.admission = Admission(config.max_connections, config.max_connections_per_ip,
+                                             config.ip_connect_rate, config.ip_prefix_v4, config.ip_prefix_v6,
+                                             config.metrics, config.workers)
+            config.tarpit.update(config.tarpit_max_connections, config.tarpit_hold_time, config.fail_cache_ttl)
+            if config.budget is not None:
+                config.budget.update(config.memory_budget, config.write_stall_timeout)
+            elif MemoryBudget.is_needed(config.memory_budget, config.write_stall_timeout):
+                config.budget = MemoryBudget(config.memory_budget, config.write_stall_timeout, config.metrics)
+                config.budget.start()
+            if config.tcp_info is not None:
+                config.tcp_info.update(config.tcp_info_interval, config.tcp_info_sample)
+            elif TCPInfoSampler.is_needed(config.tcp_info_interval, config.tcp_info_sample):
+                config.tcp_info = TCPInfoSampler(config.tcp_info_interval, config.tcp_info_sample, config.metrics)
+                config.tcp_info.start()
+            config.dc_router.config = config
+            if config.dc_pool is not None:
+                config.dc_pool.config = config
+            if config.middle_proxy_pool is not None:
+                config.middle_proxy_pool.config = config
+                config.middle_proxy_pool.ad_tag = parse_ad_tag(config.ad_tag) if config.ad_tag else None
+
+        self.config = config
+        self.config_file = config_file
+        self.setup_logging()
+        log.info('reload', "Reloaded %s, %d users", config_file, len(config.users))
+        return True
+
+    @staticmethod
+    def _read_file(config: Config, config_file: str):
+        """Apply the file settings to ``config``
+
+        Return:
+            ``list``: users of the file, None if the file could not be read.
+        """
         parser = ConfigParser()
-        parser.read(config_file)
+        if not parser.read(config_file):
+            return None
 
         settings = {
             str: [
-                "listen_addr_ipv4", "listen_addr_ipv6", "ipv4", "ipv6"
+                "listen_addr_ipv4", "listen_addr_ipv6", "ipv4", "ipv6", "reply_check_file", "relay_engine",
+                "metrics_addr", "user_stats_file", "crypto_backend", "log_level", "handoff_socket",
+                "middle_proxy_secret", "ad_tag", "ipv4_url", "ipv6_url", "ip_cache_file"
             ],
             int: [
-                "port", "to_client_buffer_size", "to_server_buffer_size",
-                "client_keepalive", "client_handshake_timeout", "client_ack_timeout", "server_connect_timeout"
+                "port", "to_client_buffer_size", "to_server_buffer_size", "min_buffer_size", "tcp_notsent_lowat",
+                "to_client_high_watermark", "to_client_low_watermark", "to_server_high_watermark",
+                "to_server_low_watermark",
+                "client_keepalive", "client_handshake_timeout", "client_ack_timeout", "server_connect_timeout",
+                "client_idle_timeout", "server_idle_timeout",
+                "reply_check_length", "dc_pool_size", "dc_pool_idle_timeout", "dc_probe_interval",
+                "metrics_port", "log_sample", "drain_timeout", "max_connections", "max_connections_per_ip",
+                "ip_prefix_v4", "ip_prefix_v6", "tarpit_max_connections", "middle_proxy_connections"
+            ],
+            float: [
+                "reply_check_fp_rate", "log_rate", "ip_connect_rate", "tarpit_hold_time", "fail_cache_ttl",
+                "write_stall_timeout", "ip_cache_ttl", "write_coalesce_window", "tcp_info_interval",
+                "tcp_info_sample"
             ],
             bool: [
-                "prefer_ipv6", "fast_mode", "secure_only", "block_mode"
+                "prefer_ipv6", "fast_mode", "secure_only", "block_mode", "splice", "log_json", "middle_proxy",
+                "ip_discovery", "tcp_nodelay"
+            ],
+            parse_rate: [
+                "rate_limit", "memory_budget"
             ],
         }
         if parser.has_section("mtproxy"):
@@ -192,12 +806,31 @@ class MTProxy:
                 for option in options:
                     value = parser.get("mtproxy", option, fallback=None)
                     if value is not None:
-                        setattr(self.config, option, order(value))
-
+                        if order is bool:
+                            value = parser.getboolean("mtproxy", option)
+                        setattr(config, option, order(value))
+        if config.ad_tag:
+            # rejected here rather than on every session
+            parse_ad_tag(config.ad_tag)
+
+        if parser.has_section("mtproxy:datacenters"):
+            config.datacenters = {
+                int(dc): parse_endpoints(value) for dc, value in parser.items("mtproxy:datacenters")
+            }
+
+        if parser.has_section("mtproxy:middle_proxies"):
+            config.middle_proxies = {
+                int(dc): parse_endpoints(value) for dc, value in parser.items("mtproxy:middle_proxies")
+            }
+
+        users = []
         if parser.has_section("mtproxy:users"):
-            self.config.users.extend(
-                [User(name, key) for name, key in parser._sections["mtproxy:users"].items() if name != "__name__"]
-            )
+            for name, value in parser._sections["mtproxy:users"].items():
+                if name == "__name__":
+                    continue
+                secret, _, rate = value.partition(" ")
+                users.append(User(name, secret, parse_rate(rate) if rate.strip() else None))
+        return users
 
     def show_data(self):
         """Print Proxy information"""
@@ -217,5 +850,4 @@ class MTProxy:
                 print("{}: tg://proxy?{}".format(name, params_encodeded))
 
             if secret in ["00000000000000000000000000000000", "0123456789abcdef0123456789abcdef"]:
-                msg = "The default secret {} is used, this is not recommended".format(secret)
-                print(msg)
+                log.warning('default_secret', "The default secret %s is used, this is not recommended", secret)
@@ -0,0 +1,178 @@
+import asyncio
+import collections
+
+
+class TokenBucket:
+    """Byte rate limit, refilled by the :class:`Shaper` timer.
+
+    Relayed bytes are taken after they are sent, so the bucket may go in debt, readers
+    wait until it is paid back.
+
+    Args:
+        rate (``int``)
+            Bytes per second.
+        burst (``int``)
+            Max tokens kept.
+    """
+
+    __slots__ = {'rate', 'burst', 'tokens', '_waiters'}
+
+    def __init__(self, rate: int, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self._waiters = collections.deque()
+
+    def call_when_ready(self, callback):
+        """Call ``callback`` once the bucket is out of debt"""
+        self._waiters.append(callback)
+
+    def wait(self) -> asyncio.Future:
+        ready = asyncio.get_event_loop().create_future()
+        self._waiters.append(lambda: ready.done() or ready.set_result(None))
+        return ready
+
+    def unlimit(self):
+        """Lift the limit, for sessions still holding a removed bucket"""
+        self.burst = self.tokens = float('inf')
+        self.refill(0)
+
+    def refill(self, tokens: float):
+        self.tokens = min(self.burst, self.tokens + tokens)
+        while self._waiters and self.tokens >= 0:
+            self._waiters.popleft()()
+
+
+class Shaper:
+    """Global and per user bandwidth limits, per direction.
+
+    Every limit is a :class:`TokenBucket` per direction, all of them are refilled by a
+    single timer ticking every ``TICK`` seconds, sessions don't run timers of their own.
+    A throttled session stops reading its source transport until its buckets are out
+    of debt.
+
+    Args:
+        rate (``int``)
+            Global bytes per second in each direction, 0 for no limit.
+        users (``list``)
+            :class:`mtproxy.utils.User` list, users with a ``rate`` get their own limit.
+    """
+
+    TICK = 0.05
+    BURST = 1
+
+    __slots__ = {'rate', 'global_buckets', 'user_buckets', '_handle', '_last'}
+
+    def __init__(self, rate: int, users: list):
+        self.rate = rate
+        self.global_buckets = Shaper._buckets(rate) if rate else ()
+        self.user_buckets = {user.name: Shaper._buckets(user.rate) for user in users if user.rate}
+        self._handle = None
+        self._last = None
+
+    def update(self, rate: int, users: list):
+        """Apply new limits, buckets of established sessions are updated in place"""
+        self.rate = rate
+        self.global_buckets = Shaper._update_buckets(self.global_buckets, rate)
+        user_buckets = {}
+        for user in users:
+            if user.rate:
+                user_buckets[user.name] = Shaper._update_buckets(self.user_buckets.pop(user.name, ()), user.rate)
+        for buckets in self.user_buckets.values():
+            Shaper._update_buckets(buckets, 0)
+        self.user_buckets = user_buckets
+
+    @classmethod
+    def is_needed(cls, rate: int, users: list) -> bool:
+        return bool(rate) or any(user.rate for user in users)
+
+    def start(self):
+        if self._handle is None:
+            loop = asyncio.get_event_loop()
+            self._last = loop.time()
+            self._handle = loop.call_later(Shaper.TICK, self._tick)
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def buckets(self, user) -> tuple:
+        """Buckets of a user session
+
+        Return:
+            ``tuple``: (client to Telegram buckets, Telegram to client buckets)
+        """
+        to_server, to_client = (), ()
+        for buckets in (self.global_buckets, self.user_buckets.get(user.name, ())):
+            if buckets:
+                to_server += (buckets[0],)
+                to_client += (buckets[1],)
+        return to_server, to_client
+
+    def _tick(self):
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        elapsed, self._last = now - self._last, now
+        for buckets in (self.global_buckets, *self.user_buckets.values()):
+            for bucket in buckets:
+                bucket.refill(bucket.rate * elapsed)
+        self._handle = loop.call_later(Shaper.TICK, self._tick)
+
+    @staticmethod
+    def _buckets(rate: int) -> tuple:
+        return tuple(TokenBucket(rate, rate * Shaper.BURST) for _ in range(2))
+
+    @staticmethod
+    def _update_buckets(buckets: tuple, rate: int) -> tuple:
+        if not rate:
+            for bucket in buckets:
+                bucket.unlimit()
+            return ()
+        if not buckets:
+            return Shaper._buckets(rate)
+        for bucket in buckets:
+            bucket.rate = rate
+            bucket.burst = rate * Shaper.BURST
+        return buckets
+
+
+async def throttle(transport, buckets: tuple, nbytes: int):
+    """Take relayed bytes from buckets, wait with ``transport`` reading paused while any is in debt"""
+    for bucket in buckets:
+        bucket.tokens -= nbytes
+    for bucket in buckets:
+        if bucket.tokens < 0:
+            break
+    else:
+        return
+
+    # a transport the stream reader paused for its buffer limit is left for it to resume
+    paused = transport is not None and _is_reading(transport)
+    if paused:
+        transport.pause_reading()
+    try:
+        for bucket in buckets:
+            while bucket.tokens < 0:
+                await bucket.wait()
+    finally:
+        if paused and not transport.is_closing():
+            transport.resume_reading()
+
+
+def _is_reading(transport) -> bool:
+    method = getattr(transport, 'is_reading', None)
+    if method is not None:
+        return method()
+    # Python < 3.7 transports have no is_reading, selector ones keep the state
+    return not getattr(transport, '_paused', False)
+
+
+def parse_rate(value: str) -> int:
+    """Parse a bytes per second rate, with an optional K, M or G binary suffix"""
+    value = value.strip().upper()
+    multiplier = 1
+    if value and value[-1] in 'KMG':
+        multiplier = 1024 ** ('KMG'.index(value[-1]) + 1)
+        value = value[:-1]
+    return int(float(value) * multiplier)
@@ -1,2 +1,5 @@
 from .client_steam_protocol import ClientSteamProtocol
 from .server_steam_protocol import ServerStreamProtocol
+from .relay_protocol import Relay, RelayProtocol, BufferPool
+from .read_sizer import ReadSizer
+from .write_coalescer import WriteCoalescer
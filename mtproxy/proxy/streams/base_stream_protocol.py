@@ -1,6 +1,11 @@
 import asyncio
+from socket import SOL_SOCKET, SO_SNDBUF
 from ...config import Config
-from ...utils import set_keepalive, set_ack_timeout, set_bufsizes
+from ...utils import set_keepalive, set_ack_timeout, set_bufsizes, set_nodelay, set_notsent_lowat, log
+from ...utils.socket_settings import try_setsockopt
+from ..shaper import throttle
+from .read_sizer import ReadSizer
+from .write_coalescer import WriteCoalescer
 
 
 class BaseStreamProtocol:
@@ -26,36 +31,80 @@ class BaseStreamProtocol:
     def writer(self) -> asyncio.StreamWriter:
         return self._stream_writer
 
-    def init_socket(self, ack: bool=False):
+    def init_socket(self, ack: bool=False, write_limits: tuple=None):
+        """Apply the socket options, and the ``(high, low)`` watermarks of the writes to this stream"""
+        if write_limits is not None:
+            high, low = write_limits
+            self.writer.transport.set_write_buffer_limits(high, min(low, high))
         socket = self.writer.get_extra_info("socket")
         set_keepalive(socket, self.config.client_keepalive, attempts=3)
         if ack:
             set_ack_timeout(socket, self.config.client_ack_timeout)
-        set_bufsizes(socket, self.config.to_server_buffer_size, self.config.to_client_buffer_size)
+        set_nodelay(socket, self.config.tcp_nodelay)
+        if self.config.tcp_notsent_lowat:
+            set_notsent_lowat(socket, self.config.tcp_notsent_lowat)
+        max_buffer_size = max(self.config.to_client_buffer_size, self.config.to_server_buffer_size)
+        if self.config.min_buffer_size < max_buffer_size and not self.config.middle_proxy:
+            # relays grow the send buffer as needed, the kernel tunes the receive one
+            try_setsockopt(socket, SOL_SOCKET, SO_SNDBUF, self.config.min_buffer_size)
+        else:
+            set_bufsizes(socket, self.config.to_server_buffer_size, self.config.to_client_buffer_size)
+
+    def read_sizer(self, writer, max_size: int) -> ReadSizer:
+        """Read size of the direction from this stream to ``writer``"""
+        return ReadSizer(self.config.min_buffer_size, max_size, writer.transport.get_extra_info('socket'),
+                         self.config.budget)
+
+    def write_coalescer(self, writer):
+        """Coalescer of the writes from this stream to ``writer``, None if disabled"""
+        if not (self.config.write_coalesce_window and WriteCoalescer.is_supported()):
+            return None
+        return WriteCoalescer(writer.transport.get_extra_info('socket'), self.config.write_coalesce_window)
 
     async def handle_handshake(self, *args, **kwargs):
         raise NotImplementedError
 
-    async def reply_stream(self,n,  writer, read_buffer_size, block_if_first_pkt_bad=False):
+    async def reply_stream(self,n,  writer, read_buffer_size, block_if_first_pkt_bad=False, counters=(), buckets=(),
+                           idle=None):
         is_first_pkt = True
+        sizer = self.read_sizer(writer, read_buffer_size)
+        coalescer = self.write_coalescer(writer)
+        transport = writer.transport
         try:
             while True:
-                data = await self.reader.read(read_buffer_size)
+                size = sizer.size
+                data = await self.reader.read(size)
+                sizer.update(len(data))
                 # protection against replay-based fingerprinting
                 if is_first_pkt:
                     is_first_pkt = False
                     if block_if_first_pkt_bad and data == BaseStreamProtocol.ERROR_PACKET_DATA:
-                        print("Active fingerprinting detected from %s, dropping it" % self.ip)
+                        self.config.metrics.first_packet_dropped.value += 1
+                        log.warning('fingerprint', "Active fingerprinting detected from %s, dropping it", self.ip)
                         break
                 if data:
+                    if idle is not None:
+                        idle.touch()
+                    for counter in counters:
+                        counter.value += len(data)
                     writer.write(data)
-                    await writer.drain()
+                    if coalescer is not None:
+                        coalescer.written(len(data), size)
+                    # the transport is paused over its high-water mark, a closing one raises there
+                    if transport.get_write_buffer_size() > transport.get_write_buffer_limits()[1] or \
+                            transport.is_closing():
+                        await writer.drain()
+                    if buckets:
+                        await throttle(self.writer.transport, buckets, len(data))
                 else:
-                    print("Finished %s" % n)
+                    log.debug('session_finished', "Finished %s", n)
                     break
             writer.write_eof()
             await writer.drain()
 
-        except (OSError, asyncio.streams.IncompleteReadError) as e:
-            print(e, n)
+        except (OSError, asyncio.IncompleteReadError) as e:
+            log.debug('session_error', "Session %s closed: %s", n, e)
             pass
+        finally:
+            if coalescer is not None:
+                coalescer.flush()
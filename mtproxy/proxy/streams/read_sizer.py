@@ -0,0 +1,80 @@
+import time
+import socket
+from ...utils.socket_settings import try_setsockopt
+
+
+class ReadSizer:
+    """Read size of one relay direction, adapted to its traffic.
+
+    The size doubles each time a read fills it, up to ``max_size``, and halves after
+    ``SHRINK_AFTER`` reads in a row using less than a quarter of it, down to ``min_size``.
+    A read after ``IDLE`` seconds without any starts over from ``min_size``. The send
+    buffer of the destination socket follows the size, so bulk transfers get large
+    buffers and idle or interactive sessions keep small ones. Receive buffers are left
+    to the kernel autotuning, shrinking them on an established connection makes the
+    peer overrun the window it was given. With a memory budget, the size is at most the
+    budget share of a write buffer.
+
+    Args:
+        min_size (``int``)
+            Smallest read size.
+        max_size (``int``)
+            Largest read size, the size is fixed if not above ``min_size``.
+        destination (:class:`socket.socket`, *optional*)
+            Socket written to.
+        budget (:class:`mtproxy.proxy.memory_budget.MemoryBudget`, *optional*)
+            Memory budget the size is capped by.
+    """
+
+    SHRINK_AFTER = 8
+    IDLE = 1.0
+
+    __slots__ = {'min_size', 'max_size', 'size', 'destination', 'budget', '_small', '_last'}
+
+    def __init__(self, min_size: int, max_size: int, destination=None, budget=None):
+        self.min_size = min(min_size, max_size)
+        self.max_size = max_size
+        self.size = self.min_size
+        self.destination = destination
+        self.budget = budget
+        self._small = 0
+        self._last = 0.0
+
+    @property
+    def adaptive(self) -> bool:
+        return self.min_size < self.max_size
+
+    def update(self, nbytes: int):
+        """Account a read of ``nbytes``"""
+        if not self.adaptive:
+            return
+        now = time.monotonic()
+        idle, self._last = now - self._last > ReadSizer.IDLE, now
+
+        size = self.size
+        max_size = self.max_size
+        if self.budget is not None:
+            max_size = max(self.min_size, min(max_size, self.budget.share))
+            if size > max_size:
+                self.resize(max_size)
+                return
+        if nbytes >= size:
+            self._small = 0
+            if size < max_size:
+                self.resize(min(size * 2, max_size))
+        elif idle and size > self.min_size:
+            self._small = 0
+            self.resize(self.min_size)
+        elif nbytes < size >> 2:
+            self._small += 1
+            if self._small >= ReadSizer.SHRINK_AFTER:
+                self._small = 0
+                if size > self.min_size:
+                    self.resize(max(size >> 1, self.min_size))
+        else:
+            self._small = 0
+
+    def resize(self, size: int):
+        self.size = size
+        if self.destination is not None:
+            try_setsockopt(self.destination, socket.SOL_SOCKET, socket.SO_SNDBUF, size)
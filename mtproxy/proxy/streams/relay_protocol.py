@@ -0,0 +1,281 @@
+import asyncio
+from .base_stream_protocol import BaseStreamProtocol
+from .read_sizer import ReadSizer
+from ...utils import log
+
+
+class BufferPool:
+    """Pool of preallocated receive buffers of a single size.
+
+    Buffers are taken for one ``get_buffer``/``buffer_updated`` round only, so idle
+    connections don't hold any.
+
+    Args:
+        size (``int``)
+            Usable buffer size.
+        max_free (``int``, *optional*)
+            Max number of free buffers to keep.
+    """
+
+    # cipher update_into() needs len(data) + block_size - 1 bytes of output
+    CIPHER_SLACK = 15
+
+    _pools = {}
+
+    __slots__ = {'size', 'max_free', '_free'}
+
+    def __init__(self, size: int, max_free: int = 1024):
+        self.size = size
+        self.max_free = max_free
+        self._free = []
+
+    @classmethod
+    def of_size(cls, size: int) -> 'BufferPool':
+        pool = cls._pools.get(size)
+        if pool is None:
+            pool = cls._pools[size] = cls(size)
+        return pool
+
+    def acquire(self) -> bytearray:
+        if self._free:
+            return self._free.pop()
+        return bytearray(self.size + BufferPool.CIPHER_SLACK)
+
+    def release(self, buffer: bytearray):
+        if len(self._free) < self.max_free:
+            self._free.append(buffer)
+
+
+class RelayProtocol(asyncio.BufferedProtocol):
+    """One direction of a :class:`Relay`, reads its transport and writes to the peer one.
+
+    Received data is decrypted and re-encrypted in place, in the pooled buffer it was
+    received into.
+
+    Args:
+        relay (:class:`Relay`)
+            Owning relay.
+        transport (:class:`asyncio.Transport`)
+            Transport to read from.
+        pool (:class:`BufferPool`)
+            Receive buffers pool.
+        sizer (:class:`ReadSizer`)
+            Receive size, up to the pool buffers size.
+        decryptor (:class:`mtproxy.mtproto.AES`)
+            Incoming data decryptor, None to pass data as is.
+        encryptor (:class:`mtproxy.mtproto.AES`)
+            Outgoing data encryptor, None to pass data as is.
+        counters (``tuple``, *optional*)
+            :class:`mtproxy.proxy.metrics.Counter` like relayed bytes counters.
+        buckets (``tuple``, *optional*)
+            :class:`mtproxy.proxy.shaper.TokenBucket` rate limits, reading is paused while any is in debt.
+        idle (:class:`mtproxy.proxy.timing_wheel.Timer`, *optional*)
+            Idle timeout, touched when data is received.
+        coalescer (:class:`mtproxy.proxy.streams.WriteCoalescer`, *optional*)
+            Holds small writes to the peer back.
+        header (``bytes``, *optional*)
+            Sent to the peer with the first data.
+        block_if_first_pkt_bad (``bool``, *optional*)
+            if True, drop the connection if the first packet is bad.
+    """
+
+    __slots__ = {'relay', 'transport', 'peer', 'pool', 'sizer', 'decryptor', 'encryptor', 'counters', 'buckets',
+                 'idle', 'coalescer', 'header', 'buffer', 'is_first_pkt', 'throttled', 'backpressured'}
+
+    def __init__(self, relay, transport, pool: BufferPool, sizer: ReadSizer, decryptor=None, encryptor=None,
+                 counters=(), buckets=(), idle=None, coalescer=None, header: bytes = None,
+                 block_if_first_pkt_bad: bool = False):
+        self.relay = relay
+        self.transport = transport
+        self.peer = None
+        self.pool = pool
+        self.sizer = sizer
+        self.decryptor = decryptor
+        self.encryptor = encryptor
+        self.counters = counters
+        self.buckets = buckets
+        self.idle = idle
+        self.coalescer = coalescer
+        self.header = header
+        self.buffer = None
+        self.is_first_pkt = block_if_first_pkt_bad
+        self.throttled = False
+        self.backpressured = False
+
+    def get_buffer(self, sizehint):
+        if self.buffer is None:
+            self.buffer = self.pool.acquire()
+        return memoryview(self.buffer)[:self.sizer.size]
+
+    def buffer_updated(self, nbytes):
+        buffer, self.buffer = self.buffer, None
+        size = self.sizer.size
+        self.sizer.update(nbytes)
+        self.relay_data(buffer, nbytes)
+        if self.coalescer is not None:
+            self.coalescer.written(nbytes, size)
+
+    def feed(self, data: bytes):
+        """Relay data received before the protocol was attached"""
+        size = self.pool.size
+        for start in range(0, len(data), size):
+            chunk = data[start:start + size]
+            buffer = self.pool.acquire()
+            buffer[:len(chunk)] = chunk
+            self.relay_data(buffer, len(chunk))
+
+    def relay_data(self, buffer: bytearray, nbytes: int):
+        data = memoryview(buffer)[:nbytes]
+        if self.decryptor is not None:
+            self.decryptor.decrypt_into(data, buffer)
+
+        # protection against replay-based fingerprinting
+        if self.is_first_pkt:
+            self.is_first_pkt = False
+            if data == BaseStreamProtocol.ERROR_PACKET_DATA:
+                self.relay.metrics.first_packet_dropped.value += 1
+                log.warning('fingerprint', "Active fingerprinting detected from %s, dropping it", self.relay.client_ip)
+                self.relay.close()
+                return
+
+        if self.encryptor is not None:
+            self.encryptor.encrypt_into(data, buffer)
+
+        if self.idle is not None:
+            self.idle.touch()
+        for counter in self.counters:
+            counter.value += nbytes
+
+        peer_transport = self.peer.transport
+        if self.header is not None:
+            data, self.header = self.header + data, None
+        peer_transport.write(data)
+        # a transport may keep a reference to data it couldn't send yet
+        if not peer_transport.get_write_buffer_size():
+            self.pool.release(buffer)
+
+        if self.buckets:
+            for bucket in self.buckets:
+                bucket.tokens -= nbytes
+            self.check_tokens()
+
+    def check_tokens(self):
+        """Pause reading while a rate limit is in debt, resume it once all are paid back"""
+        for bucket in self.buckets:
+            if bucket.tokens < 0:
+                if not self.throttled:
+                    self.throttled = True
+                    self.transport.pause_reading()
+                bucket.call_when_ready(self.check_tokens)
+                return
+
+        if self.throttled:
+            self.throttled = False
+            if not self.backpressured:
+                self.transport.resume_reading()
+
+    def eof_received(self):
+        self.peer.transport.close()
+        return False
+
+    def connection_lost(self, exc):
+        if self.buffer is not None:
+            self.pool.release(self.buffer)
+            self.buffer = None
+        if self.peer.coalescer is not None:
+            self.peer.coalescer.flush()
+        self.relay.connection_lost()
+
+    def pause_writing(self):
+        self.peer.backpressured = True
+        self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        self.peer.backpressured = False
+        if not self.peer.throttled:
+            self.peer.transport.resume_reading()
+
+
+class Relay:
+    """Callback driven relay between a handshaked client and Telegram connection.
+
+    Takes the transports over from their stream reader/writer pairs, no task runs per
+    connection while relaying. Data the stream readers have already buffered is relayed
+    first. Only the ciphers in use and the underlying stream writers are kept, the
+    handshaked streams can be collected.
+
+    Args:
+        client (:class:`mtproxy.proxy.streams.ClientSteamProtocol`)
+            Handshaked client stream.
+        server (:class:`mtproxy.proxy.streams.ServerStreamProtocol`)
+            Handshaked Telegram stream.
+        fast_mode (``bool``, *optional*)
+            if True, Telegram to client traffic is not re-encrypted.
+        block_if_first_pkt_bad (``bool``, *optional*)
+            if True, drop the connection if the first packet from Telegram is bad.
+        to_server_counters, to_client_counters (``tuple``, *optional*)
+            Relayed bytes counters per direction.
+        to_server_buckets, to_client_buckets (``tuple``, *optional*)
+            Rate limits per direction.
+        to_server_idle, to_client_idle (:class:`mtproxy.proxy.timing_wheel.Timer`, *optional*)
+            Idle timeouts per direction.
+    """
+
+    __slots__ = {'client_ip', 'metrics', 'to_server', 'to_client', 'done', '_lost', '_writers'}
+
+    def __init__(self, client, server, fast_mode: bool = False, block_if_first_pkt_bad: bool = False,
+                 to_server_counters: tuple = (), to_client_counters: tuple = (),
+                 to_server_buckets: tuple = (), to_client_buckets: tuple = (),
+                 to_server_idle=None, to_client_idle=None):
+        config = client.config
+        self.client_ip = client.ip
+        self.metrics = config.metrics
+        self.done = asyncio.get_event_loop().create_future()
+        self._lost = 0
+        # a collected asyncio.StreamWriter closes its transport
+        self._writers = (client.writer.upstream, server.writer.upstream)
+
+        self.to_server = RelayProtocol(
+            self, client.writer.transport, BufferPool.of_size(config.to_server_buffer_size),
+            client.read_sizer(server.writer, config.to_server_buffer_size),
+            decryptor=client.reader.decryptor, encryptor=server.writer.encryptor,
+            counters=to_server_counters, buckets=to_server_buckets, idle=to_server_idle,
+            coalescer=client.write_coalescer(server.writer), header=server.writer.take_header()
+        )
+        self.to_client = RelayProtocol(
+            self, server.writer.transport, BufferPool.of_size(config.to_client_buffer_size),
+            server.read_sizer(client.writer, config.to_client_buffer_size),
+            decryptor=None if fast_mode else server.reader.decryptor,
+            encryptor=None if fast_mode else client.writer.encryptor,
+            counters=to_client_counters, buckets=to_client_buckets, idle=to_client_idle,
+            coalescer=server.write_coalescer(client.writer),
+            block_if_first_pkt_bad=block_if_first_pkt_bad
+        )
+        self.to_server.peer, self.to_client.peer = self.to_client, self.to_server
+
+        for protocol, stream in ((self.to_server, client.reader), (self.to_client, server.reader)):
+            upstream = stream.upstream
+            protocol.transport.set_protocol(protocol)
+            if stream.buf:
+                protocol.feed(bytes(stream.buf))
+                stream.buf.clear()
+            # pick up what the asyncio.StreamReader has received but not returned yet
+            if upstream._buffer:
+                protocol.feed(bytes(upstream._buffer))
+                upstream._buffer.clear()
+            if upstream.at_eof():
+                protocol.eof_received()
+            if not protocol.throttled:
+                protocol.transport.resume_reading()
+
+    def close(self):
+        """Close both transports once their buffered data is sent"""
+        for protocol in (self.to_server, self.to_client):
+            if not protocol.transport.is_closing():
+                protocol.transport.close()
+
+    def connection_lost(self):
+        self._lost += 1
+        self.close()
+        if self._lost == 2 and not self.done.done():
+            self.done.set_result(None)
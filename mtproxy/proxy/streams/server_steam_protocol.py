@@ -1,25 +1,58 @@
+import asyncio
 from .base_stream_protocol import BaseStreamProtocol
+from .splice_relay import SpliceRelay
 from .wappers import (CryptoWrappedStreamReader, CryptoWrappedStreamWriter)
-from ...mtproto import Keys
+from ...mtproto import Keys, IdentityCipher
+from ...utils import log
 
 
 class ServerStreamProtocol(BaseStreamProtocol):
 
     async def handle_handshake(self):
-        sample = Keys.generator(self.proto_tag, dec_key_and_iv=self.config.fast_mode and self.key or False)
+        if self.config.fast_mode or self.config.dc_pool is None:
+            sample = Keys.generator(self.proto_tag, dec_key_and_iv=self.config.fast_mode and self.key or False)
+        else:
+            sample = self.config.dc_pool.take_header(self.proto_tag)
         encryptor = sample.generate_encryptor()
 
         first_message = sample.rev_buf[:sample.PROTO_TAG_POS] + encryptor.encrypt(sample.rev_buf)[
                                                                   sample.PROTO_TAG_POS:]
 
-        self.writer.write(first_message)
-        await self.writer.drain()
-
+        # sent in the same segment as the first client data
         self._stream_reader = CryptoWrappedStreamReader(self._stream_reader, sample.generate_decryptor())
-        self._stream_writer = CryptoWrappedStreamWriter(self._stream_writer, encryptor)
+        self._stream_writer = CryptoWrappedStreamWriter(self._stream_writer, encryptor, header=first_message)
 
         self.handshaked = True
 
     def release_reader(self):
         """release reader decryption function"""
-        self._stream_reader.decryptor.decrypt = lambda data: data
+        self._stream_reader.decryptor = IdentityCipher()
+
+    async def reply_stream(self, n, writer, read_buffer_size, block_if_first_pkt_bad=False, counters=(), buckets=(),
+                           idle=None):
+        if not (self.config.fast_mode and self.config.splice and SpliceRelay.is_supported()):
+            return await super().reply_stream(n, writer, read_buffer_size, block_if_first_pkt_bad, counters,
+                                              buckets, idle)
+
+        # fast mode data is passed as is, so it is spliced in kernel after the first packet check
+        sizer = self.read_sizer(writer, read_buffer_size)
+        try:
+            data = await self.reader.read(read_buffer_size)
+            if block_if_first_pkt_bad and data == BaseStreamProtocol.ERROR_PACKET_DATA:
+                self.config.metrics.first_packet_dropped.value += 1
+                log.warning('fingerprint', "Active fingerprinting detected from %s, dropping it", self.ip)
+                return
+            if data:
+                if idle is not None:
+                    idle.touch()
+                for counter in counters:
+                    counter.value += len(data)
+                writer.write(data)
+                await SpliceRelay(self.reader.upstream, self.writer.transport, writer, read_buffer_size,
+                                  counters, buckets, sizer, idle, self.write_coalescer(writer)).run()
+            log.debug('session_finished', "Finished %s", n)
+            writer.write_eof()
+            await writer.drain()
+
+        except (OSError, asyncio.IncompleteReadError) as e:
+            log.debug('session_error', "Session %s closed: %s", n, e)
@@ -0,0 +1,132 @@
+import os
+import asyncio
+from ..shaper import throttle
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class SpliceRelay:
+    """Kernel side relay of a pass-through stream with ``splice()`` through a pipe.
+
+    Used for the Telegram to client direction in fast mode, where the data is relayed
+    byte for byte. The source transport stops reading and the relay moves the data
+    from the source socket to the destination socket without copying it to user space,
+    waiting for readiness on duplicated descriptors in the event loop.
+
+    Args:
+        reader (:class:`asyncio.StreamReader`)
+            Source stream reader, its buffered data is relayed first.
+        source (:class:`asyncio.Transport`)
+            Source transport.
+        writer (:class:`asyncio.StreamWriter`)
+            Destination stream writer, not written to while splicing.
+        chunk_size (``int``)
+            Max bytes moved per ``splice()`` call.
+        sizer (:class:`mtproxy.proxy.streams.ReadSizer`, *optional*)
+            Adapts the bytes moved per call and the socket buffers, up to ``chunk_size``.
+        idle (:class:`mtproxy.proxy.timing_wheel.Timer`, *optional*)
+            Idle timeout, touched when data is moved.
+        coalescer (:class:`mtproxy.proxy.streams.WriteCoalescer`, *optional*)
+            Holds small moves to the destination back.
+        counters (``tuple``, *optional*)
+            :class:`mtproxy.proxy.metrics.Counter` like relayed bytes counters.
+        buckets (``tuple``, *optional*)
+            :class:`mtproxy.proxy.shaper.TokenBucket` rate limits.
+    """
+
+    FLAGS = getattr(os, 'SPLICE_F_MOVE', 0) | getattr(os, 'SPLICE_F_NONBLOCK', 0)
+
+    __slots__ = {'reader', 'source', 'writer', 'chunk_size', 'sizer', 'idle', 'coalescer', 'counters', 'buckets'}
+
+    def __init__(self, reader, source, writer, chunk_size: int, counters=(), buckets=(), sizer=None, idle=None,
+                 coalescer=None):
+        self.reader = reader
+        self.source = source
+        self.writer = writer
+        self.chunk_size = chunk_size
+        self.sizer = sizer
+        self.idle = idle
+        self.coalescer = coalescer
+        self.counters = counters
+        self.buckets = buckets
+
+    @staticmethod
+    def is_supported() -> bool:
+        return hasattr(os, 'splice')
+
+    async def run(self):
+        """Relay until EOF of the source, raises :class:`OSError` on connection errors"""
+        self.source.pause_reading()
+
+        # send what asyncio has already read, then wait for the destination buffer to empty
+        buffered = bytes(self.reader._buffer)
+        self.reader._buffer.clear()
+        if buffered:
+            for counter in self.counters:
+                counter.value += len(buffered)
+            self.writer.write(buffered)
+        self.writer.transport.set_write_buffer_limits(0)
+        await self.writer.drain()
+
+        src = os.dup(self.source.get_extra_info('socket').fileno())
+        dst = os.dup(self.writer.transport.get_extra_info('socket').fileno())
+        pipe_r, pipe_w = os.pipe()
+        try:
+            os.set_blocking(pipe_r, False)
+            os.set_blocking(pipe_w, False)
+            if fcntl is not None and hasattr(fcntl, 'F_SETPIPE_SZ'):
+                try:
+                    fcntl.fcntl(pipe_w, fcntl.F_SETPIPE_SZ, self.chunk_size)
+                except OSError:
+                    pass
+            await self._splice(src, dst, pipe_r, pipe_w)
+        finally:
+            if self.coalescer is not None:
+                self.coalescer.flush()
+            for fd in (src, dst, pipe_r, pipe_w):
+                os.close(fd)
+
+    async def _splice(self, src: int, dst: int, pipe_r: int, pipe_w: int):
+        loop = asyncio.get_event_loop()
+        sizer = self.sizer
+        while True:
+            size = sizer.size if sizer is not None else self.chunk_size
+            try:
+                pending = os.splice(src, pipe_w, size, flags=SpliceRelay.FLAGS)
+            except BlockingIOError:
+                await self._wait(loop.add_reader, loop.remove_reader, src)
+                continue
+
+            if not pending:
+                return
+            if sizer is not None:
+                sizer.update(pending)
+            if self.idle is not None:
+                self.idle.touch()
+            spliced = pending
+            for counter in self.counters:
+                counter.value += spliced
+
+            while pending:
+                try:
+                    pending -= os.splice(pipe_r, dst, pending, flags=SpliceRelay.FLAGS)
+                except BlockingIOError:
+                    await self._wait(loop.add_writer, loop.remove_writer, dst)
+            if self.coalescer is not None:
+                self.coalescer.written(spliced, size)
+
+            if self.buckets:
+                # the source transport is paused already, the socket is just not read meanwhile
+                await throttle(None, self.buckets, spliced)
+
+    @staticmethod
+    async def _wait(add, remove, fd: int):
+        ready = asyncio.get_event_loop().create_future()
+        add(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            remove(fd)
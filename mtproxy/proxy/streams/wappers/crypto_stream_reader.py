@@ -3,10 +3,10 @@ from .base_stream_reader import LayeredStreamReaderBase
 
 class CryptoWrappedStreamReader(LayeredStreamReaderBase):
 
-    __slots__ = {'upstream', 'decryptor', 'block_size', 'buf'}
+    __slots__ = {'decryptor', 'block_size', 'buf'}
 
     def __init__(self, upstream, decryptor, block_size=1):
-        self.upstream = upstream
+        super().__init__(upstream)
         self.decryptor = decryptor
         self.block_size = block_size
         self.buf = bytearray()
@@ -25,3 +25,15 @@ class CryptoWrappedStreamReader(LayeredStreamReaderBase):
             if needed_till_full_block > 0:
                 data += await self.upstream.readexactly(needed_till_full_block)
             return self.decryptor.decrypt(data)
+
+    async def readexactly(self, n):
+        if not self.buf and self.block_size == 1:
+            return self.decryptor.decrypt(await self.upstream.readexactly(n))
+
+        if len(self.buf) < n:
+            needed = n - len(self.buf)
+            needed += -needed % self.block_size
+            self.buf += self.decryptor.decrypt(await self.upstream.readexactly(needed))
+        ret = bytes(self.buf[:n])
+        del self.buf[:n]
+        return ret
@@ -1,19 +1,29 @@
 from .base_stream_writer import LayeredStreamWriterBase
+from ....utils import log
 
 
 class CryptoWrappedStreamWriter(LayeredStreamWriterBase):
 
-    __slots__ = {'upstream', 'encryptor', 'block_size'}
+    __slots__ = {'encryptor', 'block_size', 'header'}
 
-    def __init__(self, upstream, encryptor, block_size=1):
-        self.upstream = upstream
+    def __init__(self, upstream, encryptor, block_size=1, header: bytes=None):
+        super().__init__(upstream)
         self.encryptor = encryptor
         self.block_size = block_size
+        # sent as is with the first write
+        self.header = header
+
+    def take_header(self) -> bytes:
+        """Header not sent yet, to be sent by the caller"""
+        header, self.header = self.header, None
+        return header
 
     def write(self, data, extra: dict=None):
         if len(data) % self.block_size != 0:
-            print("BUG: writing %d bytes not aligned to block size %d" % (
-                      len(data), self.block_size))
+            log.error('unaligned_write', "BUG: writing %d bytes not aligned to block size %d",
+                      len(data), self.block_size)
             return 0
         q = self.encryptor.encrypt(data)
+        if self.header is not None:
+            q = self.take_header() + q
         return self.upstream.write(q)
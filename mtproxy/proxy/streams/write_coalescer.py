@@ -0,0 +1,41 @@
+import socket
+import asyncio
+from ...utils import set_cork
+
+
+class WriteCoalescer:
+    """Holds the small writes of a relay direction back for a short window.
+
+    The destination socket is corked once a read smaller than the read size is relayed,
+    so the rest of a burst of small packets leaves in full segments, and uncorked
+    ``window`` seconds later to send what is left. The first packet is not delayed.
+
+    Args:
+        sock (:class:`socket.socket`)
+            Destination socket.
+        window (``float``)
+            Seconds small writes are held back.
+    """
+
+    __slots__ = {'sock', 'window', '_handle'}
+
+    def __init__(self, sock, window: float):
+        self.sock = sock
+        self.window = window
+        self._handle = None
+
+    @staticmethod
+    def is_supported() -> bool:
+        return hasattr(socket, 'TCP_CORK')
+
+    def written(self, nbytes: int, size: int):
+        """Account a relayed read of ``nbytes``, out of ``size`` asked for"""
+        if nbytes < size and self._handle is None:
+            set_cork(self.sock, True)
+            self._handle = asyncio.get_event_loop().call_later(self.window, self.flush)
+
+    def flush(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+            set_cork(self.sock, False)
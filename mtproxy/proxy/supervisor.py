@@ -0,0 +1,159 @@
+import os
+import sys
+import time
+import signal
+import asyncio
+import traceback
+from ..utils import log
+
+
+class Supervisor:
+    """Pre-fork worker supervisor.
+
+    Forks ``workers`` processes, each one runs its own event loop and binds the proxy
+    port with ``SO_REUSEPORT``, so the kernel spreads new connections between them.
+    Used handshake keys are moved to shared memory before forking, so replay detection
+    works across workers, per user counters get a segment per worker and the external
+    addresses are looked up once. Crashed workers are restarted with an increasing
+    delay, scheduled while the others are still reaped. SIGHUP reloads the config file
+    in the supervisor, so restarted workers get it too, and in every worker. SIGTERM
+    drains the workers for up to ``drain_timeout`` seconds, a second one stops them
+    right away.
+
+    Args:
+        proxy (:class:`mtproxy.MTProxy`)
+            Configured, not yet started proxy.
+        workers (``int``)
+            Number of worker processes.
+    """
+
+    RESTART_DELAY_MIN = 1
+    RESTART_DELAY_MAX = 30
+    # reaping poll period while a restart is scheduled
+    POLL = 0.1
+
+    __slots__ = {'proxy', 'workers', '_children', '_started', '_delays', '_restarts', '_stopping'}
+
+    def __init__(self, proxy, workers: int):
+        self.proxy = proxy
+        self.workers = workers
+        self._children = {}
+        self._started = {}
+        self._delays = {}
+        # worker_id: restart time
+        self._restarts = {}
+        self._stopping = False
+
+    def run(self):
+        """Fork the workers and supervise them until SIGINT/SIGTERM"""
+        if not hasattr(os, 'fork'):
+            raise RuntimeError("Worker mode is not supported on this platform")
+
+        self.proxy.config.workers = self.workers
+        self.proxy.setup_logging()
+        self.proxy.setup_crypto()
+        self.proxy.setup_replay_cache()
+        self.proxy.setup_accounting(self.workers)
+        self.proxy.setup_middle_proxy()
+        # looked up once, the workers get the addresses
+        self.proxy.setup_ip_info()
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self._reload)
+
+        for worker_id in range(self.workers):
+            self._spawn(worker_id)
+
+        while self._children or self._restarts:
+            now = time.monotonic()
+            for worker_id, restart in list(self._restarts.items()):
+                if restart <= now:
+                    del self._restarts[worker_id]
+                    self._spawn(worker_id)
+
+            try:
+                if self._restarts:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                else:
+                    pid, status = os.wait()
+            except ChildProcessError:
+                pid = 0
+            if not pid:
+                if not self._restarts:
+                    break
+                time.sleep(min(Supervisor.POLL, max(0, min(self._restarts.values()) - time.monotonic())))
+                continue
+
+            worker_id = self._children.pop(pid, None)
+            if worker_id is None or self._stopping:
+                continue
+
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                log.info('worker_exited', "Worker %d (pid %d) exited", worker_id, pid)
+                continue
+
+            log.error('worker_crashed', "Worker %d (pid %d) crashed with status %d, restarting",
+                      worker_id, pid, status)
+            self._restart(worker_id)
+
+    def _restart(self, worker_id: int):
+        if time.monotonic() - self._started[worker_id] < Supervisor.RESTART_DELAY_MAX:
+            delay = min(self._delays.get(worker_id, 0) * 2 or Supervisor.RESTART_DELAY_MIN,
+                        Supervisor.RESTART_DELAY_MAX)
+        else:
+            delay = Supervisor.RESTART_DELAY_MIN
+        self._delays[worker_id] = delay
+        self._restarts[worker_id] = time.monotonic() + delay
+
+    def _spawn(self, worker_id: int):
+        pid = os.fork()
+        if pid:
+            self._children[pid] = worker_id
+            self._started[worker_id] = time.monotonic()
+            return
+
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        if hasattr(signal, 'SIGHUP'):
+            # handled by the worker loop once started
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        code = 0
+        try:
+            self.proxy.config.worker_id = worker_id
+            self.proxy.reset_loop()
+            self.proxy.start()
+            asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, self._drain)
+            self.proxy.run_until_disconnected()
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            log.stop()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+        self._restarts.clear()
+        for pid in self._children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _drain(self):
+        # back to the default action, so a second SIGTERM stops the worker
+        asyncio.get_event_loop().remove_signal_handler(signal.SIGTERM)
+        self.proxy.drain()
+
+    def _reload(self, signum, frame):
+        if self.proxy.config_file:
+            self.proxy.reload()
+        for pid in self._children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
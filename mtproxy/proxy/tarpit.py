@@ -0,0 +1,105 @@
+import time
+import asyncio
+import collections
+
+
+class Tarpit:
+    """Bounded hold of connections that failed the handshake, and cache of the IPs they came from.
+
+    Held connections only keep their transport, with reading paused, so the prober's
+    data stays in the kernel buffers. At most ``max_held`` connections are held, each for
+    ``hold_time`` seconds, then it is aborted by a single timer. IPs that failed in the
+    last ``fail_ttl`` seconds are held again right at accept, with no handshake work.
+
+    Args:
+        max_held (``int``)
+            Max held connections, further ones are aborted.
+        hold_time (``float``)
+            Seconds a connection is held.
+        fail_ttl (``float``)
+            Seconds a failed IP is remembered, 0 disables the cache.
+        metrics (:class:`mtproxy.proxy.metrics.Metrics`, *optional*)
+            Held connections are counted in.
+    """
+
+    FAILED_MAX = 65536
+
+    __slots__ = {'max_held', 'hold_time', 'fail_ttl', 'metrics', '_held', '_failed', '_handle'}
+
+    def __init__(self, max_held: int, hold_time: float, fail_ttl: float, metrics=None):
+        self.max_held = max_held
+        self.hold_time = hold_time
+        self.fail_ttl = fail_ttl
+        self.metrics = metrics
+        # (deadline, transport), in deadline order: see hold
+        self._held = collections.deque()
+        self._failed = collections.OrderedDict()
+        self._handle = None
+
+    def update(self, max_held: int, hold_time: float, fail_ttl: float):
+        """Apply new limits to connections held from now on, a shorter hold time once the held ones are released"""
+        self.max_held = max_held
+        self.hold_time = hold_time
+        self.fail_ttl = fail_ttl
+
+    def failed(self, ip: str):
+        """Remember an IP that failed the handshake"""
+        if not self.fail_ttl:
+            return
+        self._failed.pop(ip, None)
+        self._failed[ip] = time.monotonic() + self.fail_ttl
+        if len(self._failed) > Tarpit.FAILED_MAX:
+            self._failed.popitem(last=False)
+
+    def recently_failed(self, ip: str) -> bool:
+        if not self._failed:
+            return False
+        expiry = self._failed.get(ip)
+        if expiry is None:
+            return False
+        if expiry < time.monotonic():
+            del self._failed[ip]
+            return False
+        if self.metrics is not None:
+            self.metrics.failed_ip_hits.value += 1
+        return True
+
+    def hold(self, transport) -> bool:
+        """Hold a connection, the caller aborts it if it is not held
+
+        Return:
+            ``bool``: True if held.
+        """
+        if len(self._held) >= self.max_held or transport.is_closing():
+            if self.metrics is not None:
+                self.metrics.tarpit_overflow.value += 1
+            return False
+
+        loop = asyncio.get_event_loop()
+        transport.pause_reading()
+        deadline = loop.time() + self.hold_time
+        if self._held:
+            # not before the last one, so a hold time shortened by a reload keeps the queue in order
+            deadline = max(deadline, self._held[-1][0])
+        self._held.append((deadline, transport))
+        if self.metrics is not None:
+            self.metrics.tarpit_held.value = len(self._held)
+        if self._handle is None:
+            self._handle = loop.call_later(self.hold_time, self._release)
+        return True
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        while self._held:
+            self._held.popleft()[1].abort()
+
+    def _release(self):
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        while self._held and self._held[0][0] <= now:
+            self._held.popleft()[1].abort()
+        if self.metrics is not None:
+            self.metrics.tarpit_held.value = len(self._held)
+        self._handle = loop.call_at(self._held[0][0], self._release) if self._held else None
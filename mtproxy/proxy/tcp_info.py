@@ -0,0 +1,120 @@
+import socket
+import struct
+import random
+import asyncio
+
+
+class TCPInfoSampler:
+    """Periodic ``TCP_INFO`` sampling of session sockets.
+
+    A random ``fraction`` of the relayed sessions is tracked while it runs. Once per
+    ``interval`` seconds the kernel TCP state of their client and Telegram sockets is read
+    and observed in the metrics by DC and direction: ``to_client`` for the client socket,
+    ``to_server`` for the Telegram one. Since every tick is a loop timer, its delay is
+    observed too, telling a busy event loop apart from a slow network. Linux only.
+
+    Args:
+        interval (``float``)
+            Seconds between two samples of a socket.
+        fraction (``float``)
+            Share of the sessions sampled, between 0 and 1.
+        metrics (:class:`mtproxy.proxy.metrics.Metrics`)
+            Samples are observed in.
+    """
+
+    # struct tcp_info up to tcpi_total_retrans, long since in every kernel
+    INFO = struct.Struct('8B24I')
+    MSS, UNACKED, RTT, CWND, TOTAL_RETRANS = 10, 12, 23, 26, 31
+
+    __slots__ = {'interval', 'fraction', 'metrics', '_sockets', '_handle', '_scheduled'}
+
+    def __init__(self, interval: float, fraction: float, metrics):
+        self.interval = interval
+        self.fraction = fraction
+        self.metrics = metrics
+        # socket: [dc label, direction, total retransmits at the last sample]
+        self._sockets = {}
+        self._handle = None
+        self._scheduled = None
+
+    @classmethod
+    def is_supported(cls) -> bool:
+        return hasattr(socket, 'TCP_INFO')
+
+    @classmethod
+    def is_needed(cls, interval: float, fraction: float) -> bool:
+        return bool(interval > 0 and fraction > 0) and cls.is_supported()
+
+    def update(self, interval: float, fraction: float):
+        """Apply a new interval from the next tick, a new fraction to new sessions"""
+        self.interval = interval
+        self.fraction = fraction
+
+    def start(self):
+        if self._handle is None:
+            loop = asyncio.get_event_loop()
+            self._scheduled = loop.time() + self.interval
+            self._handle = loop.call_at(self._scheduled, self._sample)
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._sockets.clear()
+
+    def track(self, dc: int, client_transport, server_transport=None) -> tuple:
+        """Sample a session sockets, if picked, until :meth:`untrack`
+
+        Args:
+            dc (``int``)
+                Telegram DC of the session.
+            client_transport (:class:`asyncio.Transport`)
+                Client connection.
+            server_transport (:class:`asyncio.Transport`, *optional*)
+                Telegram connection, None if shared with other sessions.
+
+        Return:
+            ``tuple``: Sampled sockets, empty if the session wasn't picked.
+        """
+        if random.random() >= self.fraction:
+            return ()
+        sockets = ()
+        for transport, direction in ((client_transport, 'to_client'), (server_transport, 'to_server')):
+            sock = transport.get_extra_info('socket') if transport is not None else None
+            if sock is not None:
+                self._sockets[sock] = [str(dc), direction, None]
+                sockets += (sock,)
+        return sockets
+
+    def untrack(self, sockets: tuple):
+        for sock in sockets:
+            self._sockets.pop(sock, None)
+
+    def _sample(self):
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        metrics = self.metrics
+        metrics.event_loop_lag.observe(now - self._scheduled)
+
+        info = TCPInfoSampler.INFO
+        closed = []
+        for sock, state in self._sockets.items():
+            try:
+                values = info.unpack(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, info.size))
+            except (OSError, struct.error):
+                # closed under the session, untracked once it ends
+                closed.append(sock)
+                continue
+            labels = state[0], state[1]
+            metrics.tcp_rtt.labels(*labels).observe(values[TCPInfoSampler.RTT] / 1e6)
+            metrics.tcp_cwnd.labels(*labels).observe(values[TCPInfoSampler.CWND])
+            metrics.tcp_unacked.labels(*labels).observe(values[TCPInfoSampler.UNACKED] * values[TCPInfoSampler.MSS])
+            retransmits = values[TCPInfoSampler.TOTAL_RETRANS]
+            if state[2] is not None:
+                metrics.tcp_retransmits.labels(*labels).observe(retransmits - state[2])
+            state[2] = retransmits
+        for sock in closed:
+            del self._sockets[sock]
+
+        self._scheduled = now + self.interval
+        self._handle = loop.call_at(self._scheduled, self._sample)
@@ -0,0 +1,158 @@
+import asyncio
+from ..utils import log
+
+
+class Timer:
+    """Timeout armed on a :class:`TimingWheel`.
+
+    Cancel it with :meth:`cancel`. A timer that was :meth:`touch`-ed since it was armed
+    doesn't fire at expiry, it is pushed back to its period after the last touch, so
+    inactivity timeouts cost an int store per activity.
+    """
+
+    __slots__ = {'wheel', 'expires', 'period', 'touched', 'callback', 'args', 'slot'}
+
+    def __init__(self, wheel: 'TimingWheel', expires: int, period: int, callback, args: tuple):
+        self.wheel = wheel
+        self.expires = expires
+        self.period = period
+        self.touched = 0
+        self.callback = callback
+        self.args = args
+        self.slot = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.callback is None
+
+    def touch(self):
+        """Restart the period from now"""
+        self.touched = self.wheel.ticks
+
+    def cancel(self):
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+            self.wheel.armed -= 1
+        self.callback = self.args = None
+
+
+class TimingWheel:
+    """Hierarchical timing wheel shared by the connection timeouts.
+
+    Time is counted in ``tick`` seconds. Level ``n`` has ``SLOTS`` slots of
+    ``SLOTS ** n`` ticks each, a timer goes to the lowest level its expiry fits in and is
+    moved down when the level below wraps, so arming, cancelling and expiring a timer
+    take constant time whatever the number of timers. A single loop callback per tick
+    drives the wheel, instead of a timer heap entry, and for ``asyncio.wait_for`` a
+    wrapper task, per timeout. Timers fire up to a tick late.
+
+    Args:
+        tick (``float``, *optional*)
+            Resolution in seconds.
+    """
+
+    TICK = 0.1
+    SLOTS = 64
+    BITS = 6
+    LEVELS = 4
+
+    __slots__ = {'tick', 'ticks', 'armed', '_levels', '_loop', '_started', '_handle'}
+
+    def __init__(self, tick: float = TICK):
+        self.tick = tick
+        self.ticks = 0
+        self.armed = 0
+        self._levels = [[set() for _ in range(TimingWheel.SLOTS)] for _ in range(TimingWheel.LEVELS)]
+        self._loop = None
+        self._started = None
+        self._handle = None
+
+    def start(self):
+        if self._handle is None:
+            self._loop = asyncio.get_event_loop()
+            self._started = self._loop.time() - self.ticks * self.tick
+            self._handle = self._loop.call_later(self.tick, self._advance)
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._loop = None
+        for level in self._levels:
+            for slot in level:
+                for timer in slot:
+                    timer.slot = None
+                slot.clear()
+        self.armed = 0
+
+    def arm(self, delay: float, callback, *args) -> Timer:
+        """Call ``callback(*args)`` in ``delay`` seconds
+
+        Return:
+            :class:`Timer`: to cancel or touch.
+        """
+        # the current tick started up to a tick ago
+        period = -int(-delay // self.tick) + 1
+        now = self.ticks
+        if self._loop is not None:
+            # the wheel lags behind while the loop is busy, count from the clock
+            now = max(now, int((self._loop.time() - self._started) / self.tick))
+        timer = Timer(self, now + period, period, callback, args)
+        self._insert(timer)
+        self.armed += 1
+        return timer
+
+    def _insert(self, timer: Timer):
+        delta = timer.expires - self.ticks
+        level = 0
+        while delta >= TimingWheel.SLOTS and level < TimingWheel.LEVELS - 1:
+            delta >>= TimingWheel.BITS
+            level += 1
+        if level == TimingWheel.LEVELS - 1 and delta >= TimingWheel.SLOTS:
+            # beyond the wheel, parked in its farthest slot and put back when it comes
+            timer.slot = self._levels[level][(self.ticks >> TimingWheel.BITS * level) - 1 & TimingWheel.SLOTS - 1]
+        else:
+            timer.slot = self._levels[level][timer.expires >> TimingWheel.BITS * level & TimingWheel.SLOTS - 1]
+        timer.slot.add(timer)
+
+    def _advance(self):
+        loop = self._loop
+        # catch up if the loop was late
+        target = int((loop.time() - self._started) / self.tick)
+        while self.ticks < target:
+            self._step()
+        self._handle = loop.call_at(self._started + (self.ticks + 1) * self.tick, self._advance)
+
+    def _step(self):
+        self.ticks += 1
+        ticks = self.ticks
+        # move the timers of the slot of each upper level that comes, down the wheel
+        level = 1
+        while level < TimingWheel.LEVELS and not ticks & (1 << TimingWheel.BITS * level) - 1:
+            slot = self._levels[level][ticks >> TimingWheel.BITS * level & TimingWheel.SLOTS - 1]
+            if slot:
+                timers = list(slot)
+                slot.clear()
+                for timer in timers:
+                    self._insert(timer)
+            level += 1
+
+        slot = self._levels[0][ticks & TimingWheel.SLOTS - 1]
+        if not slot:
+            return
+        expired = [timer for timer in slot if timer.expires <= ticks]
+        for timer in expired:
+            slot.discard(timer)
+            if timer.touched + timer.period > ticks:
+                timer.expires = timer.touched + timer.period
+                self._insert(timer)
+                continue
+            timer.slot = None
+            self.armed -= 1
+            callback, args = timer.callback, timer.args
+            timer.callback = timer.args = None
+            try:
+                callback(*args)
+            except Exception as e:
+                log.error('timer_error', "Timer callback %r failed: %r", callback, e)
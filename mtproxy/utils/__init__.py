@@ -1,7 +1,9 @@
 from .async_tools import AsyncTools
 from .user import User
 from .ip_info import IPInfo
-from .socket_settings import set_keepalive, set_ack_timeout, set_bufsizes
+from .socket_settings import set_keepalive, set_ack_timeout, set_bufsizes, set_nodelay, set_notsent_lowat, set_cork
 from .ext import setup_files_limit
+from .log import log
 
-__all__ = ['AsyncTools', 'User', 'IPInfo', 'set_keepalive', 'set_ack_timeout', 'set_bufsizes', 'setup_files_limit']
+__all__ = ['AsyncTools', 'User', 'IPInfo', 'set_keepalive', 'set_ack_timeout', 'set_bufsizes', 'set_nodelay',
+           'set_notsent_lowat', 'set_cork', 'setup_files_limit', 'log']
@@ -18,6 +18,20 @@ class AsyncTools:
 
         return loop
 
+    @classmethod
+    def new_loop(cls):
+        """Create and set a fresh event loop, e.g. in a forked worker process"""
+
+        AsyncTools.try_setup_uvloop()
+
+        if sys.platform == "win32":
+            loop = asyncio.ProactorEventLoop()
+        else:
+            loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        return loop
+
     @staticmethod
     def try_setup_uvloop():
         try:
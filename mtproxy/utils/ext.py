@@ -1,6 +1,14 @@
-import urllib.request
-import sys
 import signal
+import socket
+import asyncio
+import ipaddress
+import urllib.parse
+from .log import log
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 def setup_files_limit():
@@ -9,20 +17,110 @@ def setup_files_limit():
         soft_fd_limit, hard_fd_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
         resource.setrlimit(resource.RLIMIT_NOFILE, (hard_fd_limit, hard_fd_limit))
     except (ValueError, OSError):
-        print("Failed to increase the limit of opened files", flush=True, file=sys.stderr)
+        log.warning('files_limit', "Failed to increase the limit of opened files")
     except ImportError:
         pass
 
 
-def get_ip_from_url(url):
-    TIMEOUT = 5
+async def get_ip_from_url(url: str, family: int = 0, timeout: float = 5):
+    """Address an HTTP(S) URL answers with, None if it fails or isn't an address
+
+    Args:
+        url (``str``)
+            URL answering with the plain address of the client.
+        family (``int``, *optional*)
+            ``socket.AF_INET`` or ``socket.AF_INET6`` to connect with, and to expect.
+        timeout (``float``, *optional*)
+            Seconds for the whole request.
+    """
     try:
-        with urllib.request.urlopen(url, timeout=TIMEOUT) as f:
-            if f.status != 200:
-                raise Exception("Invalid status code")
-            return f.read().decode().strip()
-    except Exception:
+        address = ipaddress.ip_address((await asyncio.wait_for(http_get(url, family), timeout)).decode().strip())
+    except (OSError, ValueError, UnicodeDecodeError, asyncio.TimeoutError):
+        return None
+    if family and address.version != (6 if family == socket.AF_INET6 else 4):
         return None
+    return str(address)
+
+
+async def http_get(url: str, family: int = 0, limit: int = 4096) -> bytes:
+    """Body of a small HTTP(S) GET response
+
+    Raises:
+        :class:`OSError`: if the request failed.
+        :class:`ValueError`: if the status isn't 200.
+    """
+    url = urllib.parse.urlsplit(url)
+    reader, writer = await asyncio.open_connection(url.hostname, url.port or (443 if url.scheme == 'https' else 80),
+                                                   family=family, ssl=url.scheme == 'https' or None)
+    try:
+        writer.write(('GET %s HTTP/1.0\r\nHost: %s\r\nConnection: close\r\n\r\n'
+                      % (url.path or '/', url.netloc)).encode())
+        response = b''
+        while len(response) < limit:
+            data = await reader.read(limit)
+            if not data:
+                break
+            response += data
+    finally:
+        writer.transport.abort()
+
+    head, _, body = response.partition(b'\r\n\r\n')
+    if head.split(b' ', 2)[1:2] != [b'200']:
+        raise ValueError("Bad HTTP response %r" % head[:64])
+    return body
+
+
+class FileLock:
+    """POSIX record lock on a byte range of a file, released by the kernel if its holder dies
+
+    Record locks are per process: any descriptor of the file closed by the holder drops
+    it, and forked children don't inherit it. Used as a context manager, it is held
+    exclusively. A no-op where ``fcntl`` is missing.
+
+    Args:
+        fd (``int``)
+            Descriptor of the file, open for reading and writing.
+        start (``int``, *optional*)
+            First locked byte.
+        length (``int``, *optional*)
+            Locked bytes, 0 up to any end of the file.
+    """
+
+    __slots__ = {'fd', 'start', 'length'}
+
+    def __init__(self, fd: int, start: int = 0, length: int = 0):
+        self.fd = fd
+        self.start = start
+        self.length = length
+
+    def acquire(self, shared: bool = False, blocking: bool = True) -> bool:
+        """Take the lock, or convert the one held by this process
+
+        Return:
+            ``bool``: False if not blocking and another process holds a conflicting lock.
+        """
+        if fcntl is None:
+            return True
+        operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            operation |= fcntl.LOCK_NB
+        try:
+            fcntl.lockf(self.fd, operation, self.length, self.start)
+        except OSError:
+            if blocking:
+                raise
+            return False
+        return True
+
+    def release(self):
+        if fcntl is not None:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, self.length, self.start)
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
 
 
 def setup_debug():
@@ -1,33 +1,114 @@
+import os
+import json
+import time
+import socket
+import asyncio
 from .ext import get_ip_from_url
+from .log import log
 
 
 class IPInfo:
+    """External addresses lookup.
 
-    PREFER_IPV6 = False
-    IPV4 = None
-    IPV6 = None
+    The addresses are asked to public "what is my IP" services, every URL of a family at
+    once over a connection of that family, the first valid answer wins. Found addresses
+    are kept in a JSON cache file, each looked up again once ``cache_ttl`` seconds old.
 
-    IPV4_URL1 = "http://v4.ident.me/"
-    IPV4_URL2 = "http://ipv4.icanhazip.com/"
+    Args:
+        ipv4_url (``str``, *optional*)
+            URL answering with the IPv4 address, instead of the public services.
+        ipv6_url (``str``, *optional*)
+            URL answering with the IPv6 address, instead of the public services.
+        cache_file (``str``, *optional*)
+            Cache file path, no cache if Ignored.
+        cache_ttl (``float``, *optional*)
+            Seconds cached addresses are used for.
+    """
 
-    IPV6_URL1 = "http://v6.ident.me/"
-    IPV6_URL2 = "http://ipv6.icanhazip.com/"
+    IPV4_URLS = ("http://v4.ident.me/", "http://ipv4.icanhazip.com/")
+    IPV6_URLS = ("http://v6.ident.me/", "http://ipv6.icanhazip.com/")
 
-    def __new__(cls, prefer_ipv6: bool=PREFER_IPV6):
-        ipv4 = get_ip_from_url(cls.IPV4_URL1) or get_ip_from_url(cls.IPV4_URL2)
-        ipv6 = get_ip_from_url(cls.IPV6_URL1) or get_ip_from_url(cls.IPV6_URL2)
+    TIMEOUT = 5
+    CACHE_TTL = 24 * 60 * 60
 
-        if prefer_ipv6:
-            if ipv6:
-                print("IPv6 found, using it for external communication")
-            else:
-                prefer_ipv6 = False
+    __slots__ = {'ipv4_urls', 'ipv6_urls', 'cache_file', 'cache_ttl'}
 
-        cls.PREFER_IPV6 = prefer_ipv6
-        cls.IPV4 = ipv4
-        cls.IPV6 = ipv6
+    def __init__(self, ipv4_url: str = None, ipv6_url: str = None, cache_file: str = None,
+                 cache_ttl: float = CACHE_TTL):
+        self.ipv4_urls = (ipv4_url,) if ipv4_url else IPInfo.IPV4_URLS
+        self.ipv6_urls = (ipv6_url,) if ipv6_url else IPInfo.IPV6_URLS
+        self.cache_file = cache_file
+        self.cache_ttl = cache_ttl
 
-        # instance = super(IP_Info, cls).__new__(cls)
-        # return instance
+    @classmethod
+    def is_needed(cls, enabled: bool, ipv4: str, ipv6: str) -> bool:
+        return bool(enabled and not (ipv4 and ipv6))
 
-        return cls
+    async def discover(self, ipv4: bool = True, ipv6: bool = True) -> tuple:
+        """Look the addresses up, from the cache if fresh
+
+        Args:
+            ipv4, ipv6 (``bool``, *optional*)
+                Families to look up.
+
+        Return:
+            ``tuple``: (IPv4 address, IPv6 address), None for the ones not looked up or not found.
+        """
+        found = self.cached()
+        lookups = [(family, urls, socket_family) for family, urls, socket_family, wanted in (
+            ('ipv4', self.ipv4_urls, socket.AF_INET, ipv4), ('ipv6', self.ipv6_urls, socket.AF_INET6, ipv6)
+        ) if wanted and not found.get(family)]
+        if lookups:
+            addresses = await asyncio.gather(*[self._lookup(urls, socket_family)
+                                               for _, urls, socket_family in lookups])
+            fresh = {family: address for (family, _, _), address in zip(lookups, addresses) if address}
+            if fresh:
+                found.update(fresh)
+                self._save(fresh)
+
+        return found.get('ipv4') if ipv4 else None, found.get('ipv6') if ipv6 else None
+
+    def cached(self) -> dict:
+        """Cached addresses by family name, the ones too old left out"""
+        now = time.time()
+        return {family: entry['address'] for family, entry in self._read().items()
+                if now - entry['time'] < self.cache_ttl}
+
+    def _read(self) -> dict:
+        """Cache entries, ``{'ipv4': {'address': ..., 'time': ...}, ...}``"""
+        if not self.cache_file:
+            return {}
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+            return {family: {'address': str(cache[family]['address']), 'time': float(cache[family]['time'])}
+                    for family in ('ipv4', 'ipv6') if family in cache}
+        except (OSError, ValueError, KeyError, TypeError):
+            return {}
+
+    def _save(self, fresh: dict):
+        if not self.cache_file:
+            return
+        cache = self._read()
+        now = time.time()
+        cache.update({family: {'address': address, 'time': now} for family, address in fresh.items()})
+        # written aside and moved, workers may look up at once
+        temp = '%s.%d' % (self.cache_file, os.getpid())
+        try:
+            with open(temp, 'w') as f:
+                json.dump(cache, f)
+            os.replace(temp, self.cache_file)
+        except OSError as e:
+            log.warning('ip_cache', "Failed to write the addresses cache %s: %s", self.cache_file, e)
+
+    async def _lookup(self, urls: tuple, family: int):
+        pending = [asyncio.ensure_future(get_ip_from_url(url, family, IPInfo.TIMEOUT)) for url in urls]
+        try:
+            for lookup in asyncio.as_completed(pending):
+                address = await lookup
+                if address:
+                    return address
+        finally:
+            for lookup in pending:
+                lookup.cancel()
+        return None
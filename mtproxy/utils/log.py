@@ -0,0 +1,206 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+
+
+class RateLimiter:
+    """Per event type rate limit and sampling of log messages.
+
+    Every event type has a token bucket of ``rate`` messages per second, and only one in
+    ``sample`` messages of a type is considered at all. Dropped messages are counted and
+    reported with the next message of the same type.
+
+    Args:
+        rate (``float``, *optional*)
+            Messages per second per event type, 0 for no limit.
+        sample (``int``, *optional*)
+            Keep one in this number of messages per event type.
+    """
+
+    __slots__ = {'rate', 'sample', '_events'}
+
+    def __init__(self, rate: float = 10, sample: int = 1):
+        self.rate = rate
+        self.sample = sample
+        # event: [tokens, last refill, seen, suppressed]
+        self._events = {}
+
+    def allow(self, event: str):
+        """Count a message
+
+        Return:
+            ``int``: number of suppressed messages of the event type since the last allowed
+            one, or None if this one is suppressed too.
+        """
+        state = self._events.get(event)
+        now = time.monotonic()
+        if state is None:
+            state = self._events[event] = [self.rate, now, 0, 0]
+
+        state[2] += 1
+        if self.sample > 1 and state[2] % self.sample:
+            state[3] += 1
+            return None
+
+        if self.rate:
+            tokens = min(self.rate, state[0] + (now - state[1]) * self.rate)
+            state[1] = now
+            if tokens < 1:
+                state[0] = tokens
+                state[3] += 1
+                return None
+            state[0] = tokens - 1
+
+        suppressed, state[3] = state[3], 0
+        return suppressed
+
+
+class TextFormatter(logging.Formatter):
+
+    def format(self, record) -> str:
+        line = '%s %s %s' % (self.formatTime(record), record.levelname, record.getMessage())
+        if record.fields:
+            line += ' ' + ' '.join('%s=%s' % item for item in record.fields.items())
+        if record.suppressed:
+            line += ' (%d similar suppressed)' % record.suppressed
+        return line
+
+
+class JSONFormatter(logging.Formatter):
+
+    def format(self, record) -> str:
+        entry = {'ts': round(record.created, 3), 'level': record.levelname.lower(), 'event': record.event,
+                 'pid': record.process, 'msg': record.getMessage()}
+        entry.update(record.fields)
+        if record.suppressed:
+            entry['suppressed'] = record.suppressed
+        return json.dumps(entry, separators=(',', ':'), default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Enqueues records as they are, they are formatted by the listener thread"""
+
+    def __init__(self, log_queue, log):
+        super().__init__(log_queue)
+        self.log = log
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.log.dropped += 1
+
+
+class Log:
+    """Non-blocking proxy logger.
+
+    Records are put on a bounded queue and written by a background thread, so the event
+    loop never waits on the output. Messages below the level are discarded before a
+    record is made, the others are rate limited and sampled per event type by a
+    :class:`RateLimiter`. Records that don't fit in the queue are counted in ``dropped``.
+
+    The writer thread starts on first use and again in forked processes.
+    """
+
+    LEVELS = {'debug': logging.DEBUG, 'info': logging.INFO, 'warning': logging.WARNING,
+              'error': logging.ERROR}
+    QUEUE_SIZE = 10000
+
+    __slots__ = {'logger', 'level', 'limiter', 'json_output', 'stream', 'dropped', '_listener'}
+
+    def __init__(self, name: str = 'mtproxy'):
+        self.logger = logging.getLogger(name)
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+        self.level = logging.INFO
+        self.limiter = RateLimiter()
+        self.json_output = False
+        self.stream = None
+        self.dropped = 0
+        self._listener = None
+
+        atexit.register(self.stop)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def setup(self, level: str = 'info', json_output: bool = False, rate: float = 10, sample: int = 1,
+              stream=None):
+        """Configure the logger
+
+        Args:
+            level (``str``, *optional*)
+                'debug', 'info', 'warning' or 'error'.
+            json_output (``bool``, *optional*)
+                if True, write a compact JSON object per line.
+            rate (``float``, *optional*)
+                Messages per second per event type, 0 for no limit.
+            sample (``int``, *optional*)
+                Keep one in this number of messages per event type.
+            stream (``file``, *optional*)
+                Output, stderr by default.
+        """
+        if level not in Log.LEVELS:
+            raise ValueError("Unknown log level %s" % level)
+
+        self.stop()
+        self.level = Log.LEVELS[level]
+        self.limiter = RateLimiter(rate, sample)
+        self.json_output = json_output
+        self.stream = stream
+
+    def start(self):
+        if self._listener is not None:
+            return
+
+        log_queue = queue.Queue(Log.QUEUE_SIZE)
+        output = logging.StreamHandler(self.stream or sys.stderr)
+        output.setFormatter(JSONFormatter() if self.json_output else TextFormatter())
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+        self.logger.addHandler(_QueueHandler(log_queue, self))
+        self._listener = logging.handlers.QueueListener(log_queue, output)
+        self._listener.start()
+
+    def stop(self):
+        """Write the queued records and stop the writer thread"""
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+    def _after_fork(self):
+        # the writer thread doesn't survive fork, a new one is started on first use
+        self._listener = None
+        self.logger.handlers.clear()
+
+    def log(self, level: int, event: str, msg: str, *args, **fields):
+        if level < self.level:
+            return
+        suppressed = self.limiter.allow(event)
+        if suppressed is None:
+            return
+        if self._listener is None:
+            self.start()
+        self.logger.log(level, msg, *args, extra={'event': event, 'fields': fields, 'suppressed': suppressed})
+
+    def debug(self, event: str, msg: str, *args, **fields):
+        self.log(logging.DEBUG, event, msg, *args, **fields)
+
+    def info(self, event: str, msg: str, *args, **fields):
+        self.log(logging.INFO, event, msg, *args, **fields)
+
+    def warning(self, event: str, msg: str, *args, **fields):
+        self.log(logging.WARNING, event, msg, *args, **fields)
+
+    def error(self, event: str, msg: str, *args, **fields):
+        self.log(logging.ERROR, event, msg, *args, **fields)
+
+
+log = Log()
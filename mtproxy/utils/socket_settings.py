@@ -26,3 +26,17 @@ def set_ack_timeout(sock, timeout):
 def set_bufsizes(sock, recv_buf, send_buf):
     try_setsockopt(sock, socket.SOL_SOCKET, socket.SO_RCVBUF, recv_buf)
     try_setsockopt(sock, socket.SOL_SOCKET, socket.SO_SNDBUF, send_buf)
+
+
+def set_nodelay(sock, enabled=True):
+    try_setsockopt(sock, socket.IPPROTO_TCP, socket.TCP_NODELAY, int(enabled))
+
+
+def set_notsent_lowat(sock, size):
+    if hasattr(socket, "TCP_NOTSENT_LOWAT"):
+        try_setsockopt(sock, socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT, size)
+
+
+def set_cork(sock, enabled):
+    if hasattr(socket, "TCP_CORK"):
+        try_setsockopt(sock, socket.IPPROTO_TCP, socket.TCP_CORK, int(enabled))
@@ -1,3 +1,5 @@
 from collections import namedtuple
 
-User = namedtuple('User', ('name', 'secret'))
+User = namedtuple('User', ('name', 'secret', 'rate'))
+# bytes per second in each direction, no limit by default
+User.__new__.__defaults__ = (None,)
@@ -38,7 +38,8 @@ setup(name='MTProxy',
       packages=['mtproxy', 'mtproxy.utils', 'mtproxy.mtproto', 'mtproxy.proxy', 'mtproxy.proxy.streams', 'mtproxy.proxy.streams.wappers'],
       install_requires=['cryptography'],
       extras_require={
-          'fast': ['uvloop']
+          'fast': ['uvloop'],
+          'crypto': ['tgcrypto', 'pycryptodome']
       },
       entry_points={
           'console_scripts': [